@@ -10,11 +10,16 @@ except ImportError:
 
 from .experiment import Experiment, ExperimentError, ParameterSet, Result, ResultList
 from .parallelexperiment import ParallelExperiment
+from .processpoolexperiment import ProcessPoolExperiment
 from .measurement import FileMeasurement, MemoryMeasurement
 from .serialization import XMLArchive, XMLArchiveError, JsonArchive, \
                            JsonArchiveError, Serializer, Archive, \
-                           ArchiveError, archive_exists, RecursiveSerializer
+                           ArchiveError, archive_exists, RecursiveSerializer, \
+                           NpySidecar, H5Archive, H5ArchiveError, \
+                           BinArchive, BinArchiveError, convert_archive
 from .config import expand_path, load_config, create_config_file, \
                     create_default_config
 from .indexfile import IndexFile
+from .catalog import MeasurementCatalog
+from .store import MeasurementStore
 from . import test
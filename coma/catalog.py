@@ -0,0 +1,192 @@
+# Copyright (c) 2014, Burkhard Ritter
+# This code is distributed under the two-clause BSD License.
+
+import os
+import sqlite3
+from collections import OrderedDict
+from .serialization import JsonArchive
+from .measurement import FileMeasurement
+from .util import map_in_pool
+
+_SCHEMA = '''\
+CREATE TABLE IF NOT EXISTS measurements (
+    id INTEGER PRIMARY KEY,
+    filename TEXT,
+    mtime REAL,
+    size INTEGER,
+    start_date TEXT,
+    end_date TEXT
+);
+CREATE TABLE IF NOT EXISTS paths (
+    path TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS "values" (
+    measurement_id INTEGER,
+    path TEXT,
+    value TEXT,
+    PRIMARY KEY (measurement_id, path)
+);
+'''
+
+def _dump_values(archive, m, paths):
+    vs = []
+    for p in paths:
+        try:
+            vs.append(archive.dumps(m[p]))
+        except KeyError:
+            vs.append(None)
+    return vs
+
+def _load_values(args):
+    # Runs in a worker process or thread
+    mid,f,config,paths = args
+    m = FileMeasurement(f, mid, config=config, paths=paths)
+    a = JsonArchive(None, pretty_print=False, config=config)
+    return m.start_date, m.end_date, _dump_values(a, m, paths)
+
+class MeasurementCatalog(object):
+    """A catalog of an experiment's measurement files.
+
+    For each measurement the catalog records the id, filename, modification
+    time, size, start and end date, and the values at all tracked paths (e.g.
+    the paths of the parameter set definition). Values are stored as JSON; a
+    missing path is stored as NULL. The catalog is an sqlite database, by
+    default "measurement.catalog" in the experiment directory.
+
+    The catalog is updated whenever a measurement that knows about the catalog
+    is saved. Measurement files that were created, modified or deleted
+    otherwise are picked up by `sync`.
+    """
+    def __init__(self, filename, config=None):
+        self.filename = filename
+        self.dir = os.path.dirname(filename)
+        self.config = config
+        self.archive = JsonArchive(None, pretty_print=False, config=config)
+        self._db = None
+
+    @property
+    def db(self):
+        # Only create the database file when it's actually used
+        if self._db is None:
+            self._db = sqlite3.connect(self.filename, timeout=60)
+            self._db.executescript(_SCHEMA)
+        return self._db
+
+    def exists(self):
+        return os.path.exists(self.filename)
+
+    def sync(self, files, workers=None):
+        """Bring the catalog up to date with the measurement files.
+
+        `files` is a list of (measurement id, filename) tuples of all existing
+        measurements. Measurements whose files changed or are not in the
+        catalog yet are (partially) loaded and added, measurements that no
+        longer exist are removed. With `workers`, measurements are loaded in
+        parallel (see coma.util.map_in_pool).
+        """
+        rows = {}
+        for mid,f,mtime,size in self.db.execute(
+                'SELECT id,filename,mtime,size FROM measurements'):
+            rows[mid] = (f,mtime,size)
+        stale = []
+        for mid,f in files:
+            st = os.stat(f)
+            r = rows.pop(mid, None)
+            if r != (os.path.basename(f), st.st_mtime, st.st_size):
+                stale.append((mid,f))
+        for mid in rows.keys():
+            self._delete(mid)
+        paths = self.paths()
+        rs = self._load(stale, paths, workers)
+        for (mid,f),(start_date,end_date,vs) in zip(stale, rs):
+            self._insert_row(mid, f, start_date, end_date, paths, vs)
+        self.db.commit()
+
+    def update(self, m):
+        """Add or update the measurement `m`, a FileMeasurement."""
+        self._insert(m)
+        self.db.commit()
+
+    def paths(self):
+        return [p for p, in self.db.execute('SELECT path FROM paths')]
+
+    def values(self, paths, workers=None):
+        """Return the values at `paths` for all measurements.
+
+        Returns a list of (measurement id, tuple of values), ordered by
+        measurement id. Measurements that lack any of the paths are left out.
+        Paths that are not tracked yet are added to the catalog, which
+        requires (partially) loading all measurements once, with `workers` in
+        parallel.
+        """
+        paths = [p if isinstance(p, basestring) else '/'.join(str(s) for s in p)
+                 for p in paths]
+        if len(paths) == 0:
+            ids = self.db.execute('SELECT id FROM measurements ORDER BY id')
+            return [(mid,()) for mid, in ids]
+        tracked = self.paths()
+        new = [p for p in OrderedDict.fromkeys(paths) if p not in tracked]
+        if len(new) > 0:
+            self._track(new, workers)
+
+        # A definition may use the same path more than once
+        unique = list(set(paths))
+        vs = {}
+        q = 'SELECT measurement_id,path,value FROM "values" WHERE path IN ({})'
+        q = q.format(','.join('?' for p in unique))
+        for mid,p,v in self.db.execute(q, unique):
+            vs.setdefault(mid, {})[p] = v
+        rs = []
+        for mid in sorted(vs.keys()):
+            d = vs[mid]
+            if len(d) != len(unique) or None in d.values():
+                continue
+            rs.append((mid, tuple(self.archive.loads(d[p]) for p in paths)))
+        return rs
+
+    def clear(self):
+        self.db.execute('DELETE FROM measurements')
+        self.db.execute('DELETE FROM "values"')
+        self.db.commit()
+
+    def remove(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+        if self.exists():
+            os.remove(self.filename)
+
+    def _track(self, paths, workers=None):
+        for p in paths:
+            self.db.execute('INSERT OR IGNORE INTO paths VALUES (?)', (p,))
+        fs = self.db.execute('SELECT id,filename FROM measurements').fetchall()
+        fs = [(mid,os.path.join(self.dir, f)) for mid,f in fs]
+        rs = self._load(fs, paths, workers)
+        for (mid,f),(start_date,end_date,vs) in zip(fs, rs):
+            self._insert_values(mid, paths, vs)
+        self.db.commit()
+
+    def _load(self, files, paths, workers):
+        args = [(mid,f,self.config,paths) for mid,f in files]
+        return map_in_pool(_load_values, args, workers)
+
+    def _insert(self, m):
+        paths = self.paths()
+        self._insert_row(m.id, m.archive.filename, m.start_date, m.end_date,
+                         paths, _dump_values(self.archive, m, paths))
+
+    def _insert_row(self, mid, f, start_date, end_date, paths, vs):
+        st = os.stat(f)
+        self.db.execute('INSERT OR REPLACE INTO measurements VALUES (?,?,?,?,?,?)',
+                        (mid, os.path.basename(f), st.st_mtime, st.st_size,
+                         start_date, end_date))
+        self._insert_values(mid, paths, vs)
+
+    def _insert_values(self, mid, paths, vs):
+        for p,v in zip(paths, vs):
+            self.db.execute('INSERT OR REPLACE INTO "values" VALUES (?,?,?)',
+                            (mid, p, v))
+
+    def _delete(self, mid):
+        self.db.execute('DELETE FROM measurements WHERE id=?', (mid,))
+        self.db.execute('DELETE FROM "values" WHERE measurement_id=?', (mid,))
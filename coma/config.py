@@ -12,10 +12,27 @@ DEFAULT_CONFIG_FILE='''\
 ; experiment_index = experiment.index
 ; measurement_file = measurement.${measurement_id}
 ; measurement_index = measurement.index
+; measurement_catalog = measurement.catalog
+; measurement_store = measurement.store.npz
+; measurement_result_cache = measurement.results
+; experiment_load_workers = 1
+; experiment_result_cache = no
 ; archive_default_format = json
 ; archive_pretty_print = yes
+; archive_compression_level = none
+; archive_json_backend = auto
+; archive_json_ordered = yes
+; archive_xml_numeric_arrays = no
+; archive_h5_compression = none
+; archive_h5_compression_level = none
 ; serializer_getstate = coma_getstate
 ; serializer_setstate = coma_setstate
+; serializer_ndarray_encoding = list
+; serializer_columns = no
+; serializer_references = no
+; measurement_sidecar_threshold = none
+; index_lock_timeout = 60
+; index_lock_expiry = 300
 '''
 
 CONFIG_OPTIONS = [
@@ -23,10 +40,27 @@ CONFIG_OPTIONS = [
     ('experiment_index', 'str'),
     ('measurement_file', 'str'),
     ('measurement_index', 'str'),
+    ('measurement_catalog', 'str'),
+    ('measurement_store', 'str'),
+    ('measurement_result_cache', 'str'),
+    ('experiment_load_workers', 'int'),
+    ('experiment_result_cache', 'bool'),
     ('archive_default_format', 'str'),
     ('archive_pretty_print', 'bool'),
+    ('archive_compression_level', 'int'),
+    ('archive_json_backend', 'str'),
+    ('archive_json_ordered', 'bool'),
+    ('archive_xml_numeric_arrays', 'bool'),
+    ('archive_h5_compression', 'str'),
+    ('archive_h5_compression_level', 'int'),
     ('serializer_getstate', 'str'),
-    ('serializer_setstate', 'str')
+    ('serializer_setstate', 'str'),
+    ('serializer_ndarray_encoding', 'str'),
+    ('serializer_columns', 'bool'),
+    ('serializer_references', 'bool'),
+    ('measurement_sidecar_threshold', 'int'),
+    ('index_lock_timeout', 'int'),
+    ('index_lock_expiry', 'int')
 ]
 
 CONFIG_DIR = '~/.config/coma'
@@ -60,6 +94,13 @@ def load_config(configfile='preferences.conf'):
                 d[o] = c.get('coma', o)
             elif t == 'bool':
                 d[o] = c.getboolean('coma', o)
+            elif t == 'int':
+                # "none" leaves an optional setting unset, e.g. to turn off
+                # sidecar files
+                if c.get('coma', o).lower() == 'none':
+                    d[o] = None
+                else:
+                    d[o] = c.getint('coma', o)
     return d
 
 def create_config_file(configfile):
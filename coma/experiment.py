@@ -1,27 +1,138 @@
 # Copyright (c) 2013, Burkhard Ritter
 # This code is distributed under the two-clause BSD License.
 
-from collections import OrderedDict
+from collections import OrderedDict, deque
 import os
 import re
 from string import Template
 import numpy as np
-from .serialization import Archive, archive_exists
-from .util import current_date_as_string
+from .serialization import Archive, NpySidecar, archive_exists
+from .util import current_date_as_string, map_in_pool
 from .indexfile import IndexFile
 from .config import expand_path, load_config
 from .measurement import FileMeasurement, MemoryMeasurement
+from .catalog import MeasurementCatalog
+from .store import MeasurementStore
+from .resultcache import ResultCache
 
 class ExperimentError(Exception):
     pass
 
+def _tuplify(l):
+    """Recursively converts all lists in l into tuples."""
+    if isinstance(l,list):
+        vs = []
+        for v in l:
+            vs.append(_tuplify(v))
+        return tuple(vs)
+    else:
+        return l
+
+def _flatten_list(n, l):
+    """Flattens the list, returning a list of names and a list of values."""
+    ns = []
+    vs = []
+    for i,v in enumerate(l):
+        nn = n + '_' + str(i+1)
+        if isinstance(v,list):
+            ns_,vs_ = _flatten_list(nn,v)
+            ns.extend(ns_)
+            vs.extend(vs_)
+        else:
+            ns.append(nn)
+            vs.append(v)
+    return ns,vs
+
+def _format_rank(filename):
+    for i,f in enumerate(Archive.formats):
+        if filename.endswith('.' + f):
+            return i
+    return len(Archive.formats)
+
+def _result_row(m, tdef, pdef):
+    """Extract a row of a results table from measurement `m`.
+
+    Returns the parameter tuple, the row and its column names, or None if the
+    measurement lacks any of the paths.
+    """
+    try:
+        p,t,c = [],[],[]
+        for name,path in pdef.iteritems():
+            p.append(m[path])
+        p = _tuplify(p)
+        for name,path in tdef.iteritems():
+            v = m[path]
+            if isinstance(v,list):
+                ns,vs = _flatten_list(name,v)
+                t.extend(vs)
+                c.extend(ns)
+            else:
+                t.append(v)
+                c.append(name)
+        return (p,t,tuple(c))
+    except KeyError:
+        return None
+
+_INTS = (int, long, np.integer)
+_NUMBERS = (int, long, float, np.integer, np.floating)
+_BOOLS = (bool, np.bool_)
+
+def _column_dtype(t, j):
+    """Infer the dtype of column `j` of the table `t`, a list of rows."""
+    ts = set(type(r[j]) for r in t)
+    if all(issubclass(x, _BOOLS) for x in ts):
+        return np.dtype(bool)
+    if not any(issubclass(x, _BOOLS) for x in ts):
+        if all(issubclass(x, _INTS) for x in ts):
+            if all(-2**63 <= r[j] < 2**63 for r in t):
+                return np.dtype(np.int64)
+        elif all(issubclass(x, _NUMBERS) for x in ts):
+            return np.dtype(np.float64)
+        elif all(issubclass(x, str) for x in ts):
+            return np.dtype('S{}'.format(max(1, max(len(r[j]) for r in t))))
+        elif all(issubclass(x, basestring) for x in ts):
+            return np.dtype('U{}'.format(max(1, max(len(r[j]) for r in t))))
+    return np.dtype(object)
+
+def _typed_column(t, j):
+    dt = _column_dtype(t, j)
+    if dt.kind in 'bif':
+        return np.fromiter((r[j] for r in t), dt, len(t))
+    a = np.empty(len(t), dtype=dt)
+    for i,r in enumerate(t):
+        a[i] = r[j]
+    return a
+
+def _typed_table(t, columns, table_format):
+    """Convert the table `t` column by column into typed arrays.
+
+    Returns an OrderedDict of arrays if `table_format` is 'columns', and a
+    record array otherwise.
+    """
+    cs = OrderedDict()
+    for j,c in enumerate(columns):
+        cs[c] = _typed_column(t, j)
+    if table_format == 'columns':
+        return cs
+    a = np.empty(len(t), dtype=[(str(c),x.dtype) for c,x in cs.iteritems()])
+    for c,x in cs.iteritems():
+        a[str(c)] = x
+    return a.view(np.recarray)
+
+def _load_result_row(args):
+    # Runs in a worker process or thread
+    mid,f,config,tdef,pdef = args
+    m = FileMeasurement(f, mid, config=config, paths=pdef.values()+tdef.values())
+    return _result_row(m, tdef, pdef)
+
 class Result(object):
     """Retrieved result from an experiment.
 
     A list of Result is returned by Experiment.retrieve_results. Result is a
     simple object with the following properties:
 
-    table: Retrieved results table. A numpy array.
+    table: Retrieved results table. A numpy array, a record array or a dict
+        of arrays, see Experiment.retrieve_results.
     table_columns: Names of the columns of table. A list.
     parameters: Parameters of this Result. A ParameterSet.
     """
@@ -148,6 +259,11 @@ class Experiment(object):
         self.experiment_index = 'experiment.index'
         self.measurement_file = 'measurement.${measurement_id}'
         self.measurement_index = 'measurement.index'
+        self.measurement_catalog = 'measurement.catalog'
+        self.measurement_store = 'measurement.store.npz'
+        self.measurement_result_cache = 'measurement.results'
+        self.load_workers = None
+        self.use_result_cache = False
 
         if config is None:
             config = load_config()
@@ -162,6 +278,13 @@ class Experiment(object):
         self.eindex = IndexFile(eindexfile, 'experiment', config=config)
         mindexfile = os.path.join(self.dir, self.measurement_index)
         self.mindex = IndexFile(mindexfile, 'measurement', config=config)
+        self._reserved_mids = deque()
+        catalogfile = os.path.join(self.dir, self.measurement_catalog)
+        self.catalog = MeasurementCatalog(catalogfile, config=config)
+        storefile = os.path.join(self.dir, self.measurement_store)
+        self.store = MeasurementStore(storefile, config=config)
+        cachedir = os.path.join(self.dir, self.measurement_result_cache)
+        self.result_cache = ResultCache(cachedir, config=config)
 
         # Retrieve files matching the experiment_file config variable.
         #
@@ -202,10 +325,15 @@ class Experiment(object):
 
     def _configure(self, config):
         props = ['experiment_index','measurement_index',
-                 'experiment_file','measurement_file']
+                 'experiment_file','measurement_file','measurement_catalog',
+                 'measurement_store','measurement_result_cache']
         for p in props:
             if config.has_key(p):
                 setattr(self, p, config[p])
+        if config.has_key('experiment_load_workers'):
+            self.load_workers = config['experiment_load_workers']
+        if config.has_key('experiment_result_cache'):
+            self.use_result_cache = config['experiment_result_cache']
 
     def save(self):
         o = OrderedDict()
@@ -313,8 +441,11 @@ class Experiment(object):
                                   'investigate by hand.')
 
         for m in self._file_measurements():
-            os.remove(m.archive.filename)
+            m.remove()
         self.mindex.remove()
+        self.catalog.remove()
+        self.store.remove()
+        self.result_cache.remove()
 
     def isactive(self):
         return self._measurements is None
@@ -331,12 +462,18 @@ class Experiment(object):
         if self.isactive():
             last_mid = self.mindex.get()
             self.mindex.create()
+            self._reserved_mids.clear()
             for mid,f in self._matching_measurement_files():
                 if mid < 1 or mid>last_mid:
                     continue
                 f = os.path.join(self.dir, f)
                 a = Archive(f,'measurement')
                 os.remove(a.filename)
+                NpySidecar(a.basename).remove()
+            if self.catalog.exists():
+                self.catalog.clear()
+            self.store.remove()
+            self.result_cache.remove()
         else:
             self._measurements = []
         self.save()
@@ -345,27 +482,66 @@ class Experiment(object):
         if not self.isactive():
             raise ExperimentError('Cannot create a new measurement for an '
                                   'inactive experiment.')
-        mid = self.mindex.increment()
+        if len(self._reserved_mids) > 0:
+            mid = self._reserved_mids.popleft()
+        else:
+            mid = self.mindex.increment()
         f = self._measurement_filename(mid)
         f = os.path.join(self.dir, f)
         if archive_exists(f):
             raise ExperimentError('Cannot create measurement with id {}: The '
                                   'measurement already exists.'.format(mid))
         m = FileMeasurement(f, mid, config=self.config)
+        m.catalog = self.catalog
         return m
 
-    def measurements(self):
+    def reserve_measurement_ids(self, n):
+        """Reserve `n` measurement ids at once.
+
+        Subsequent calls to `new_measurement` use the reserved ids before
+        incrementing the measurement index again. Ids that end up unused should
+        be given back with `release_measurement_ids`.
+        """
+        if not self.isactive():
+            return
+        self._reserved_mids.extend(self.mindex.reserve(n))
+
+    def release_measurement_ids(self):
+        """Give back all reserved but unused measurement ids."""
+        if len(self._reserved_mids) > 0:
+            self.mindex.release(list(self._reserved_mids))
+            self._reserved_mids.clear()
+
+    def measurements(self, paths=None):
+        """Iterate over all measurements.
+
+        If `paths` is given, measurement files are only partially loaded, such
+        that only these paths can be accessed.
+        """
         if self.isactive():
-            return self._file_measurements()
+            return self._file_measurements(paths)
         else:
             return self._memory_measurements()
 
-    def _file_measurements(self):
+    def consolidate(self, paths):
+        """Write the values at `paths` of all measurements into one file.
+
+        The consolidated store (by default "measurement.store.npz") holds one
+        array per path. `retrieve_results` uses it automatically whenever it
+        has all the paths of the table and parameter set definitions; only
+        measurements whose files changed since are then read from their
+        files. Call `consolidate` again to bring the store up to date.
+        """
+        if not self.isactive():
+            raise ExperimentError('Cannot consolidate an inactive experiment')
+        self.store.write(self._measurement_files(), paths)
+
+    def _file_measurements(self, paths=None):
         for mid in range(1,self.mindex.get()+1):
             f = self._measurement_filename(mid)
             f = os.path.join(self.dir, f)
             if archive_exists(f):
-                yield FileMeasurement(f, mid, config=self.config)
+                yield FileMeasurement(f, mid, config=self.config, paths=paths)
             else:
                 continue
 
@@ -381,7 +557,8 @@ class Experiment(object):
 
     def _number_of_file_measurements(self):
         fs = self._matching_measurement_files()
-        ls = [(1 if (mid!=0 and mid<=self.mindex.get()) else 0) for mid,f in fs]
+        last_mid = self.mindex.get()
+        ls = [(1 if (mid!=0 and mid<=last_mid) else 0) for mid,f in fs]
         return sum(ls)
 
     def _number_of_memory_measurements(self):
@@ -445,8 +622,12 @@ class Experiment(object):
         todo = [p for p in self.psets if p not in existing]
 
         self.start()
-        for p in todo:
-            self.run_measurement(function, ParameterSet(self.pset_definition, p))
+        self.reserve_measurement_ids(len(todo))
+        try:
+            for p in todo:
+                self.run_measurement(function, ParameterSet(self.pset_definition, p))
+        finally:
+            self.release_measurement_ids()
         self.end()
         self.save()
 
@@ -459,7 +640,10 @@ class Experiment(object):
         m.end()
         m.save(r)
 
-    def retrieve_results(self, table_definition, parameter_set_definition=()):
+    table_formats = ['array','records','columns']
+
+    def retrieve_results(self, table_definition, parameter_set_definition=(),
+                         workers=None, table_format='array'):
         """Retrieve results in table form, with one table per unique parameter set.
 
         table_definition defines the columns of the table. It is a list of
@@ -484,76 +668,124 @@ class Experiment(object):
         (corresponding to m['parameters/P'] and m['results/energy'] where m is
         a Measurement). If there were five different values for N, e.g.
         N=1,2,3,4,5, it would return a list of five such coma.Results.
+
+        If the experiment was consolidated (see `consolidate`) with all the
+        paths of both definitions, the values are read from the consolidated
+        store instead of the measurement files. With the
+        experiment_result_cache config option, the extracted rows are cached
+        (by default in "measurement.results"), so that repeated calls only
+        read measurements that are new or changed.
+
+        With `workers`, measurement files are loaded in parallel by that
+        many worker processes (see coma.util.map_in_pool). The default is the
+        experiment_load_workers config option. The results are the same as
+        when loading serially.
+
+        `table_format` chooses the type of coma.Result.table: 'array' (the
+        default) is a plain numpy array of all values, which becomes an array
+        of objects or strings if the columns have mixed types. 'records' is a
+        numpy record array with one field per column (named after
+        coma.Result.table_columns) and 'columns' is an OrderedDict of one
+        array per column. For the latter two, each column's dtype is inferred
+        from its values: bool, int64, float64 (for mixed ints and floats),
+        fixed-length strings, or object otherwise.
         """
+        if table_format not in self.table_formats:
+            raise ExperimentError('Unsupported table format: {}'
+                                  .format(table_format))
         tdef = OrderedDict(table_definition)
         pdef = OrderedDict(parameter_set_definition)
         
         ts = OrderedDict()
-        for m in self.measurements():
-            try:
-                p,t,c = [],[],[]
-                for name,path in pdef.iteritems():
-                    p.append(m[path])
-                p = self._tuplify(p)
-                for name,path in tdef.iteritems():
-                    v = m[path]
-                    if isinstance(v,list):
-                        ns,vs = self._flatten_list(name,v)
-                        t.extend(vs)
-                        c.extend(ns)
-                    else:
-                        t.append(v)
-                        c.append(name)
-                c = tuple(c)
-                if not ts.has_key(p):
-                    ts[p] = (c,[],[])
-                if ts[p][0] != c:
-                    raise ExperimentError('Different number of columns in results '
-                                          'table for the same set of parameters')
-                ts[p][1].append(t)
-                ts[p][2].append(m.id)
-            except KeyError:
-                pass
+        if workers is None:
+            workers = self.load_workers
+        for mid,row in self._result_rows(tdef, pdef, workers):
+            if row is None:
+                continue
+            p,t,c = row
+            if not ts.has_key(p):
+                ts[p] = (c,[],[])
+            if ts[p][0] != c:
+                raise ExperimentError('Different number of columns in results '
+                                      'table for the same set of parameters')
+            ts[p][1].append(t)
+            ts[p][2].append(mid)
 
         rs = ResultList()
         for p,(c,t,ids) in ts.iteritems():
             r = Result()
             r.parameters = ParameterSet(pdef,p)
-            r.table = np.array(t)
+            if table_format == 'array':
+                r.table = np.array(t)
+            else:
+                r.table = _typed_table(t, c, table_format)
             r.table_definition = tdef
             r.table_columns = c
             r.measurement_ids = ids
             rs.append(r)
         return rs
 
+    def _result_rows(self, tdef, pdef, workers=None):
+        """Return (measurement id, row) for all measurements, ordered by id.
+
+        For active experiments with the result cache enabled, rows are cached
+        and only extracted from measurements that are new or changed since the
+        last call.
+        """
+        paths = pdef.values() + tdef.values()
+        if not self.isactive():
+            return [(m.id, _result_row(m, tdef, pdef))
+                    for m in self.measurements(paths)]
+
+        key = (tdef.items(), pdef.items())
+        rows = {}
+        if self.use_result_cache:
+            rows = self.result_cache.load(key)
+        stats = OrderedDict()
+        stale = []
+        for mid,f in sorted(self._measurement_files()):
+            st = os.stat(f)
+            stats[mid] = (os.path.basename(f), st.st_mtime, st.st_size)
+            if not rows.has_key(mid) or rows[mid][0] != stats[mid]:
+                stale.append((mid,f))
+        if self.store.covers(paths):
+            for m in self.store.measurements(stale, paths):
+                rows[m.id] = (stats[m.id], _result_row(m, tdef, pdef))
+        else:
+            args = [(mid,f,self.config,tdef,pdef) for mid,f in stale]
+            rs = map_in_pool(_load_result_row, args, workers)
+            for (mid,f),r in zip(stale, rs):
+                rows[mid] = (stats[mid], r)
+        removed = [mid for mid in rows.keys() if not stats.has_key(mid)]
+        for mid in removed:
+            del rows[mid]
+        if self.use_result_cache and (len(stale) > 0 or len(removed) > 0):
+            try:
+                self.result_cache.save(key, rows)
+            except (IOError, OSError):
+                # E.g. a read-only experiment directory; the cache is only an
+                # optimization
+                pass
+        return [(mid, rows[mid][1]) for mid in stats.keys()]
+
     def _tuplify(self, l):
         """Recursively converts all lists in l into tuples."""
-        if isinstance(l,list):
-            vs = []
-            for v in l:
-                vs.append(self._tuplify(v))
-            return tuple(vs)
-        else:
-            return l
+        return _tuplify(l)
 
     def _flatten_list(self, n, l):
         """Flattens the list, returning a list of names and a list of values."""
-        ns = []
-        vs = []
-        for i,v in enumerate(l):
-            nn = n + '_' + str(i+1)
-            if isinstance(v,list):
-                ns_,vs_ = self._flatten_list(nn,v)
-                ns.extend(ns_)
-                vs.extend(vs_)
-            else:
-                ns.append(nn)
-                vs.append(v)
-        return ns,vs
+        return _flatten_list(n, l)
 
-    def _get_existing_psets(self):
+    def _get_existing_psets(self, workers=None):
+        if workers is None:
+            workers = self.load_workers
+        if self.isactive():
+            # Query the catalog instead of loading all measurements
+            self.catalog.sync(self._measurement_files(), workers)
+            vs = self.catalog.values(self.pset_definition.values(), workers)
+            return [v for mid,v in vs]
         ps = []
-        for m in self.measurements():
+        for m in self.measurements(self.pset_definition.values()):
             try:
                 p = []
                 for name,path in self.pset_definition.iteritems():
@@ -587,11 +819,29 @@ class Experiment(object):
     def _matching_measurement_files(self):
         return self._matching_files(self.measurement_file, 'measurement_id')
 
-    def _matching_files(self, pattern, sub):
+    def _measurement_files(self):
+        """Return (id, filename) of all existing measurements.
+
+        If a measurement exists in several formats (e.g. after
+        convert_archive), the file whose format comes first in
+        Archive.formats is used.
+        """
+        last_mid = self.mindex.get()
+        fs = self._matching_files(self.measurement_file, 'measurement_id',
+                                  full_names=True)
+        files = {}
+        for mid,f in fs:
+            if mid < 1 or mid > last_mid:
+                continue
+            if not files.has_key(mid) or _format_rank(f) < _format_rank(files[mid]):
+                files[mid] = f
+        return [(mid,os.path.join(self.dir, f)) for mid,f in sorted(files.items())]
+
+    def _matching_files(self, pattern, sub, full_names=False):
         # Build a regular expression from pattern
         s = pattern
         s = s.replace('.','\.').replace('/','\/')
-        fs = '|'.join(Archive.formats) # string 'json|xml', or similar
+        fs = '|'.join(re.escape(f) for f in Archive.formats) # 'json|xml|json\.gz', or similar
         s = '^(' +  Template(s).substitute({sub: '(\d+|none)'}) + ')\.(?:' + fs + ')$'
         e = re.compile(s)
 
@@ -601,10 +851,11 @@ class Experiment(object):
         for f in fs:
             m  = e.match(f)
             if m is not None:
+                n = m.group(0) if full_names else m.group(1)
                 if len(m.groups()) == 2 and m.group(2) != 'none':
-                    rs.append((int(m.group(2)),m.group(1)))
+                    rs.append((int(m.group(2)),n))
                 else:
-                    rs.append((0,m.group(1)))
+                    rs.append((0,n))
         return rs
 
     def __str__(self):
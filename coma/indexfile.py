@@ -2,11 +2,39 @@
 # This code is distributed under the two-clause BSD License.
 
 import os
+import errno
+import socket
+import time
+import random
+import uuid
 from .serialization import Archive, archive_exists
 
 class IndexFile(object):
+    """An index file holding the last used experiment or measurement id.
+
+    Updates are protected by a lock file, "<index file>.lock", which records
+    the host, process id and time of its owner and a token that is unique to
+    each lock. If the index is locked, `lock` waits, with exponential backoff,
+    for up to `lock_timeout` seconds (config option "index_lock_timeout")
+    before giving up with an IOError. Locks of processes on this host that no
+    longer exist, and locks of other hosts that are older than `lock_expiry`
+    seconds ("index_lock_expiry"), are considered stale and are broken. Locks
+    of live processes on this host are never broken. `unlock` only removes
+    the lock if it still is ours. The time spent waiting is recorded in
+    `lock_stats`.
+    """
     def __init__(self, filename, indextype, config=None):
         self.filename = filename
+        self.lock_timeout = 60
+        self.lock_expiry = 300
+        if config is not None:
+            if config.has_key('index_lock_timeout'):
+                self.lock_timeout = config['index_lock_timeout']
+            if config.has_key('index_lock_expiry'):
+                self.lock_expiry = config['index_lock_expiry']
+        self.lock_stats = {'locks': 0, 'contended': 0, 'broken': 0,
+                           'wait_time': 0.0}
+        self._token = None
         self.element = ''
         archive_name = ''
         if indextype == 'experiment':
@@ -28,28 +56,71 @@ class IndexFile(object):
             return
         o = {self.element: i}
         self.lock()
-        self.archive.save(o)
-        self.unlock()
+        try:
+            self.archive.save(o)
+        finally:
+            self.unlock()
 
     def increment(self):
         if not self.exists():
             return 0
         self.lock()
-        o = self.archive.load()
-        o[self.element] += 1
-        lastid = o[self.element]
-        self.archive.save(o)
-        self.unlock()
+        try:
+            o = self.archive.load()
+            o[self.element] += 1
+            lastid = o[self.element]
+            self.archive.save(o)
+        finally:
+            self.unlock()
         return lastid
 
+    def reserve(self, n):
+        """Reserve a contiguous block of `n` ids in a single locked update.
+
+        Returns the list of reserved ids.
+        """
+        if not self.exists() or n < 1:
+            return []
+        self.lock()
+        try:
+            o = self.archive.load()
+            first = o[self.element] + 1
+            o[self.element] += n
+            self.archive.save(o)
+        finally:
+            self.unlock()
+        return range(first, first+n)
+
+    def release(self, ids):
+        """Give back unused ids from the end of a reserved block.
+
+        `ids` is a contiguous, ascending list of ids. They are only returned to
+        the index if no ids were handed out after them, otherwise they are
+        simply left unused. Returns True if the ids were returned.
+        """
+        if not self.exists() or len(ids) == 0:
+            return False
+        self.lock()
+        try:
+            o = self.archive.load()
+            if o[self.element] != ids[-1]:
+                return False
+            o[self.element] = ids[0] - 1
+            self.archive.save(o)
+            return True
+        finally:
+            self.unlock()
+
     def exists(self):
         return archive_exists(self.filename)
 
     def create(self):
         o = {self.element: 0}
         self.lock()
-        self.archive.save(o)
-        self.unlock()
+        try:
+            self.archive.save(o)
+        finally:
+            self.unlock()
 
     def remove(self):
         if self.exists():
@@ -57,10 +128,99 @@ class IndexFile(object):
 
     def lock(self):
         lockfile = self.archive.filename + '.lock'
-        if os.path.exists(lockfile):
-            raise IOError('File "{}" is locked'.format(self.archive.filename))
-        open(lockfile,'a').close()
+        token = uuid.uuid4().hex
+        owner = '{} {} {!r} {}\n'.format(socket.gethostname(), os.getpid(),
+                                        time.time(), token)
+        start = time.time()
+        delay = 0.001
+        contended = False
+        while True:
+            try:
+                fd = os.open(lockfile, os.O_CREAT|os.O_EXCL|os.O_WRONLY, 0644)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            else:
+                os.write(fd, owner)
+                os.close(fd)
+                self._token = token
+                break
+            contended = True
+            if self._break_stale_lock(lockfile):
+                continue
+            waited = time.time() - start
+            if waited >= self.lock_timeout:
+                self.lock_stats['wait_time'] += waited
+                self.lock_stats['contended'] += 1
+                raise IOError('File "{}" is locked by {}'.format(
+                    self.archive.filename, self._lock_owner(lockfile)))
+            time.sleep(delay * random.uniform(0.5, 1.5))
+            delay = min(2*delay, 0.5)
+        self.lock_stats['locks'] += 1
+        if contended:
+            self.lock_stats['contended'] += 1
+            self.lock_stats['wait_time'] += time.time() - start
 
     def unlock(self):
         lockfile = self.archive.filename + '.lock'
-        os.remove(lockfile)
+        token,self._token = self._token,None
+        owner = self._lock_owner(lockfile)
+        # If our lock was broken, the lock file belongs to someone else now
+        if owner is not None and owner[3] == token:
+            os.remove(lockfile)
+
+    def _lock_owner(self, lockfile):
+        # Returns (host, pid, time, token)
+        try:
+            with open(lockfile) as f:
+                host,pid,t,token = f.read().split()
+            return (host,int(pid),float(t),token)
+        except (IOError,ValueError):
+            return None
+
+    def _break_stale_lock(self, lockfile):
+        try:
+            st = os.stat(lockfile)
+        except OSError:
+            # Lock is gone already
+            return True
+        owner = self._lock_owner(lockfile)
+        if owner is not None and owner[0] == socket.gethostname():
+            # Whether the owner is alive is known for sure; its age is
+            # irrelevant
+            try:
+                os.kill(owner[1], 0)
+                return False
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    return False
+        elif time.time() - st.st_mtime <= self.lock_expiry:
+            return False
+        # Only one process at a time may break locks. Fresh locks can only be
+        # created once the stale one is gone, so as long as the lock file is
+        # still the stale one, it is safe to remove.
+        breakfile = lockfile + '.break'
+        try:
+            fd = os.open(breakfile, os.O_CREAT|os.O_EXCL|os.O_WRONLY, 0644)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            # A process that died while breaking the lock leaves this behind
+            try:
+                if time.time() - os.path.getmtime(breakfile) > self.lock_expiry:
+                    os.remove(breakfile)
+            except OSError:
+                pass
+            return False
+        os.close(fd)
+        try:
+            s = os.stat(lockfile)
+            if ((s.st_ino,s.st_mtime) == (st.st_ino,st.st_mtime)
+                    and self._lock_owner(lockfile) == owner):
+                os.remove(lockfile)
+                self.lock_stats['broken'] += 1
+        except OSError:
+            pass
+        finally:
+            os.remove(breakfile)
+        return True
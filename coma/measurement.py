@@ -2,7 +2,8 @@
 # This code is distributed under the two-clause BSD License.
 
 from collections import OrderedDict
-from .serialization import Archive, RecursiveSerializer, archive_exists
+import os
+from .serialization import Archive, NpySidecar
 from .path import access_data_by_path
 from .util import current_date_as_string
 
@@ -76,14 +77,79 @@ class MemoryMeasurement(Measurement):
         self.start_date = self.data['info']['start_date']
         self.end_date = self.data['info']['end_date']
 
+def _loaded_property(name):
+    # A FileMeasurement property that loads the measurement file on first
+    # access
+    attr = '_' + name
+    def get(self):
+        if not self._loaded:
+            self.load()
+        return getattr(self, attr)
+    def set(self, v):
+        setattr(self, attr, v)
+    return property(get, set)
+
 class FileMeasurement(Measurement):
-    def __init__(self, filename, id=None, config=None):
+    """A measurement stored in a file.
+
+    The file is only parsed when the measurement's data is first accessed.
+    Use `load_info` to cheaply read just the measurement's info.
+
+    If `paths` is given, only the parts of the file that are needed to access
+    these paths (and the info) are loaded. Such a partially loaded measurement
+    can't be saved again, unless new data is assigned.
+    """
+    start_date = _loaded_property('start_date')
+    end_date = _loaded_property('end_date')
+
+    def __init__(self, filename, id=None, config=None, paths=None):
+        self._loaded = True
+        self._partial = False
         Measurement.__init__(self)
         self.id = id
         self.config = config
+        self.paths = paths
+        # If set, the MeasurementCatalog is updated on every save
+        self.catalog = None
         self.archive = Archive(filename, 'measurement', config=config)
-        if archive_exists(filename):
+        # Large numpy arrays are stored in separate .npy files (if
+        # configured) and are always loaded memory-mapped
+        self.sidecar = NpySidecar(self.archive.basename, config=config)
+        self.archive.serializer.sidecar = self.sidecar
+        if os.path.exists(self.archive.filename):
+            self._loaded = False
+
+    @property
+    def id(self):
+        if self._id is None and not self._loaded:
             self.load()
+        return self._id
+
+    @id.setter
+    def id(self, i):
+        self._id = i
+
+    @property
+    def data(self):
+        if not self._loaded:
+            self.load()
+        return self._data
+
+    @data.setter
+    def data(self, o):
+        self._loaded = True
+        self._partial = False
+        Measurement.data.fset(self, o)
+
+    def load_info(self):
+        """Return the measurement's info.
+
+        If the measurement is not loaded yet, only the info is read from the
+        file, if the archive format allows it.
+        """
+        if self._loaded:
+            return self.data['info']
+        return self.archive.load_entry('info')
 
     def start(self):
         self.start_date = current_date_as_string()
@@ -92,25 +158,64 @@ class FileMeasurement(Measurement):
         self.end_date = current_date_as_string()
 
     def save(self, m=None):
-        if m is not None:
-            a = RecursiveSerializer(config=self.config)
-            o = a.serialize(m)
-            i = OrderedDict()
-            if hasattr(m, 'program'):
-                i['program'] = m.program
-            if hasattr(m, 'version'):
-                i['version'] = m.version
-            if not o.has_key('info'):
-                o = OrderedDict([('info', i)] + o.items())
-            else:
-                i.update(o['info'])
-                o['info'] = i
-            self.data = o
-        self.archive.save(self.data)
+        """Save the measurement.
+
+        If `m` is given, it is saved as the measurement's data. Only the top
+        level of `m` is serialized up front; the archive serializes everything
+        below (using coma_getstate and storing arrays as it sees fit) while
+        writing, so that no complete copy of `m` is made. The saved data is
+        then only loaded again from the file when it is accessed.
+        """
+        self.sidecar.begin()
+        if m is None:
+            if self._partial:
+                raise ValueError('Cannot save measurement {}, it was only '
+                                 'partially loaded'.format(self.id))
+            self.archive.save(self.data)
+            self.sidecar.end()
+            if self.catalog is not None:
+                self.catalog.update(self)
+            return
+
+        if isinstance(m, dict):
+            o = OrderedDict(m.iteritems())
+        else:
+            o = self.archive.serializer.serialize(m)
+        i = OrderedDict()
+        if hasattr(m, 'program'):
+            i['program'] = m.program
+        if hasattr(m, 'version'):
+            i['version'] = m.version
+        if not o.has_key('info'):
+            o = OrderedDict([('info', i)] + o.items())
+        else:
+            i.update(o['info'])
+            o['info'] = i
+        Measurement.data.fset(self, o)
+        # Only drop the data once it is safely in the file
+        self.archive.save(self._data)
+        self.sidecar.end()
+        self._data = OrderedDict()
+        self._loaded = False
+        self._partial = False
+        if self.catalog is not None:
+            self.catalog.update(FileMeasurement(self.archive.filename, self.id,
+                                                config=self.config,
+                                                paths=self.catalog.paths()))
 
     def load(self):
-        self.data = self.archive.load()
+        if self.paths is None:
+            self.data = self.archive.load()
+        else:
+            self.data = self.archive.load(list(self.paths) + ['info'])
+            self._partial = True
         i = self.data['info']
         self.id = i['measurement_id']
         self.start_date = i['start_date']
         self.end_date = i['end_date']
+
+    def remove(self):
+        """Delete the measurement file and its .npy sidecar files."""
+        if os.path.exists(self.archive.filename):
+            os.remove(self.archive.filename)
+        self.sidecar.remove()
@@ -1,5 +1,6 @@
 from IPython.parallel import Client
 import traceback
+import time
 from .experiment import Experiment, ParameterSet
 
 class ParallelExperiment(Experiment):
@@ -21,7 +22,8 @@ class ParallelExperiment(Experiment):
             del kwargs['profile']
 
         Experiment.__init__(self, *args, **kwargs)
-        self.tasks = []
+        self.tasks = {}
+        self.poll_interval = 0.01
         self.pclient = Client(profile=profile)
         self.pview = self.pclient.load_balanced_view()
 
@@ -30,13 +32,16 @@ class ParallelExperiment(Experiment):
         todo = [p for p in self.psets if p not in existing]
 
         self.start()
-        for p in todo:
-            self.run_measurement(function, ParameterSet(self.pset_definition, p))
-        
-        while self.pview.wait(timeout=1) == False:
-            self.save_measurements()
-        self.pview.wait()
-        self.save_measurements()
+        self.reserve_measurement_ids(len(todo))
+        try:
+            for p in todo:
+                self.run_measurement(function, ParameterSet(self.pset_definition, p))
+        finally:
+            self.release_measurement_ids()
+
+        while len(self.tasks) > 0:
+            if not self.save_measurements():
+                time.sleep(self.poll_interval)
         
         self.end()
         self.save()
@@ -51,26 +56,39 @@ class ParallelExperiment(Experiment):
         m = self.new_measurement()
         m.start()
         ar = self.pview.apply(function, parameter_set)
-        self.tasks.append((m,ar,False))
+        self.tasks[ar.msg_ids[0]] = (m,ar)
         
     def save_measurements(self):
-        for i,(m,ar,done) in enumerate(self.tasks):
-            if (not ar.ready()) or done:
-                continue
-            if not ar.successful():
-                print('Measurement {} was not successful.'.format(m.id))
-                print('-'*60)
-                try:
-                    ar.get()
-                except:
-                    traceback.print_exc()
-                print('-'*60)
-                print('\n')
-                self.tasks[i] = (m,ar,True)
-                continue
-            r = ar.get()
-            m.end()
-            m.save(r)
-            # set done to True
-            self.tasks[i] = (m,ar,True)
-            # print('Saved measurement {}.'.format(m.id))
+        """Save all measurements whose results have arrived.
+
+        The client's results dict only holds results that have not been
+        collected yet, so it serves as a ready queue: the cost of each call
+        does not depend on the number of pending tasks. Saved tasks are
+        dropped. Returns the number of saved measurements.
+        """
+        self.pclient.spin()
+        ready = [i for i in self.pclient.results.keys() if i in self.tasks]
+        for i in ready:
+            m,ar = self.tasks.pop(i)
+            self.save_measurement(m, ar)
+            # The results are not owned by the AsyncResult and would otherwise
+            # stay in the client forever
+            self.pclient.results.pop(i, None)
+            self.pclient.metadata.pop(i, None)
+        return len(ready)
+
+    def save_measurement(self, m, ar):
+        if not ar.successful():
+            print('Measurement {} was not successful.'.format(m.id))
+            print('-'*60)
+            try:
+                ar.get()
+            except:
+                traceback.print_exc()
+            print('-'*60)
+            print('\n')
+            return
+        r = ar.get()
+        m.end()
+        m.save(r)
+        # print('Saved measurement {}.'.format(m.id))
@@ -63,3 +63,56 @@ def _get(o, segments):
             return (INVALID_VALUE,False)
     else:
         return (INVALID_VALUE,False)
+
+def path_tree(paths):
+    """Merge paths into a tree of path segments.
+
+    The tree is a nested dictionary keyed by path segment (as strings), where
+    True stands for a whole subtree. It describes which parts of a data tree
+    are needed to access all of `paths`. See path_subtree.
+    """
+    tree = {}
+    for path in paths:
+        segments = _parse_path(path)
+        segments.reverse()
+        if segments[-1] == '':
+            segments.pop()
+        if len(segments) == 0:
+            return True
+        t = tree
+        for s in segments[:-1]:
+            s = _key(s)
+            if t.get(s) is True:
+                break
+            t = t.setdefault(s, {})
+        else:
+            t[_key(segments[-1])] = True
+    return tree
+
+def path_subtree(tree, key):
+    """Return the tree for the child `key`, or None if it is not needed."""
+    if tree is True:
+        return True
+    key = _key(key)
+    ts = [tree[k] for k in set([key,'*']) if tree.has_key(k)]
+    if len(ts) == 0:
+        return None
+    if len(ts) == 1:
+        return ts[0]
+    return _merge_path_trees(ts[0], ts[1])
+
+def _merge_path_trees(t1, t2):
+    if t1 is True or t2 is True:
+        return True
+    t = dict(t1)
+    for k,v in t2.iteritems():
+        if t.has_key(k):
+            t[k] = _merge_path_trees(t[k], v)
+        else:
+            t[k] = v
+    return t
+
+def _key(s):
+    if isinstance(s, basestring):
+        return s
+    return str(s)
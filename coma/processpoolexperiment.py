@@ -0,0 +1,82 @@
+# Copyright (c) 2014, Burkhard Ritter
+# This code is distributed under the two-clause BSD License.
+
+import multiprocessing
+import traceback
+from .experiment import Experiment, ParameterSet
+
+def _run_function(args):
+    # Runs in the worker process. Exceptions are returned as a formatted
+    # traceback, because not all exceptions can be pickled.
+    i,function,parameter_set = args
+    try:
+        return (i,True,function(parameter_set))
+    except Exception:
+        return (i,False,traceback.format_exc())
+
+class ProcessPoolExperiment(Experiment):
+    """An experiment that runs measurements in parallel on the local machine.
+
+    Defined parameter sets---measurements---are run in parallel in a
+    multiprocessing pool of worker processes. Each measurement is saved as
+    soon as it is completed. Both the function passed to `run` and its results
+    must be picklable; in particular, the function must be defined at the top
+    level of a module.
+    """
+    def __init__(self, *args, **kwargs):
+        """Load or create an experiment.
+
+        In addition to the Experiment's constructor's arguments, supports the
+        keyword argument `processes` to specify the number of worker
+        processes. The default is the number of CPUs.
+        """
+        processes = None
+        if kwargs.has_key('processes'):
+            processes = kwargs['processes']
+            del kwargs['processes']
+
+        Experiment.__init__(self, *args, **kwargs)
+        self.processes = processes
+
+    def run(self, function=None):
+        existing = self._get_existing_psets()
+        todo = [p for p in self.psets if p not in existing]
+
+        self.start()
+        ms = []
+        tasks = []
+        self.reserve_measurement_ids(len(todo))
+        try:
+            for i,p in enumerate(todo):
+                m = self.new_measurement()
+                m.start()
+                ms.append(m)
+                tasks.append((i,function,ParameterSet(self.pset_definition, p)))
+        finally:
+            self.release_measurement_ids()
+
+        if len(tasks) > 0:
+            pool = multiprocessing.Pool(self.processes)
+            try:
+                for i,successful,r in pool.imap_unordered(_run_function, tasks):
+                    self.save_measurement(ms[i], successful, r)
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+
+        self.end()
+        self.save()
+
+        return (len(todo),len(self.psets))
+
+    def save_measurement(self, m, successful, r):
+        if not successful:
+            print('Measurement {} was not successful.'.format(m.id))
+            print('-'*60)
+            print(r)
+            print('-'*60)
+            print('\n')
+            return
+        m.end()
+        m.save(r)
@@ -0,0 +1,73 @@
+# Copyright (c) 2014, Burkhard Ritter
+# This code is distributed under the two-clause BSD License.
+
+import os
+import shutil
+import hashlib
+from .serialization import JsonArchive
+
+def _tuplify(l):
+    if isinstance(l, list):
+        return tuple(_tuplify(v) for v in l)
+    return l
+
+class ResultCache(object):
+    """A persistent cache of the rows extracted by Experiment.retrieve_results.
+
+    The cache is a directory, by default "measurement.results" in the
+    experiment directory, with one JSON file per combination of table and
+    parameter set definition, named after a hash of the definitions. A file
+    maps each measurement id to the measurement file's name, modification
+    time and size, and to the row that was extracted from it (None if the
+    measurement lacks some of the paths).
+
+    The cache is only used with the experiment_result_cache config option. A
+    cache file that can't be read or decoded is treated as empty.
+    """
+    def __init__(self, dir, config=None):
+        self.dir = dir
+        self.archive = JsonArchive(None, pretty_print=False, config=config)
+
+    def filename(self, key):
+        h = hashlib.sha1(repr(key)).hexdigest()
+        return os.path.join(self.dir, h + '.json')
+
+    def load(self, key):
+        """Return the cached rows for `key`, an empty dict if there are none."""
+        f = self.filename(key)
+        if not os.path.exists(f):
+            return {}
+        try:
+            with open(f) as fp:
+                o = self.archive.load(fp)
+            # Guard against hash collisions
+            if o['key'] != self.archive.loads(self.archive.dumps(key)):
+                return {}
+            rows = {}
+            for mid,stat,row in o['rows']:
+                if row is not None:
+                    p,t,c = row
+                    row = (_tuplify(p), t, tuple(c))
+                rows[mid] = (tuple(stat), row)
+            return rows
+        except Exception:
+            return {}
+
+    def save(self, key, rows):
+        if not os.path.exists(self.dir):
+            os.mkdir(self.dir)
+        f = self.filename(key)
+        tmp = f + '.tmp'
+        o = {'key': key,
+             'rows': [(mid,stat,row) for mid,(stat,row) in rows.iteritems()]}
+        try:
+            with open(tmp, 'w') as fp:
+                self.archive.dump(o, fp)
+            os.rename(tmp, f)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def remove(self):
+        if os.path.exists(self.dir):
+            shutil.rmtree(self.dir)
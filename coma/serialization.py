@@ -3,34 +3,150 @@
 
 from collections import OrderedDict
 import xml.etree.ElementTree as ET
-from xml.dom import minidom
+try:
+    import xml.etree.cElementTree as cET
+except ImportError:
+    cET = ET
 import json
 import re
 from importlib import import_module
 import math
+import datetime
 import os
+import inspect
+import base64
+import mmap
+import gzip
+import bz2
+import struct
+import io
+from StringIO import StringIO
 import numpy
+from .path import access_data_by_path, path_tree, path_subtree, _parse_path
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
 
 class Serializer(object):
     # TODO: '__class__' is part of the serialization / de-serialization
     # protocol, just as 'coma_getstate' and 'coma_setstate' and should
     # probably be configurable as well
+    ndarray_encodings = ['list','base64']
+
     def __init__(self, restore_objects=False, getstate='coma_getstate', 
-                 setstate='coma_setstate', config=None):
+                 setstate='coma_setstate', ndarray_encoding=None, config=None):
         self.restore_objects = restore_objects
         self.getstate = getstate
         self.setstate = setstate
+        self.ndarray_encoding = 'list'
+        # If True, RecursiveSerializer stores homogeneous lists column-wise
+        self.columns = False
+        # If True, RecursiveSerializer stores shared objects only once
+        self.references = False
+        # Restored shared objects, by "__id__"
+        self.shared = {}
+        # Set if a "__ref__" was restored before its "__id__", e.g. because
+        # the shared object is outside of the paths that were loaded
+        self.unresolved = False
+        # True during partial loads, in which shared objects may be
+        # incomplete, so that no reference is resolved
+        self.partial = False
+        self.sidecar = None
         if config is not None:
             if config.has_key('serializer_getstate'):
                 self.getstate = config['serializer_getstate']
             if config.has_key('serializer_setstate'):
                 self.setstate = config['serializer_setstate']
+            if config.has_key('serializer_ndarray_encoding'):
+                e = config['serializer_ndarray_encoding']
+                if e in self.ndarray_encodings:
+                    self.ndarray_encoding = e
+            if config.has_key('serializer_columns'):
+                self.columns = config['serializer_columns']
+            if config.has_key('serializer_references'):
+                self.references = config['serializer_references']
+        if ndarray_encoding is not None:
+            if ndarray_encoding not in self.ndarray_encodings:
+                raise ValueError('Unsupported ndarray encoding: {}'
+                                 .format(ndarray_encoding))
+            self.ndarray_encoding = ndarray_encoding
+
+    # Registry of encoders and decoders for types that don't implement the
+    # getstate / setstate protocol, see `register_type`
+    _encoders = {}
+    _decoders = {}
+    _encoder_cache = {}
+    # Cache of restored classes, by "__class__" string
+    _classes = {}
+
+    @classmethod
+    def register_type(cls, type_, name, encode, decode):
+        """Register an encoder and a decoder for objects of type `type_`.
+
+        `encode(serializer, o)` returns a dict of the object's state and
+        `decode(serializer, d)` restores the object from that dict. The
+        serialized dict is tagged with `"__type__": name`. Encoders apply to
+        subclasses of `type_` as well, unless a more specific type is
+        registered.
+        """
+        cls._encoders[type_] = (name, encode)
+        cls._decoders[name] = decode
+        cls._encoder_cache.clear()
+
+    @classmethod
+    def unregister_type(cls, type_):
+        name,_ = cls._encoders.pop(type_)
+        del cls._decoders[name]
+        cls._encoder_cache.clear()
+
+    def _encoder(self, t):
+        try:
+            return self._encoder_cache[t]
+        except KeyError:
+            pass
+        e = None
+        for b in inspect.getmro(t):
+            if b in self._encoders:
+                e = self._encoders[b]
+                break
+        self._encoder_cache[t] = e
+        return e
+
+    def _resolve_class(self, name):
+        try:
+            return self._classes[name]
+        except KeyError:
+            pass
+        # I believe that __module__ can never be empty, so __class__
+        # should always be of the form some_module.class
+        ms,_,cs = name.rpartition('.')
+        c = getattr(import_module(ms), cs)
+        self._classes[name] = c
+        return c
 
     def serialize(self, o):
-        # Special case for numpy array. In principle this could be a more
-        # general, extensible system to allow serialization of arbitrary types.
-        if isinstance(o, numpy.ndarray):
-            return self.serialize_numpy_ndarray(o)
+        e = self._encoder(type(o))
+        if e is not None:
+            name,encode = e
+            d = encode(self, o)
+            if '__type__' not in d:
+                d = OrderedDict([('__type__', name)] + d.items())
+            return d
         if not hasattr(o, self.getstate):
             raise AttributeError('Can\'t serialize ' + repr(o))
         f = getattr(o, self.getstate)
@@ -38,20 +154,37 @@ class Serializer(object):
         d['__class__'] = o.__class__.__module__ + '.' + o.__class__.__name__
         return d
 
+    def reset(self):
+        """Forget the shared objects restored so far.
+
+        Archives call this before every load, so that references never
+        resolve to objects of an earlier load.
+        """
+        self.shared = {}
+        self.unresolved = False
+        self.partial = False
+
     def restore(self, o):
-        if isinstance(o, dict) and '__type__' in o:
-            if o['__type__'] == 'numpy.ndarray':
-                return self.restore_numpy_ndarray(o)
+        if isinstance(o, dict):
+            if self.references:
+                if '__id__' in o:
+                    return self.restore_shared(o)
+                if '__ref__' in o and len(o) == 1:
+                    if not self.partial and o['__ref__'] in self.shared:
+                        return self.shared[o['__ref__']]
+                    # The reference stays as it is; see Archive.load
+                    self.unresolved = True
+                    return o
+            if '__type__' in o:
+                decode = self._decoders.get(o['__type__'])
+                if decode is not None:
+                    return decode(self, o)
         if not self.restore_objects:
             return o
         if not isinstance(o, dict) or not '__class__' in o:
             return o
 
-        # I believe that __module__ can never be empty, so __class__
-        # should always be of the form some_module.class
-        ms,_,cs= o['__class__'].rpartition('.')
-        m = import_module(ms)
-        c = getattr(m,cs)
+        c = self._resolve_class(o['__class__'])
         
         if not hasattr(c, self.setstate):
             raise AttributeError('Can\'t restore object ' + repr(o))
@@ -62,52 +195,378 @@ class Serializer(object):
         f(i,o)
         return i
 
+    def restore_shared(self, d):
+        """Restore an object that RecursiveSerializer marked as shared.
+
+        The object is remembered, so that later references to it (see
+        `restore`) resolve to the very same object.
+        """
+        n = d.pop('__id__')
+        if d.keys() == ['__value__']:
+            o = d['__value__']
+        else:
+            o = self.restore(d)
+        self.shared[n] = o
+        return o
+
+    def restore_columns(self, d):
+        """Restore a list that RecursiveSerializer stored column-wise."""
+        n = d['count']
+        cs = d['columns']
+        c = d.get('class')
+        ks = cs.keys()
+        for k in ks:
+            if len(cs[k]) != n:
+                raise ValueError('Column "{}" has {} instead of {} items'
+                                 .format(k, len(cs[k]), n))
+        l = []
+        for i in xrange(n):
+            o = OrderedDict([(k,cs[k][i]) for k in ks])
+            if c is not None:
+                o['__class__'] = c
+            l.append(self.restore(o))
+        return l
+
     def serialize_numpy_ndarray(self, o):
+        if self.sidecar is not None and self.sidecar.accepts(o):
+            return self.sidecar.save(o)
+        # Arrays of Python objects do not have a meaningful raw buffer, so
+        # they always use the list encoding.
+        if self.ndarray_encoding == 'base64' and not o.dtype.hasobject:
+            return self.serialize_numpy_ndarray_base64(o)
         d = OrderedDict()
         d['__type__'] = 'numpy.ndarray'
         d['shape'] = o.shape
         d['list'] = o.flatten().tolist()
         return d
 
+    def serialize_numpy_ndarray_base64(self, o):
+        """Encode the array's raw buffer, its dtype and its shape.
+
+        The dtype string includes the byte order (e.g. '<f8'), so the buffer
+        can be restored on any machine. The buffer is always in C order.
+        """
+        d = OrderedDict()
+        d['__type__'] = 'numpy.ndarray'
+        d['shape'] = o.shape
+        d['dtype'] = o.dtype.str
+        d['encoding'] = 'base64'
+        d['data'] = base64.b64encode(o.tobytes(order='C'))
+        return d
+
     def restore_numpy_ndarray(self, d):
+        if d.has_key('encoding'):
+            if d['encoding'] == 'npy':
+                if self.sidecar is None:
+                    raise ValueError('Array is stored in a separate file "{}", '
+                                     'but no sidecar is configured'
+                                     .format(d['file']))
+                return self.sidecar.load(d)
+            if d['encoding'] != 'base64':
+                raise ValueError('Unsupported ndarray encoding: {}'
+                                 .format(d['encoding']))
+            return self.restore_numpy_ndarray_base64(d)
         o = numpy.array(d['list'])
         o.shape = d['shape']
         return o
 
+    def restore_numpy_ndarray_base64(self, d):
+        # bytearray makes the array writable without an additional copy
+        b = bytearray(base64.b64decode(d['data']))
+        o = numpy.frombuffer(b, dtype=numpy.dtype(str(d['dtype'])))
+        o.shape = d['shape']
+        return o
+
+def _serialize_complex(serializer, o):
+    return OrderedDict([('real', o.real), ('imag', o.imag)])
+
+def _restore_complex(serializer, d):
+    return complex(d['real'], d['imag'])
+
+def _serialize_numpy_scalar(serializer, o):
+    return OrderedDict([('dtype', o.dtype.str), ('value', o.item())])
+
+def _restore_numpy_scalar(serializer, d):
+    return numpy.dtype(str(d['dtype'])).type(d['value'])
+
+def _serialize_date(serializer, o):
+    return OrderedDict([('isoformat', o.isoformat())])
+
+def _restore_date(serializer, d):
+    return datetime.datetime.strptime(d['isoformat'], '%Y-%m-%d').date()
+
+def _serialize_datetime(serializer, o):
+    if o.utcoffset() is not None:
+        raise ValueError('Can\'t serialize datetime with time zone ' + repr(o))
+    return OrderedDict([('isoformat', o.isoformat())])
+
+def _restore_datetime(serializer, d):
+    s = d['isoformat']
+    f = '%Y-%m-%dT%H:%M:%S.%f' if '.' in s else '%Y-%m-%dT%H:%M:%S'
+    return datetime.datetime.strptime(s, f)
+
+Serializer.register_type(numpy.ndarray, 'numpy.ndarray',
+                         Serializer.serialize_numpy_ndarray.__func__,
+                         Serializer.restore_numpy_ndarray.__func__)
+Serializer.register_type(numpy.generic, 'numpy.scalar',
+                         _serialize_numpy_scalar, _restore_numpy_scalar)
+Serializer.register_type(complex, 'complex',
+                         _serialize_complex, _restore_complex)
+Serializer.register_type(datetime.date, 'datetime.date',
+                         _serialize_date, _restore_date)
+Serializer.register_type(datetime.datetime, 'datetime.datetime',
+                         _serialize_datetime, _restore_datetime)
+# Lists stored column-wise are only ever written by RecursiveSerializer
+Serializer._decoders['columns'] = Serializer.restore_columns.__func__
+
+class NpySidecar(object):
+    """Stores large numpy arrays in .npy files next to an archive.
+
+    Arrays with at least `threshold` bytes are written to
+    "<basename>.<n>.npy" and the archive only keeps a reference to the file.
+    Referenced arrays are loaded memory-mapped and read-only, so they are only
+    paged in when they are actually accessed. If `threshold` is None, no
+    arrays are written to separate files, but existing references can still
+    be loaded.
+    """
+    def __init__(self, basename, threshold=None, config=None):
+        if config is not None:
+            if config.has_key('measurement_sidecar_threshold'):
+                threshold = config['measurement_sidecar_threshold']
+        self.basename = basename
+        self.dir = os.path.dirname(basename)
+        self.threshold = threshold
+        self.n = 0
+        self.file_re = re.compile(
+            '^' + re.escape(os.path.basename(basename)) + r'\.\d+\.npy$')
+
+    def begin(self):
+        """Start numbering sidecar files from zero, e.g. before a save."""
+        self.n = 0
+
+    def end(self):
+        """Remove the files of an earlier save that were not written again."""
+        for f in self.files():
+            n = int(f[len(self.basename)+1:-len('.npy')])
+            if n >= self.n:
+                os.remove(f)
+
+    def accepts(self, o):
+        return (self.threshold is not None and o.nbytes >= self.threshold
+                and not o.dtype.hasobject)
+
+    def save(self, o):
+        f = '{}.{}.npy'.format(self.basename, self.n)
+        self.n += 1
+        # Write to a temporary file first: the old file might still be
+        # memory-mapped by a previous load.
+        tmp = f + '.tmp'
+        fh = open(tmp, 'wb')
+        numpy.save(fh, o)
+        fh.close()
+        os.rename(tmp, f)
+        d = OrderedDict()
+        d['__type__'] = 'numpy.ndarray'
+        d['shape'] = o.shape
+        d['dtype'] = o.dtype.str
+        d['encoding'] = 'npy'
+        d['file'] = os.path.basename(f)
+        return d
+
+    def load(self, d):
+        f = os.path.join(self.dir, d['file'])
+        return numpy.load(f, mmap_mode='r')
+
+    def files(self):
+        fs = os.listdir(self.dir or '.')
+        return [os.path.join(self.dir, f) for f in sorted(fs)
+                if self.file_re.match(f)]
+
+    def remove(self):
+        for f in self.files():
+            os.remove(f)
+
 # Maybe just merge this class with Serializer and have a flag recursive.
 # It might make sense to always use RecursiveSerializer for all serialization,
 # right now the same serialization functionality is implemented in different
 # ways in XMLArchive and JsonArchive.
+_scalar_types = (basestring,bool,int,long,float,type(None))
+
 class RecursiveSerializer(object):
+    """Serialize a whole object tree into dicts, lists and scalars.
+
+    If the serializer's `columns` option is set (config option
+    serializer_columns), lists of objects of the same class, or of dicts with
+    the same keys, are stored column-wise: the class name is stored once and
+    each field becomes a list of the values of all items. Restoring such a
+    list gives the same result as restoring the items one by one.
+
+    If the serializer's `references` option is set (config option
+    serializer_references), objects, dicts, lists and arrays that are
+    reachable more than once are stored only once, tagged with an "__id__",
+    and every other occurrence is stored as {"__ref__": id}. On restore,
+    references resolve to the same object again. Circular references raise a
+    ValueError.
+    """
     def __init__(self, restore_objects=False, getstate='coma_getstate', 
-                 setstate='coma_setstate', config=None):
-        self.serializer = Serializer(restore_objects=restore_objects,
-                                     getstate=getstate,
-                                     setstate=setstate,
-                                     config=config)
+                 setstate='coma_setstate', serialize_ndarrays=True,
+                 config=None, serializer=None):
+        if serializer is None:
+            serializer = Serializer(restore_objects=restore_objects,
+                                    getstate=getstate,
+                                    setstate=setstate,
+                                    config=config)
+        self.serializer = serializer
+        # If False, numpy arrays are passed through as is and are left for
+        # the archive to encode
+        self.serialize_ndarrays = serialize_ndarrays
+        # Per call state of the references mode
+        self._counts = None
+        self._states = None
+        self._ids = None
+        self._active = None
 
     def serialize(self, o):
-        if isinstance(o, (basestring,bool,int,long,float)) or o is None:
+        if not self.serializer.references:
+            return self._serialize(o)
+        self._counts = {}
+        self._states = {}
+        self._ids = {}
+        self._active = set()
+        try:
+            self._count_references(o)
+            return self._serialize(o)
+        finally:
+            self._counts = self._states = self._ids = self._active = None
+
+    def _count_references(self, o):
+        # Count how often each object is reachable. The objects' states are
+        # kept, so that getstate is only called once and ids stay unique.
+        if isinstance(o, _scalar_types):
+            return
+        if isinstance(o, tuple):
+            # Tuples are immutable, so they are never shared in the output;
+            # their items may be, though
+            for v in o:
+                self._count_references(v)
+            return
+        i = id(o)
+        if i in self._counts:
+            self._counts[i] += 1
+            return
+        self._counts[i] = 1
+        if isinstance(o, numpy.ndarray) and not self.serialize_ndarrays:
+            pass
+        elif isinstance(o, (list, tuple)):
+            for v in o:
+                self._count_references(v)
+        elif isinstance(o, dict):
+            for v in o.itervalues():
+                self._count_references(v)
+        else:
+            d = self.serializer.serialize(o)
+            self._states[i] = (o,d)
+            self._count_references(d)
+
+    def _state(self, o):
+        if self._states is not None and id(o) in self._states:
+            return self._states[id(o)][1]
+        return self.serializer.serialize(o)
+
+    def _is_shared(self, o):
+        return self._counts is not None and self._counts.get(id(o), 0) > 1
+
+    def _serialize(self, o):
+        if isinstance(o, _scalar_types):
+            return o
+        if self._is_shared(o):
+            return self._serialize_shared(o)
+        return self._serialize_value(o)
+
+    def _serialize_shared(self, o):
+        i = id(o)
+        if i in self._active:
+            raise ValueError('Circular reference to {} object'
+                             .format(type(o).__name__))
+        if i in self._ids:
+            return OrderedDict([('__ref__', self._ids[i])])
+        n = len(self._ids)
+        self._ids[i] = n
+        self._active.add(i)
+        d = self._serialize_value(o)
+        self._active.remove(i)
+        # The id comes last, so that typed values still start with "__type__"
+        if isinstance(d, dict):
+            d['__id__'] = n
+        else:
+            d = OrderedDict([('__value__', d), ('__id__', n)])
+        return d
+
+    def _serialize_value(self, o):
+        if isinstance(o, numpy.ndarray) and not self.serialize_ndarrays:
             return o
         elif isinstance(o, (list, tuple)):
-            return [self.serialize(i) for i in o]
+            if self.serializer.columns:
+                d = self._serialize_columns(o)
+                if d is not None:
+                    return d
+            return [self._serialize(i) for i in o]
         elif isinstance(o, dict):
-            return OrderedDict([(self.serialize(k), self.serialize(v)) for k,v in o.iteritems()])
+            return OrderedDict([(self._serialize(k), self._serialize(v)) for k,v in o.iteritems()])
         else:
-            return self.serialize(self.serializer.serialize(o))
+            return self._serialize(self._state(o))
+
+    def _serialize_columns(self, o):
+        # Returns None if the list is not homogeneous
+        if len(o) < 2:
+            return None
+        if any(self._is_shared(i) for i in o):
+            return None
+        c = None
+        if all(isinstance(i, dict) for i in o):
+            ds = o
+            ks = ds[0].keys()
+        else:
+            t = type(o[0])
+            s = self.serializer
+            if (s._encoder(t) is not None or not hasattr(o[0], s.getstate)
+                    or any(type(i) is not t for i in o)):
+                return None
+            ds = [self._state(i) for i in o]
+            c = t.__module__ + '.' + t.__name__
+            ks = [k for k in ds[0].keys() if k != '__class__']
+        if (len(ks) == 0 or not all(isinstance(k, basestring) for k in ks)
+                or any(d.keys() != ds[0].keys() for d in ds)):
+            return None
+        d = OrderedDict()
+        d['__type__'] = 'columns'
+        d['count'] = len(ds)
+        if c is not None:
+            d['class'] = c
+        d['columns'] = OrderedDict()
+        for k in ks:
+            v = [i[k] for i in ds]
+            if not all(isinstance(i, _scalar_types) for i in v):
+                v = self._serialize(v)
+            d['columns'][k] = v
+        return d
 
     def restore(self, d):
+        self.serializer.reset()
+        return self._restore(d)
+
+    def _restore(self, d):
         o = None
         if isinstance(d, (basestring,bool,int,long,float)) or d is None:
             o = d
         elif isinstance(d, dict):
             o = OrderedDict()
             for k,v in d.iteritems():
-                o[self.restore(k)] = self.restore(v)
+                o[self._restore(k)] = self._restore(v)
         elif isinstance(d, (list, tuple)):
             o = []
             for v in d:
-                o.append(self.restore(v))
+                o.append(self._restore(v))
         else:
             o = d
         return self.serializer.restore(o)
@@ -117,9 +576,10 @@ class XMLArchiveError(Exception):
 
 class XMLArchive(object):
     def __init__(self, archive_name, pretty_print=None, indent=None, config=None):
-        # defaults for pretty_print and indent
+        # defaults for pretty_print, indent and numeric_arrays
         _pretty_print = True
         _indent = 2
+        _numeric_arrays = False
         
         # read relevant config options
         if config is not None:
@@ -127,6 +587,8 @@ class XMLArchive(object):
                 p = config['archive_pretty_print']
                 if p is True or p is False:
                     _pretty_print = p
+            if config.has_key('archive_xml_numeric_arrays'):
+                _numeric_arrays = config['archive_xml_numeric_arrays']
         
         # __init__ arguments---if specified (i.e. not None)---overwrite config
         # options
@@ -142,6 +604,8 @@ class XMLArchive(object):
         self.serializer = Serializer(config=config)
         self.pretty_print = _pretty_print
         self.indent = ' ' * _indent
+        # If True, lists of numbers are loaded as numpy arrays
+        self.numeric_arrays = _numeric_arrays
         # this is taken from json.scanner
         self.number_re = re.compile(
             r'^(-?(?:0|[1-9]\d*))(\.\d+)?([eE][-+]?\d+)?$',
@@ -152,67 +616,248 @@ class XMLArchive(object):
         self.dump(o, f)
         f.close()
 
-    def loadfile(self, filename):
+    def loadfile(self, filename, paths=None):
         f = open(filename)
-        o = self.load(f)
+        o = self.load(f, paths)
         f.close()
         return o
         
     def dumps(self, o):
-        s = ET.tostring(self._dump_to_element(o))
         if self.pretty_print:
-            # This is a hack to get rid of the xml header
-            header = minidom.Document().toprettyxml(indent=self.indent)
-            s = minidom.parseString(s).toprettyxml(indent=self.indent)
-            s = s[len(header):]
-        return s
+            s = []
+            self.write(s.append, self._tag(), o)
+            return ''.join(s)
+        return ET.tostring(self._dump_to_element(o))
 
     def dump(self, o, f):
         if self.pretty_print:
-            #s = ET.tostring(self._dump_to_element(o))
-            #minidom.parseString(s).writexml(f, addindent=self.indent, newl='\n', encoding='utf-8')
-            s = self.dumps(o)
-            f.write(s)
+            self.write(f.write, self._tag(), o)
         else:
             et = ET.ElementTree(self._dump_to_element(o))
             et.write(f)
 
-    def _dump_to_element(self, o):
+    def _tag(self):
         tag = self.archive_name
         if tag is None:
             tag = 'serialization'
-        return self.encode(tag, o)
+        return tag
+
+    def _dump_to_element(self, o):
+        return self.encode(self._tag(), o)
+
+    def write(self, write, tag, o, level=0):
+        """Write `o` as indented XML, element by element, to `write`.
+
+        The output is the same as pretty printing the ElementTree from
+        `encode` with minidom, without building either tree.
+        """
+        indent = self.indent * level
+        if isinstance(o, (list, tuple)):
+            write('{}<{}>\n'.format(indent, tag))
+            self.write(write, 'count', len(o), level+1)
+            self.write(write, 'item_version', 0, level+1)
+            for i in o:
+                self.write(write, 'item', i, level+1)
+            write('{}</{}>\n'.format(indent, tag))
+        elif isinstance(o, dict):
+            if len(o) == 0:
+                write('{}<{}/>\n'.format(indent, tag))
+                return
+            write('{}<{}>\n'.format(indent, tag))
+            for k,v in o.iteritems():
+                self.write(write, k, v, level+1)
+            write('{}</{}>\n'.format(indent, tag))
+        elif isinstance(o, (basestring,bool,int,long,float)) or o is None:
+            t = self._text(o)
+            if t == '':
+                write('{}<{}/>\n'.format(indent, tag))
+            else:
+                write('{}<{}>{}</{}>\n'.format(indent, tag, self._escape(t), tag))
+        else:
+            self.write(write, tag, self.serializer.serialize(o), level)
+
+    def _text(self, o):
+        if o is None:
+            return ''
+        if isinstance(o, float):
+            if math.isnan(o):
+                return 'NaN'
+            elif o == float('inf'):
+                return 'Infinity'
+            elif o == -float('inf'):
+                return '-Infinity'
+        return str(o)
+
+    def _escape(self, t):
+        # As minidom does it; line endings are normalized like an XML parser
+        # would do
+        if '\r' in t:
+            t = t.replace('\r\n', '\n').replace('\r', '\n')
+        return t.replace('&', '&amp;').replace('<', '&lt;') \
+                .replace('"', '&quot;').replace('>', '&gt;')
+
+    def loads(self, s, paths=None):
+        return self.load(StringIO(s), paths)
+
+    def load(self, f, paths=None):
+        """Load the archive from file object `f`.
+
+        If `paths` is given, only the parts of the archive that are needed to
+        access these paths (see coma.path) are decoded; everything else is
+        skipped and discarded while parsing.
+        """
+        self.serializer.reset()
+        if paths is not None and not self.serializer.restore_objects:
+            return self._load_paths(f, paths)
+        # Elements are decoded as soon as they end and are then discarded, so
+        # that the complete element tree is never held in memory. For each
+        # open element, the stack holds the element and the list of (tag,
+        # value) tuples of its decoded children.
+        # The third entry collects the texts of the items of a list, as long as
+        # all of them are leaf elements, so that they can be parsed in bulk.
+        # It is None before the first item and False if that isn't possible.
+        stack = []
+        for event,e in cET.iterparse(f, events=('start','end')):
+            if event == 'start':
+                if len(stack) == 0:
+                    self._check_root_element(e)
+                stack.append([e,[],None])
+                continue
+            _,cs,texts = stack.pop()
+            if texts:
+                v = self._decode_leaf_list(e.tag, cs, texts)
+            elif len(cs) == 0:
+                v = None
+            else:
+                v = self._decode_children(e.tag, cs)
+            if len(stack) == 0:
+                if v is None and len(cs) == 0:
+                    v = self.serializer.restore(self._parse_string(e.text))
+                return v
+            p = stack[-1]
+            if len(cs) == 0 and e.tag == 'item' and p[2] is not False:
+                if p[2] is None:
+                    p[2] = [] if self._is_list_header(p[1]) else False
+                if p[2] is not False:
+                    p[2].append(e.text)
+                    p[0].clear()
+                    continue
+            if p[2]:
+                # Not a list of leaves after all
+                p[1].extend(('item',self.serializer.restore(self._parse_string(t)))
+                            for t in p[2])
+                p[2] = False
+            elif p[2] is None and len(p[1]) >= 2:
+                p[2] = False
+            if len(cs) == 0:
+                v = self._decode_leaf(e.tag, e.text, p[1])
+            p[1].append((e.tag,v))
+            # Removes e (and the parent's text, which is irrelevant once it
+            # has children)
+            p[0].clear()
+
+    def _whole_tags(self):
+        if self.serializer.references:
+            return ('__type__','__ref__')
+        return ('__type__',)
+
+    def _load_paths(self, f, paths):
+        # For each open element, the stack holds a list [element, path tree,
+        # number of children, list state, ids of skipped children]. The path
+        # tree is True for elements that are decoded completely and None for
+        # skipped elements. The list state is 0 (not a list), 1 (first child
+        # was <count>) or 2 (a list, second child was <item_version>).
+        self.serializer.partial = True
+        stack = []
+        for event,e in cET.iterparse(f, events=('start','end')):
+            if event == 'start':
+                if len(stack) == 0:
+                    self._check_root_element(e)
+                    stack.append([e, path_tree(paths), 0, 0, set()])
+                    continue
+                p = stack[-1]
+                t,n = p[1],p[2]
+                p[2] += 1
+                if t is None or t is True:
+                    pass
+                elif n == 0 and e.tag == 'count':
+                    p[3] = 1
+                    t = True
+                elif n == 1 and e.tag == 'item_version' and p[3] == 1:
+                    p[3] = 2
+                    t = True
+                elif n == 0 and e.tag in self._whole_tags():
+                    # Typed values (numpy arrays) and references are only
+                    # decoded as a whole
+                    p[1] = True
+                    t = True
+                elif p[3] == 2:
+                    t = path_subtree(t, n-2)
+                else:
+                    t = path_subtree(t, e.tag)
+                stack.append([e, t, 0, 0, set()])
+                continue
 
-    def loads(self, s):
-        e = ET.fromstring(s)
-        return self._load_from_element(e)
+            _,t,_,l,skipped = stack.pop()
+            if len(stack) == 0:
+                root = e
+                break
+            p = stack[-1]
+            if t is None:
+                # Skipped elements become empty; in lists they are kept as
+                # placeholders (decoded as None), so that indices don't change
+                e.clear()
+                if p[1] is None:
+                    p[0].clear()
+                elif p[3] != 2:
+                    p[4].add(id(e))
+            elif len(skipped) > 0:
+                e[:] = [c for c in e if id(c) not in skipped]
+        if len(skipped) > 0:
+            root[:] = [c for c in root if id(c) not in skipped]
+        return self.decode(root)
 
-    def load(self, f):
-        et = ET.parse(f)
-        e = et.getroot()
-        return self._load_from_element(e)
+    def loadfile_entry(self, filename, key):
+        f = open(filename)
+        try:
+            return self.load_entry(f, key)
+        finally:
+            f.close()
+
+    def load_entry(self, f, key):
+        """Load only the top-level entry `key`.
+
+        Stops parsing as soon as the entry has been read; skipped elements are
+        discarded. Raises KeyError if there is no such entry.
+        """
+        self.serializer.reset()
+        depth = 0
+        for event,e in cET.iterparse(f, events=('start','end')):
+            if event == 'start':
+                depth += 1
+                if depth == 1:
+                    self._check_root_element(e)
+                continue
+            depth -= 1
+            if depth == 1:
+                if e.tag == key:
+                    return self.decode(e)
+                e.clear()
+        raise KeyError(key)
 
     def _load_from_element(self, e):
+        self._check_root_element(e)
+        return self.decode(e)
+
+    def _check_root_element(self, e):
         if self.archive_name is not None and e.tag != self.archive_name:
             raise XMLArchiveError('Expected XML root element "{}", but found "{}"'
                     .format(self.archive_name, e.tag))
-        return self.decode(e)
 
     def encode(self, tag, o):
         e = ET.Element(tag)
-        if isinstance(o, (basestring,bool,int,long)):
-            e.text = str(o)
-        elif o is None:
-            e.text = ''
-        elif isinstance(o, float):
-            if math.isnan(o):
-                e.text = 'NaN'
-            elif o == float('inf'):
-                e.text = 'Infinity'
-            elif o == -float('inf'):
-                e.text = '-Infinity'
-            else:
-                e.text = str(o)
+        if isinstance(o, (basestring,bool,int,long,float)) or o is None:
+            e.text = self._text(o)
         elif isinstance(o, (list, tuple)):
             f = ET.Element('count')
             f.text = str(len(o))
@@ -232,27 +877,85 @@ class XMLArchive(object):
     def decode(self, e):
         if len(e) == 0:
             return self.serializer.restore(self._parse_string(e.text))
+        if (len(e) > 2 and e[0].tag == 'count' and e[1].tag == 'item_version'
+                and all(len(c) == 0 and c.tag == 'item' for c in e[2:])):
+            cs = [(c.tag,self.decode(c)) for c in e[:2]]
+            if self._is_list_header(cs):
+                return self._decode_leaf_list(e.tag, cs, [c.text for c in e[2:]])
         # Children
-        cs = [(c.tag,self.decode(c)) for c in e]
+        cs = []
+        for c in e:
+            if len(c) == 0:
+                cs.append((c.tag,self._decode_leaf(c.tag, c.text, cs)))
+            else:
+                cs.append((c.tag,self.decode(c)))
+        return self._decode_children(e.tag, cs)
+
+    def _decode_leaf(self, tag, text, cs):
+        # cs is the list of (tag, value) tuples of the preceding siblings.
+        # The base64 data of numpy arrays is kept as text; it may look like a
+        # number, but str() would not give the original text back.
+        if tag == 'data' and len(cs) > 0 and cs[0] == ('__type__','numpy.ndarray'):
+            return text or ''
+        return self.serializer.restore(self._parse_string(text))
+
+    def _is_list_header(self, cs):
+        return (len(cs) == 2 and cs[0][0] == 'count' and isinstance(cs[0][1],int)
+                and cs[1][0] == 'item_version')
+
+    _numbers_re = re.compile(
+        r'(?:-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][-+]?\d+)?|NaN|-?Infinity)'
+        r'(?:,(?:-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][-+]?\d+)?|NaN|-?Infinity))*\Z')
+    _float_re = re.compile(r'[.eEIN]')
+
+    def _decode_leaf_list(self, tag, cs, texts):
+        # Decodes a list whose items are all leaf elements, given the
+        # list header cs and the items' texts. Lists of numbers are parsed in
+        # bulk.
+        if len(texts) != cs[0][1]:
+            raise XMLArchiveError('Element "{}" looks like a list, but '
+                    'number of items does not match "count"'.format(tag))
+        l = self._parse_numbers(texts)
+        if l is None:
+            l = [self.serializer.restore(self._parse_string(t)) for t in texts]
+        elif self.numeric_arrays:
+            return numpy.array(l)
+        return self.serializer.restore(l)
+
+    def _parse_numbers(self, texts):
+        # Returns the list of numbers, with the same types as _parse_string,
+        # or None if not all texts are numbers
+        if None in texts:
+            return None
+        s = ','.join(texts)
+        if self._numbers_re.match(s) is None or s.count(',') != len(texts)-1:
+            return None
+        if self._float_re.search(s) is None:
+            return map(int, texts)
+        return [float(t) if self._float_re.search(t) else int(t) for t in texts]
+
+    def _decode_children(self, tag, cs):
+        # cs is the list of (tag, value) tuples of the element's children
         # Is it a list?
-        if cs[0][0] == 'count' and isinstance(cs[0][1],int) and cs[1][0] == 'item_version':
+        if (len(cs) > 1 and cs[0][0] == 'count' and isinstance(cs[0][1],int)
+                and cs[1][0] == 'item_version'):
             n = cs[0][1]
             if len(cs) != n+2:
                 raise XMLArchiveError('Element "{}" looks like a list, but '
-                        'number of items does not match "count"'.format(e.tag))
+                        'number of items does not match "count"'.format(tag))
             if n == 0:
                 return self.serializer.restore([])
-            unique_tags = set(zip(*(cs[2:]))[0])
-            if len(unique_tags) != 1 or unique_tags.pop() != 'item':
-                raise XMLArchiveError('Element "{}" looks like a list, but '
-                        'contains invalid child elements'.format(e.tag))
-            l = list(zip(*(cs[2:]))[1])
+            l = []
+            for t,v in cs[2:]:
+                if t != 'item':
+                    raise XMLArchiveError('Element "{}" looks like a list, but '
+                            'contains invalid child elements'.format(tag))
+                l.append(v)
             return self.serializer.restore(l)
         # Otherwise it's a dictionary
-        unique_tags = set(zip(*(cs))[0])
-        if len(unique_tags) != len(cs):
-            raise XMLArchiveError('Multiple elements with the same tag are not supported')
         d = OrderedDict(cs)
+        if len(d) != len(cs):
+            raise XMLArchiveError('Multiple elements with the same tag are not supported')
         return self.serializer.restore(d)
 
     def _parse_string(self, s):
@@ -277,11 +980,42 @@ class XMLArchive(object):
 class JsonArchiveError(Exception):
     pass
 
+def json_backend(name='auto'):
+    """Return the name and module of a JSON backend.
+
+    `name` is 'json' (the stdlib), 'simplejson' or 'auto'. With 'auto',
+    simplejson is used if it is installed with its C speedups, otherwise the
+    stdlib.
+    """
+    if name == 'auto':
+        if simplejson is not None and simplejson.encoder.c_make_encoder is not None:
+            name = 'simplejson'
+        else:
+            name = 'json'
+    if name == 'json':
+        return name,json
+    if name == 'simplejson':
+        if simplejson is None:
+            raise JsonArchiveError('The simplejson backend requires simplejson')
+        return name,simplejson
+    raise JsonArchiveError('Unsupported JSON backend: {}'.format(name))
+
 class JsonArchive(object):
+    """Archive in the JSON format.
+
+    JSON is encoded and decoded with the stdlib's json module or, if
+    available, with simplejson, which is faster, but produces identical
+    output. The backend is chosen with the archive_json_backend config option
+    ('auto', 'json' or 'simplejson'); the one in use is recorded in the
+    `backend` attribute. If archive_json_ordered is False, objects are loaded
+    as plain dicts instead of OrderedDicts.
+    """
     def __init__(self, archive_name, pretty_print=None, indent=None, config=None):
-        # defaults for pretty_print and indent
+        # defaults for pretty_print, indent, backend and ordered
         _pretty_print = True
         _indent = 2
+        _backend = 'auto'
+        _ordered = True
         
         # read relevant config options
         if config is not None:
@@ -289,6 +1023,10 @@ class JsonArchive(object):
                 p = config['archive_pretty_print']
                 if p is True or p is False:
                     _pretty_print = p
+            if config.has_key('archive_json_backend'):
+                _backend = config['archive_json_backend']
+            if config.has_key('archive_json_ordered'):
+                _ordered = config['archive_json_ordered']
         
         # __init__ arguments---if specified (i.e. not None)---overwrite config
         # options
@@ -299,47 +1037,282 @@ class JsonArchive(object):
 
         self.archive_name = archive_name
         self.serializer = Serializer(config=config)
+        self.backend,self.json = json_backend(_backend)
         self.indent = _indent
         self.separators = (',',': ')
         if _pretty_print is False:
             self.indent = None
             self.separators = (',',':')
+        # Options that make simplejson behave like the stdlib
+        self.dump_options = {}
+        self.load_options = {}
+        if self.backend == 'simplejson':
+            self.dump_options = {'allow_nan': True,
+                                 'namedtuple_as_object': False,
+                                 'tuple_as_array': True,
+                                 'for_json': False,
+                                 'iterable_as_array': False,
+                                 'bigint_as_string': False,
+                                 'use_decimal': False}
+            # Recent versions reject NaN and Infinity by default
+            args = inspect.getargspec(simplejson.JSONDecoder.__init__).args
+            if 'allow_nan' in args:
+                self.load_options = {'allow_nan': True}
+        # Objects are decoded into OrderedDicts by default. Plain dicts are
+        # faster and smaller, but lose the key order. Only objects with a
+        # "__type__" or "__class__" key (or "__id__" or "__ref__" with
+        # serializer_references) are passed on to the serializer.
+        self.ordered = _ordered
+        if self.ordered:
+            self.dict_type = OrderedDict
+            self.load_options['object_pairs_hook'] = self._restore_pairs
+        else:
+            self.dict_type = dict
+            self.load_options['object_hook'] = self._restore_dict
+
+    def _restore_pairs(self, pairs):
+        d = self.dict_type(pairs)
+        if ('__type__' in d or '__class__' in d or
+                (self.serializer.references and ('__id__' in d or '__ref__' in d))):
+            return self.serializer.restore(d)
+        return d
+
+    def _restore_dict(self, d):
+        if ('__type__' in d or '__class__' in d or
+                (self.serializer.references and ('__id__' in d or '__ref__' in d))):
+            return self.serializer.restore(d)
+        return d
 
     def dumpfile(self, o, filename):
         f = open(filename, 'w')
         self.dump(o, f)
         f.close()
 
-    def loadfile(self, filename):
+    def loadfile(self, filename, paths=None):
         f = open(filename)
-        o = self.load(f)
+        o = self.load(f, paths)
         f.close()
         return o
         
     def dumps(self, o):
         if self.archive_name is not None:
             o = OrderedDict([(self.archive_name, o)])
-        return json.dumps(o, default=self.serializer.serialize, 
-                             indent=self.indent, 
-                             separators=self.separators)
+        return self.json.dumps(o, default=self.serializer.serialize, 
+                                  indent=self.indent, 
+                                  separators=self.separators,
+                                  **self.dump_options)
 
     def dump(self, o, f):
         if self.archive_name is not None:
             o = OrderedDict([(self.archive_name, o)])
-        json.dump(o, f, default=self.serializer.serialize,
-                        indent=self.indent, 
-                        separators=self.separators)
+        self.json.dump(o, f, default=self.serializer.serialize,
+                             indent=self.indent, 
+                             separators=self.separators,
+                             **self.dump_options)
 
-    def loads(self, s):
-        return self._load(s, json.loads)
-        o = json.loads(s, object_pairs_hook=lambda d: self.serializer.restore(OrderedDict(d)))
+    def loadfile_entry(self, filename, key):
+        f = open(filename)
+        try:
+            return self.load_entry(f, key)
+        finally:
+            f.close()
 
-    def load(self, f):
-        return self._load(f, json.load)
+    def load_entry(self, f, key):
+        """Load only the top-level entry `key`.
+
+        If `key` is the first entry, as 'info' is for measurements, parsing
+        stops right after it. Otherwise the whole archive is loaded. Raises
+        KeyError if there is no such entry.
+        """
+        prefix = r'\s*\{\s*'
+        if self.archive_name is not None:
+            prefix += re.escape(json.dumps(self.archive_name)) + r'\s*:\s*\{\s*'
+        prefix += re.escape(json.dumps(key)) + r'\s*:\s*'
+        prefix = re.compile(prefix)
+        decoder = self.json.JSONDecoder(**self.load_options)
+
+        s = ''
+        n = 4096
+        while True:
+            c = f.read(n)
+            s += c
+            m = prefix.match(s)
+            if m is None:
+                if not c or len(s) >= 4096:
+                    break
+                continue
+            try:
+                self.serializer.reset()
+                o,j = decoder.raw_decode(s, m.end())
+            except ValueError as e:
+                if not c:
+                    raise JsonArchiveError(e.message)
+            else:
+                # A number that ends with the buffer may continue after it
+                if j < len(s) or not c:
+                    return o
+            n *= 2
+
+        # Not the first entry
+        f.seek(0)
+        o = self.load(f)
+        if not isinstance(o, dict) or not o.has_key(key):
+            raise KeyError(key)
+        return o[key]
+
+    def loads(self, s, paths=None):
+        self.serializer.reset()
+        if paths is not None and not self.serializer.restore_objects:
+            return self._load_paths(s, paths)
+        return self._load(s, self.json.loads)
+
+    def load(self, f, paths=None):
+        """Load the archive from file object `f`.
+
+        If `paths` is given, only the parts of the archive that are needed to
+        access these paths (see coma.path) are decoded. Everything else is
+        only scanned to find its end. Files are memory-mapped, so that skipped
+        parts are never copied into memory.
+        """
+        self.serializer.reset()
+        if paths is None or self.serializer.restore_objects:
+            return self._load(f, self.json.load)
+        if not isinstance(f, file):
+            # e.g. a compressed file, whose fileno() is not what we want
+            return self._load_paths(f.read(), paths)
+        try:
+            b = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, ValueError, EnvironmentError):
+            return self._load_paths(f.read(), paths)
+        try:
+            return self._load_paths(b, paths)
+        finally:
+            b.close()
+
+    _ws_re = re.compile(r'[ \t\n\r]*')
+    _string_re = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"')
+    _special_re = re.compile(r'["\[\]{}]')
+    _scalar_re = re.compile(r'[^,\]}\s]*')
+
+    def _load_paths(self, b, paths):
+        self.serializer.partial = True
+        t = path_tree(paths)
+        if self.archive_name is not None:
+            t = {self.archive_name: t}
+        try:
+            o,i = self._decode_paths(b, self._skip_ws(b, 0), t)
+            if self._skip_ws(b, i) != len(b):
+                raise ValueError('Extra data at position {}'.format(i))
+        except (ValueError, IndexError) as e:
+            raise JsonArchiveError(str(e))
+        if self.archive_name is not None:
+            if not isinstance(o, dict) or not o.has_key(self.archive_name):
+                raise JsonArchiveError('Did not find top-level entry "{}" in JSON '
+                                       'string'.format(self.archive_name))
+            o = o[self.archive_name]
+        return o
+
+    def _decode_paths(self, b, i, t):
+        # Decodes the value starting at b[i], restricted to path tree t.
+        # Returns the value and the position after it.
+        if t is not True:
+            if b[i] == '{':
+                return self._decode_object_paths(b, i, t)
+            if b[i] == '[':
+                return self._decode_array_paths(b, i, t)
+        j = self._skip_value(b, i)
+        o = self.json.loads(b[i:j], **self.load_options)
+        return o,j
+
+    def _decode_object_paths(self, b, start, t):
+        d = []
+        i = self._skip_ws(b, start+1)
+        if b[i] == '}':
+            return self._restore_pairs([]),i+1
+        while True:
+            m = self._string_re.match(b, i)
+            if m is None:
+                raise ValueError('Expecting property name at position {}'.format(i))
+            k = json.loads(m.group())
+            i = self._skip_ws(b, m.end())
+            if b[i] != ':':
+                raise ValueError('Expecting : delimiter at position {}'.format(i))
+            i = self._skip_ws(b, i+1)
+            if len(d) == 0 and (k == '__type__' or
+                                (k == '__ref__' and self.serializer.references)):
+                # Typed values (numpy arrays) and references are only
+                # decoded as a whole
+                return self._decode_paths(b, start, True)
+            s = path_subtree(t, k)
+            if s is None:
+                i = self._skip_value(b, i)
+            else:
+                v,i = self._decode_paths(b, i, s)
+                d.append((k,v))
+            i = self._skip_ws(b, i)
+            if b[i] == '}':
+                return self._restore_pairs(d),i+1
+            if b[i] != ',':
+                raise ValueError('Expecting , delimiter at position {}'.format(i))
+            i = self._skip_ws(b, i+1)
+
+    def _decode_array_paths(self, b, start, t):
+        # Skipped items are replaced by None, so that indices don't change
+        l = []
+        i = self._skip_ws(b, start+1)
+        if b[i] == ']':
+            return l,i+1
+        while True:
+            s = path_subtree(t, len(l))
+            if s is None:
+                i = self._skip_value(b, i)
+                l.append(None)
+            else:
+                v,i = self._decode_paths(b, i, s)
+                l.append(v)
+            i = self._skip_ws(b, i)
+            if b[i] == ']':
+                return l,i+1
+            if b[i] != ',':
+                raise ValueError('Expecting , delimiter at position {}'.format(i))
+            i = self._skip_ws(b, i+1)
+
+    def _skip_ws(self, b, i):
+        return self._ws_re.match(b, i).end()
+
+    def _skip_value(self, b, i):
+        c = b[i]
+        if c == '"':
+            m = self._string_re.match(b, i)
+            if m is None:
+                raise ValueError('Unterminated string at position {}'.format(i))
+            return m.end()
+        if c == '{' or c == '[':
+            depth = 0
+            while True:
+                m = self._special_re.search(b, i)
+                if m is None:
+                    raise ValueError('Unterminated value at position {}'.format(i))
+                i = m.start()
+                c = b[i]
+                if c == '"':
+                    i = self._skip_value(b, i)
+                    continue
+                if c == '{' or c == '[':
+                    depth += 1
+                else:
+                    depth -= 1
+                i += 1
+                if depth == 0:
+                    return i
+        j = self._scalar_re.match(b, i).end()
+        if j == i:
+            raise ValueError('Expecting value at position {}'.format(i))
+        return j
 
     def _load(self, s_or_f, json_load):
         try:
-            o = json_load(s_or_f, object_pairs_hook=lambda d: self.serializer.restore(OrderedDict(d)))
+            o = json_load(s_or_f, **self.load_options)
             if self.archive_name is not None:
                 if not isinstance(o, dict) or not o.has_key(self.archive_name):
                     raise JsonArchiveError('Did not find top-level entry "{}" in JSON '
@@ -349,12 +1322,621 @@ class JsonArchive(object):
         except ValueError as e:
             raise JsonArchiveError(e.message)
 
+class H5ArchiveError(Exception):
+    pass
+
+class H5Archive(object):
+    """Archive in the HDF5 format.
+
+    Dictionaries and lists are stored as groups, numpy arrays as datasets and
+    all other values as scalar datasets. The type of each node is recorded in
+    its "__type__" attribute. By default, arrays are not compressed. With e.g.
+    the config options archive_h5_compression = gzip and
+    archive_h5_compression_level = 4, they are stored chunked and compressed.
+    Requires h5py.
+    """
+    def __init__(self, archive_name, pretty_print=None, indent=None, config=None):
+        if h5py is None:
+            raise H5ArchiveError('The h5 archive format requires h5py')
+
+        # pretty_print and indent do not apply to a binary format
+        _compression = None
+        _compression_level = None
+        if config is not None:
+            if config.has_key('archive_h5_compression'):
+                _compression = config['archive_h5_compression']
+            if config.has_key('archive_h5_compression_level'):
+                _compression_level = config['archive_h5_compression_level']
+        if _compression == 'none':
+            _compression = None
+
+        self.archive_name = archive_name
+        self.serializer = Serializer(config=config)
+        self.compression = _compression
+        self.compression_level = _compression_level
+
+    def dumpfile(self, o, filename):
+        f = h5py.File(filename, 'w', track_order=True)
+        try:
+            self._dump_to_file(o, f)
+        finally:
+            f.close()
+
+    def loadfile(self, filename, paths=None):
+        f = h5py.File(filename, 'r')
+        try:
+            return self._load_from_file(f, paths)
+        finally:
+            f.close()
+
+    def loadfile_path(self, filename, path):
+        """Load only the value at `path`.
+
+        Only the groups and datasets along `path` are read. Integer path
+        segments into arrays only read the corresponding slice of the dataset.
+        Raises KeyError if `path` does not exist.
+        """
+        f = h5py.File(filename, 'r')
+        try:
+            self.serializer.reset()
+            return self._decode_path(self._root(f), path)
+        finally:
+            f.close()
+
+    def loadfile_entry(self, filename, key):
+        return self.loadfile_path(filename, [key])
+
+    def dump(self, o, f):
+        h = h5py.File(f, 'w', track_order=True)
+        try:
+            self._dump_to_file(o, h)
+        finally:
+            h.close()
+
+    def load(self, f, paths=None):
+        """Load the archive from file object `f`.
+
+        If `paths` is given, only the groups and datasets that are needed to
+        access these paths (see coma.path) are read.
+        """
+        h = h5py.File(f, 'r')
+        try:
+            return self._load_from_file(h, paths)
+        finally:
+            h.close()
+
+    def _dump_to_file(self, o, f):
+        tag = self.archive_name
+        if not tag:
+            tag = 'serialization'
+        self.encode(f, tag, o)
+
+    def _load_from_file(self, f, paths):
+        self.serializer.reset()
+        e = self._root(f)
+        if paths is None or self.serializer.restore_objects:
+            return self.decode(e)
+        self.serializer.partial = True
+        return self._decode_paths(e, path_tree(paths))
+
+    def _root(self, f):
+        if self.archive_name:
+            if not self.archive_name in f:
+                raise H5ArchiveError('Did not find top-level entry "{}" in '
+                                     'HDF5 file'.format(self.archive_name))
+            e = f[self.archive_name]
+        else:
+            if len(f) != 1:
+                raise H5ArchiveError('Expected exactly one top-level entry in '
+                                     'HDF5 file')
+            e = f.values()[0]
+        return e
+
+    def encode(self, g, k, o):
+        if '/' in k or k in ('','.'):
+            raise H5ArchiveError('Invalid name "{}" for an HDF5 group or '
+                                 'dataset'.format(k))
+        if isinstance(o, numpy.ndarray) and not o.dtype.hasobject:
+            opts = {}
+            if self.compression is not None and o.ndim > 0 and o.size > 0:
+                opts['chunks'] = True
+                opts['compression'] = self.compression
+                opts['compression_opts'] = self.compression_level
+            e = g.create_dataset(k, data=o, **opts)
+            t = 'numpy.ndarray'
+        elif isinstance(o, dict):
+            e = g.create_group(k, track_order=True)
+            for kk,v in o.iteritems():
+                self.encode(e, str(kk), v)
+            t = 'dict'
+        elif isinstance(o, (list, tuple)):
+            e = g.create_group(k, track_order=True)
+            for i,v in enumerate(o):
+                self.encode(e, str(i), v)
+            t = 'list'
+        elif o is None:
+            e = g.create_dataset(k, data=h5py.Empty('f'))
+            t = 'None'
+        elif isinstance(o, bool):
+            e = g.create_dataset(k, data=o)
+            t = 'bool'
+        elif isinstance(o, (int,long)):
+            try:
+                e = g.create_dataset(k, data=o)
+            except (OverflowError, TypeError):
+                raise H5ArchiveError('Integer {} is too large for HDF5'.format(o))
+            t = 'int'
+        elif isinstance(o, float):
+            e = g.create_dataset(k, data=o)
+            t = 'float'
+        elif isinstance(o, basestring):
+            e = g.create_dataset(k, data=o)
+            t = 'str'
+        else:
+            if isinstance(o, numpy.ndarray):
+                o = self.serializer.serialize_numpy_ndarray(o)
+            else:
+                o = self.serializer.serialize(o)
+            return self.encode(g, k, o)
+        e.attrs['__type__'] = t
+
+    def decode(self, e):
+        t = e.attrs.get('__type__')
+        if isinstance(e, h5py.Group):
+            if t == 'list':
+                l = [self.decode(e[str(i)]) for i in range(len(e))]
+                return self.serializer.restore(l)
+            d = OrderedDict([(k,self.decode(v)) for k,v in e.iteritems()])
+            return self.serializer.restore(d)
+        if t == 'None':
+            return None
+        v = e[()]
+        if t == 'bool':
+            return bool(v)
+        if t == 'int':
+            return int(v)
+        if t == 'float':
+            return float(v)
+        if t == 'numpy.ndarray':
+            # 0-d datasets are read as numpy scalars
+            return numpy.asarray(v)
+        return v
+
+    def _decode_paths(self, e, t):
+        if (t is True or not isinstance(e, h5py.Group) or '__type__' in e
+                or (self.serializer.references and '__ref__' in e)):
+            return self.decode(e)
+        if e.attrs.get('__type__') == 'list':
+            l = []
+            for i in range(len(e)):
+                s = path_subtree(t, i)
+                l.append(None if s is None else self._decode_paths(e[str(i)], s))
+            return self.serializer.restore(l)
+        d = OrderedDict()
+        for k,v in e.iteritems():
+            s = path_subtree(t, k)
+            if s is not None:
+                d[k] = self._decode_paths(v, s)
+        return self.serializer.restore(d)
+
+    def _decode_path(self, e, path):
+        segments = _parse_path(path)
+        while len(segments) > 0 and isinstance(e, h5py.Group):
+            s = segments[-1]
+            if s in ('','*'):
+                break
+            k = str(s)
+            if not k in e:
+                raise KeyError(path)
+            e = e[k]
+            segments.pop()
+        if len(segments) == 0:
+            return self.decode(e)
+        segments.reverse()
+        if (isinstance(e, h5py.Dataset) and e.attrs.get('__type__') == 'numpy.ndarray'
+                and all(isinstance(s,int) or s.isdigit() for s in segments)):
+            i = tuple(int(s) for s in segments)
+            if len(i) > len(e.shape) or any(j >= n for j,n in zip(i,e.shape)):
+                raise KeyError(path)
+            return e[i]
+        return access_data_by_path(self.decode(e), segments)
+
+class BinArchiveError(Exception):
+    pass
+
+class BinArchive(object):
+    """Archive in a compact binary format.
+
+    The file starts with the magic string "COMA", a format version byte and
+    the archive name. Every value is a one byte type tag followed by its
+    payload. Numbers are stored as little-endian int64 and float64; strings,
+    large integers, dictionaries, lists and numpy arrays are prefixed with the
+    byte length of their payload, so that they can be skipped without being
+    decoded. Arrays are stored as their raw buffer in C order together with
+    their dtype and shape. Other objects are serialized by the Serializer and
+    stored as dictionaries.
+    """
+    magic = 'COMA'
+    version = 1
+    _int = struct.Struct('<q')
+    _float = struct.Struct('<d')
+    _len = struct.Struct('<Q')
+    _count = struct.Struct('<I')
+
+    def __init__(self, archive_name, pretty_print=None, indent=None, config=None):
+        # pretty_print and indent do not apply to a binary format
+        self.archive_name = archive_name
+        self.serializer = Serializer(config=config)
+
+    def dumpfile(self, o, filename):
+        f = open(filename, 'wb')
+        try:
+            self.dump(o, f)
+        finally:
+            f.close()
+
+    def loadfile(self, filename, paths=None):
+        f = open(filename, 'rb')
+        try:
+            return self.load(f, paths)
+        finally:
+            f.close()
+
+    def loadfile_entry(self, filename, key):
+        f = open(filename, 'rb')
+        try:
+            return self.load_entry(f, key)
+        finally:
+            f.close()
+
+    def dumps(self, o):
+        f = io.BytesIO()
+        self.dump(o, f)
+        return f.getvalue()
+
+    def dump(self, o, f):
+        """Write `o` to the seekable file object `f`."""
+        f.write(self.magic + chr(self.version))
+        self._write_str(f, self._name())
+        self.encode(f, o)
+
+    def loads(self, s, paths=None):
+        return self._load_from_buffer(bytearray(s), paths)
+
+    def load(self, f, paths=None):
+        """Load the archive from file object `f`.
+
+        If `paths` is given, only the parts of the archive that are needed to
+        access these paths (see coma.path) are decoded; everything else is
+        skipped. Real files are memory-mapped, so that only the decoded parts
+        are read; arrays are copied out of the map. For other file objects,
+        arrays share memory with the buffer the file was read into.
+        """
+        b = self._buffer(f)
+        try:
+            return self._load_from_buffer(b, paths)
+        finally:
+            if isinstance(b, mmap.mmap):
+                b.close()
+
+    def load_entry(self, f, key):
+        """Load only the top-level entry `key`.
+
+        Raises KeyError if there is no such entry.
+        """
+        b = self._buffer(f)
+        try:
+            self.serializer.reset()
+            i = self._root(b)
+            if self._byte(b, i) != ord('d'):
+                raise KeyError(key)
+            for k,j in self._entries(b, i):
+                if k == key:
+                    return self.decode(b, j)[0]
+            raise KeyError(key)
+        finally:
+            if isinstance(b, mmap.mmap):
+                b.close()
+
+    def _buffer(self, f):
+        # A memory map for real files, a bytearray for everything else
+        if isinstance(f, file):
+            try:
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (AttributeError, ValueError, EnvironmentError):
+                pass
+        return bytearray(f.read())
+
+    def _byte(self, b, i):
+        # Indexing a memory map gives a character, a bytearray an integer
+        c = b[i]
+        if isinstance(c, str):
+            return ord(c)
+        return c
+
+    def _name(self):
+        if self.archive_name is None:
+            return 'serialization'
+        return self.archive_name
+
+    def _load_from_buffer(self, b, paths):
+        self.serializer.reset()
+        i = self._root(b)
+        try:
+            if paths is None or self.serializer.restore_objects:
+                o,i = self.decode(b, i)
+            else:
+                self.serializer.partial = True
+                o,i = self._decode_paths(b, i, path_tree(paths))
+        except (IndexError, struct.error) as e:
+            raise BinArchiveError('Truncated binary archive: {}'.format(e))
+        if i != len(b):
+            raise BinArchiveError('Extra data at position {}'.format(i))
+        return o
+
+    def _root(self, b):
+        if str(b[:4]) != self.magic:
+            raise BinArchiveError('Not a binary coma archive')
+        if self._byte(b, 4) != self.version:
+            raise BinArchiveError('Unsupported binary archive version {}'
+                                  .format(self._byte(b, 4)))
+        name,i = self._read_str(b, 5)
+        if name != self._name():
+            raise BinArchiveError('Expected archive "{}", found "{}"'
+                                  .format(self._name(), name))
+        return i
+
+    def _write_str(self, f, s):
+        if isinstance(s, unicode):
+            s = s.encode('utf-8')
+        f.write(self._count.pack(len(s)))
+        f.write(s)
+
+    def _read_str(self, b, i):
+        n, = self._count.unpack_from(b, i)
+        i += self._count.size
+        return b[i:i+n].decode('utf-8'),i+n
+
+    def _begin(self, f, tag):
+        # Writes tag and a placeholder for the payload length; returns the
+        # position of the placeholder
+        f.write(tag)
+        p = f.tell()
+        f.write(self._len.pack(0))
+        return p
+
+    def _end(self, f, p):
+        e = f.tell()
+        f.seek(p)
+        f.write(self._len.pack(e - p - self._len.size))
+        f.seek(e)
+
+    def encode(self, f, o):
+        if isinstance(o, numpy.ndarray) and not o.dtype.hasobject:
+            p = self._begin(f, 'a')
+            self._write_str(f, o.dtype.str)
+            f.write(self._count.pack(o.ndim))
+            for n in o.shape:
+                f.write(self._int.pack(n))
+            f.write(numpy.ascontiguousarray(o).data)
+            self._end(f, p)
+        elif isinstance(o, dict):
+            p = self._begin(f, 'd')
+            f.write(self._count.pack(len(o)))
+            for k,v in o.iteritems():
+                if not isinstance(k, basestring):
+                    k = str(k)
+                self._write_str(f, k)
+                self.encode(f, v)
+            self._end(f, p)
+        elif isinstance(o, (list, tuple)):
+            p = self._begin(f, 'l')
+            f.write(self._count.pack(len(o)))
+            for v in o:
+                self.encode(f, v)
+            self._end(f, p)
+        elif o is None:
+            f.write('N')
+        elif o is True:
+            f.write('T')
+        elif o is False:
+            f.write('F')
+        elif isinstance(o, (int,long)):
+            if -2**63 <= o < 2**63:
+                f.write('i')
+                f.write(self._int.pack(o))
+            else:
+                p = self._begin(f, 'I')
+                f.write(str(o))
+                self._end(f, p)
+        elif isinstance(o, float):
+            f.write('f')
+            f.write(self._float.pack(o))
+        elif isinstance(o, basestring):
+            if isinstance(o, unicode):
+                o = o.encode('utf-8')
+            p = self._begin(f, 's')
+            f.write(o)
+            self._end(f, p)
+        else:
+            if isinstance(o, numpy.ndarray):
+                o = self.serializer.serialize_numpy_ndarray(o)
+            else:
+                o = self.serializer.serialize(o)
+            self.encode(f, o)
+
+    def decode(self, b, i):
+        # Decodes the value starting at b[i]. Returns the value and the
+        # position after it.
+        t = chr(self._byte(b, i))
+        i += 1
+        if t == 'N':
+            return None,i
+        if t == 'T':
+            return True,i
+        if t == 'F':
+            return False,i
+        if t == 'i':
+            return self._int.unpack_from(b, i)[0],i+self._int.size
+        if t == 'f':
+            return self._float.unpack_from(b, i)[0],i+self._float.size
+        n, = self._len.unpack_from(b, i)
+        i += self._len.size
+        e = i + n
+        if e > len(b):
+            raise BinArchiveError('Truncated binary archive')
+        if t == 's':
+            return b[i:e].decode('utf-8'),e
+        if t == 'I':
+            return int(str(b[i:e])),e
+        if t == 'a':
+            dtype,i = self._read_str(b, i)
+            ndim, = self._count.unpack_from(b, i)
+            i += self._count.size
+            shape = []
+            for j in range(ndim):
+                shape.append(self._int.unpack_from(b, i)[0])
+                i += self._int.size
+            # bytearray makes the array writable without an additional copy
+            o = numpy.frombuffer(b, dtype=numpy.dtype(str(dtype)),
+                                 count=int(numpy.prod(shape)), offset=i)
+            if isinstance(b, mmap.mmap):
+                # The map is closed after loading
+                o = o.copy()
+            o.shape = shape
+            return o,e
+        if t == 'd':
+            d = OrderedDict()
+            for k,j in self._entries(b, i-self._len.size-1):
+                d[k],_ = self.decode(b, j)
+            return self.serializer.restore(d),e
+        if t == 'l':
+            n, = self._count.unpack_from(b, i)
+            i += self._count.size
+            l = []
+            for j in range(n):
+                v,i = self.decode(b, i)
+                l.append(v)
+            return self.serializer.restore(l),e
+        raise BinArchiveError('Unknown type tag "{}" at position {}'
+                              .format(t, i-1))
+
+    def _skip(self, b, i):
+        t = chr(self._byte(b, i))
+        if t in 'NTF':
+            return i+1
+        if t in 'if':
+            return i+9
+        n, = self._len.unpack_from(b, i+1)
+        return i + 1 + self._len.size + n
+
+    def _entries(self, b, i):
+        # Yields key and position of the value for each entry of the
+        # dictionary starting at b[i]
+        i += 1 + self._len.size
+        n, = self._count.unpack_from(b, i)
+        i += self._count.size
+        for j in range(n):
+            k,i = self._read_str(b, i)
+            yield k,i
+            i = self._skip(b, i)
+
+    def _decode_paths(self, b, i, t):
+        if t is True or self._byte(b, i) not in (ord('d'), ord('l')):
+            return self.decode(b, i)
+        e = self._skip(b, i)
+        if self._byte(b, i) == ord('l'):
+            i += 1 + self._len.size
+            n, = self._count.unpack_from(b, i)
+            i += self._count.size
+            l = []
+            for j in range(n):
+                s = path_subtree(t, j)
+                l.append(None if s is None else self._decode_paths(b, i, s)[0])
+                i = self._skip(b, i)
+            return self.serializer.restore(l),e
+        es = list(self._entries(b, i))
+        whole = ('__type__','__ref__') if self.serializer.references else ('__type__',)
+        if any(k in whole for k,j in es):
+            return self.decode(b, i)
+        d = OrderedDict()
+        for k,j in es:
+            s = path_subtree(t, k)
+            if s is not None:
+                d[k] = self._decode_paths(b, j, s)[0]
+        return self.serializer.restore(d),e
+
+class CompressedArchive(object):
+    """A JSON or XML archive in a compressed file.
+
+    Wraps `archive`, a JsonArchive or XMLArchive, and (de)compresses files on
+    the fly with the stdlib's gzip, bz2 or lzma module (`compression` is 'gz',
+    'bz2' or 'xz'). The compression level is configured with the
+    archive_compression_level config option; by default, each module's own
+    default is used (9 for gzip and bz2, 6 for xz). The xz compression
+    requires the lzma module, which on Python 2 is provided by backports.lzma.
+    """
+    def __init__(self, archive, compression, config=None):
+        if compression == 'xz' and lzma is None:
+            raise ArchiveError('The xz compression requires the lzma module')
+        _level = None
+        if config is not None:
+            if config.has_key('archive_compression_level'):
+                _level = config['archive_compression_level']
+
+        self.archive = archive
+        self.compression = compression
+        self.level = _level
+
+    @property
+    def serializer(self):
+        return self.archive.serializer
+
+    def dumpfile(self, o, filename):
+        f = self.open(filename, 'wb')
+        try:
+            self.archive.dump(o, f)
+        finally:
+            f.close()
+
+    def loadfile(self, filename, paths=None):
+        f = self.open(filename, 'rb')
+        try:
+            return self.archive.load(f, paths)
+        finally:
+            f.close()
+
+    def loadfile_entry(self, filename, key):
+        f = self.open(filename, 'rb')
+        try:
+            return self.archive.load_entry(f, key)
+        finally:
+            f.close()
+
+    def open(self, filename, mode):
+        if self.compression == 'gz':
+            if self.level is None:
+                return gzip.GzipFile(filename, mode)
+            return gzip.GzipFile(filename, mode, self.level)
+        elif self.compression == 'bz2':
+            if self.level is None:
+                return bz2.BZ2File(filename, mode)
+            return bz2.BZ2File(filename, mode, compresslevel=self.level)
+        elif self.compression == 'xz':
+            if self.level is None or mode.startswith('r'):
+                return lzma.LZMAFile(filename, mode)
+            return lzma.LZMAFile(filename, mode, preset=self.level)
+        raise ArchiveError('Unsupported compression: {}'.format(self.compression))
+
 class ArchiveError(Exception):
     pass
 
 class Archive(object):
-    formats = ['json','xml']
-    classes = {'json': JsonArchive, 'xml': XMLArchive}
+    formats = ['json','xml','h5','bin',
+               'json.gz','json.bz2','json.xz','xml.gz','xml.bz2','xml.xz']
+    classes = {'json': JsonArchive, 'xml': XMLArchive, 'h5': H5Archive,
+               'bin': BinArchive}
+    compressions = ['gz','bz2','xz']
 
     def __init__(self, filename, archive_name, pretty_print=None, indent=None,
                  default_format=None, config=None):
@@ -377,20 +1959,60 @@ class Archive(object):
 
     def save(self, o, format=None):
         if format is None or format == self.format:
-            self._a.dumpfile(o, self.filename)
-            return
-        filename = self.basename + '.' + format
-        a = self._archive_factory(format)
+            a = self._a
+            filename = self.filename
+        else:
+            a = self._archive_factory(format)
+            filename = self.basename + '.' + format
+        if a.serializer.columns or a.serializer.references:
+            o = RecursiveSerializer(serializer=a.serializer,
+                                    serialize_ndarrays=False).serialize(o)
         a.dumpfile(o, filename)
 
-    def load(self):
-        return self._a.loadfile(self.filename)
+    def load(self, paths=None):
+        """Load the archive.
+
+        If `paths` is given, only the parts of the archive that are needed to
+        access these paths (see coma.path) are loaded and the rest is skipped.
+        With serializer_references, if a shared object is referenced at one of
+        the paths, but stored outside of them, the whole archive is loaded.
+        """
+        o = self._a.loadfile(self.filename, paths)
+        if paths is not None and self.serializer.unresolved:
+            o = self._a.loadfile(self.filename)
+        return o
+
+    def load_entry(self, key):
+        """Load only the top-level entry `key` of the archive.
+
+        Depending on the format, this avoids reading the whole file.
+        """
+        o = self._a.loadfile_entry(self.filename, key)
+        if self.serializer.unresolved:
+            o = self._a.loadfile(self.filename)
+            if not isinstance(o, dict) or not o.has_key(key):
+                raise KeyError(key)
+            o = o[key]
+        return o
+
+    @property
+    def serializer(self):
+        return self._a.serializer
 
     def _archive_factory(self, format):
+        # Compound formats like 'json.gz' are compressed archives
+        compression = None
+        if format not in self.formats:
+            raise ArchiveError('Unsupported archive format: {}'.format(format))
+        if '.' in format:
+            format,compression = format.split('.')
         if not self.classes.has_key(format):
             raise ArchiveError('Unsupported archive format: {}'.format(format))
         A = self.classes[format]
-        return A(self.name, self.pretty_print, self.indent, config=self.config)
+        a = A(self.name, self.pretty_print, self.indent, config=self.config)
+        if compression is not None:
+            a = CompressedArchive(a, compression, config=self.config)
+        return a
     
     def _basename_and_format(self, filename):
         # If filename ends with a supported format, return basename and format
@@ -420,3 +2042,24 @@ def archive_exists(filename):
         if os.path.exists(filename + '.' + f):
             return True
     return False
+
+def convert_archive(filename, archive_name, format, config=None, remove=False):
+    """Convert an existing archive to another format.
+
+    `filename` may or may not include the extension. Arrays stored in .npy
+    sidecar files (see NpySidecar) are loaded as well and written into the new
+    archive. If `remove` is True, the original archive and its sidecar files
+    are deleted afterwards. Returns the filename of the new archive.
+    """
+    a = Archive(filename, archive_name, config=config)
+    if a.format == format:
+        return a.filename
+    sidecar = NpySidecar(a.basename)
+    a.serializer.sidecar = sidecar
+    o = a.load()
+    b = Archive(a.basename + '.' + format, archive_name, config=config)
+    b.save(o)
+    if remove:
+        os.remove(a.filename)
+        sidecar.remove()
+    return b.filename
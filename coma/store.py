@@ -0,0 +1,180 @@
+# Copyright (c) 2014, Burkhard Ritter
+# This code is distributed under the two-clause BSD License.
+
+import os
+from collections import OrderedDict
+import numpy as np
+from .measurement import FileMeasurement
+from .serialization import JsonArchive
+
+_TYPED = (bool, int, float, str, unicode)
+
+def _path_string(p):
+    return p if isinstance(p, basestring) else '/'.join(str(s) for s in p)
+
+def _column(vs):
+    # A typed array if all values are scalars of the same type, otherwise None
+    ts = set(type(v) for v in vs)
+    if len(ts) == 0:
+        return np.array([])
+    if len(ts) == 1 and ts.pop() in _TYPED:
+        a = np.array(vs)
+        if a.ndim == 1 and a.dtype.kind in 'biufSU':
+            return a
+    return None
+
+class StoredMeasurement(object):
+    """A measurement's values at the paths of a MeasurementStore."""
+    def __init__(self, id, values):
+        self.id = id
+        self.values = values
+
+    def __getitem__(self, path):
+        return self.values[_path_string(path)]
+
+class MeasurementStore(object):
+    """A consolidated, columnar copy of some paths of all measurements.
+
+    The store is a single numpy .npz file, by default "measurement.store.npz"
+    in the experiment directory. For each path it holds one array with the
+    values of all measurements that have the path, and a mask of the
+    measurements that have it. The array is typed if the values are scalars
+    of the same type; otherwise it holds the values as JSON strings, so that
+    the store never needs to be unpickled.
+    For each measurement it records the id, filename, modification time and
+    size, so that measurements whose files changed since the store was
+    written are recognized and read from their files instead.
+
+    The store is written by `write` (Experiment.consolidate) and is never
+    updated otherwise.
+    """
+    def __init__(self, filename, config=None):
+        self.filename = filename
+        self.config = config
+        self._data = None
+        self._stat = None
+
+    def exists(self):
+        return os.path.exists(self.filename)
+
+    def write(self, files, paths):
+        """Consolidate the values at `paths` of all measurements.
+
+        `files` is a list of (measurement id, filename) tuples of all existing
+        measurements.
+        """
+        paths = [_path_string(p) for p in paths]
+        files = sorted(files)
+        ids,fs,mtimes,sizes = [],[],[],[]
+        vs = [[] for p in paths]
+        present = [[] for p in paths]
+        for mid,f in files:
+            st = os.stat(f)
+            m = FileMeasurement(f, mid, config=self.config, paths=paths)
+            for i,p in enumerate(paths):
+                try:
+                    vs[i].append(m[p])
+                    present[i].append(True)
+                except KeyError:
+                    present[i].append(False)
+            ids.append(mid)
+            fs.append(os.path.basename(f))
+            mtimes.append(st.st_mtime)
+            sizes.append(st.st_size)
+
+        a = self._archive()
+        d = {}
+        d['ids'] = np.array(ids, dtype=np.int64)
+        d['files'] = np.array(fs, dtype=np.unicode_)
+        d['mtimes'] = np.array(mtimes, dtype=np.float64)
+        d['sizes'] = np.array(sizes, dtype=np.int64)
+        d['paths'] = np.array(paths, dtype=np.unicode_)
+        encoded = []
+        for i in range(len(paths)):
+            c = _column(vs[i])
+            encoded.append(c is None)
+            if c is None:
+                c = np.array([a.dumps(v) for v in vs[i]])
+            d['values_{}'.format(i)] = c
+            d['present_{}'.format(i)] = np.array(present[i], dtype=bool)
+        d['encoded'] = np.array(encoded, dtype=bool)
+
+        # Write to a temporary file first, so that readers never see a
+        # partially written store
+        tmp = self.filename + '.tmp'
+        f = open(tmp, 'wb')
+        try:
+            np.savez(f, **d)
+        finally:
+            f.close()
+        os.rename(tmp, self.filename)
+        self._data = None
+
+    def paths(self):
+        if not self.exists():
+            return []
+        return self._load()['paths']
+
+    def covers(self, paths):
+        """Whether the store exists and holds all of `paths`."""
+        if not self.exists():
+            return False
+        ps = self.paths()
+        return all(_path_string(p) in ps for p in paths)
+
+    def measurements(self, files, paths=None):
+        """Iterate over all measurements, ordered by id.
+
+        `files` is a list of (measurement id, filename) tuples of all existing
+        measurements. Measurements that are unchanged since the store was
+        written are StoredMeasurements, all others are FileMeasurements that
+        are partially loaded with `paths`.
+        """
+        d = self._load()
+        for mid,f in sorted(files):
+            r = d['measurements'].get(mid)
+            if r is not None:
+                st = os.stat(f)
+                if r[0] == (os.path.basename(f), st.st_mtime, st.st_size):
+                    yield StoredMeasurement(mid, r[1])
+                    continue
+            yield FileMeasurement(f, mid, config=self.config, paths=paths)
+
+    def remove(self):
+        self._data = None
+        if self.exists():
+            os.remove(self.filename)
+
+    def _load(self):
+        # The decoded store is kept as long as the file does not change
+        st = os.stat(self.filename)
+        stat = (st.st_mtime, st.st_size)
+        if self._data is not None and self._stat == stat:
+            return self._data
+        z = np.load(self.filename, allow_pickle=False)
+        a = self._archive()
+        try:
+            paths = z['paths'].tolist()
+            encoded = z['encoded'].tolist()
+            ms = OrderedDict()
+            stats = zip(z['files'].tolist(), z['mtimes'].tolist(),
+                        z['sizes'].tolist())
+            for mid,s in zip(z['ids'].tolist(), stats):
+                ms[mid] = (s, {})
+            mids = ms.keys()
+            for i,p in enumerate(paths):
+                vs = z['values_{}'.format(i)].tolist()
+                if encoded[i]:
+                    vs = [a.loads(v) for v in vs]
+                vs = iter(vs)
+                for mid,b in zip(mids, z['present_{}'.format(i)].tolist()):
+                    if b:
+                        ms[mid][1][p] = next(vs)
+        finally:
+            z.close()
+        self._data = {'paths': paths, 'measurements': ms}
+        self._stat = stat
+        return self._data
+
+    def _archive(self):
+        return JsonArchive(None, pretty_print=False, config=self.config)
@@ -5,3 +5,4 @@ from .test_serialization import *
 from .test_experiment import *
 from .test_measurement import *
 from .test_config import *
+from .test_indexfile import *
@@ -4,7 +4,11 @@
 import unittest
 import os
 import shutil
-from coma import expand_path, load_config, create_config_file
+import numpy
+from coma import expand_path, load_config, create_config_file, NpySidecar
+from coma import H5Archive
+from coma.config import DEFAULT_CONFIG_FILE
+from coma.serialization import h5py, JsonArchive, CompressedArchive
 
 _CONFIG_FILE_1='''\
 [coma]
@@ -42,7 +46,7 @@ class TestConfig(unittest.TestCase):
         f = open('__pref.conf')
         ls = f.readlines()
         f.close()
-        self.assertEqual(len(ls), 9)
+        self.assertEqual(len(ls), 26)
 
         create_config_file('__pref.conf')
         # should print a message
@@ -74,6 +78,21 @@ class TestConfig(unittest.TestCase):
         os.remove('__pref1.conf')
         os.remove('__pref2.conf')
 
+    def test_default_config_file_shows_the_defaults(self):
+        f = open('__pref.conf', 'w')
+        f.write(DEFAULT_CONFIG_FILE.replace('; ', ''))
+        f.close()
+        c = load_config('__pref.conf')
+        os.remove('__pref.conf')
+        self.assertEqual(c['measurement_sidecar_threshold'], None)
+        s = NpySidecar('m', config=c)
+        self.assertFalse(s.accepts(numpy.zeros(10**6)))
+        a = CompressedArchive(JsonArchive('m'), 'gz', config=c)
+        self.assertEqual(a.level, None)
+        if h5py is not None:
+            a = H5Archive('m', config=c)
+            self.assertEqual((a.compression, a.compression_level), (None, None))
+
     def test_load_nonexistent_config_file(self):
         c = load_config('muh')
         self.assertEqual(c, {})
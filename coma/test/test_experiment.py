@@ -9,8 +9,18 @@ import copy
 import glob
 import filecmp
 import pickle
+import sys
+from StringIO import StringIO
+import multiprocessing
+import numpy
 from coma import Experiment, ExperimentError, IndexFile, ParameterSet, \
-                 ResultList, Result, Archive, expand_path, load_config
+                 ResultList, Result, Archive, expand_path, load_config, \
+                 ProcessPoolExperiment, ParallelExperiment, FileMeasurement, \
+                 convert_archive
+from coma import parallelexperiment
+from coma.store import StoredMeasurement
+from coma.experiment import _typed_table
+from coma.serialization import h5py
 
 _CONFIG_FILE_1='''\
 [coma]
@@ -831,6 +841,80 @@ class ExampleSimulation(object):
         i['results'] = self.results
         return i
 
+def retrieve_results_in_daemon(args):
+    d,c = args
+    e = Experiment(d, config=c)
+    rs = e.retrieve_results((('V1','parameters/layout/V1'),), workers=2)
+    return rs[0].table.tolist()
+
+def run_example_simulation(p):
+    # Top level, so that it can be pickled for ProcessPoolExperiment
+    s = ExampleSimulation()
+    s.t = p.t
+    s.V1 = p.V1
+    s.init()
+    s.run()
+    return s
+
+class FakeAsyncResult(object):
+    def __init__(self, msg_id, value, error):
+        self.msg_ids = [msg_id]
+        self.value = value
+        self.error = error
+
+    def successful(self):
+        return self.error is None
+
+    def get(self):
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+class FakeView(object):
+    def __init__(self, client):
+        self.client = client
+
+    def apply(self, function, *args):
+        value,error = None,None
+        try:
+            value = function(*args)
+        except Exception as e:
+            error = e
+        i = 'msg{}'.format(len(self.client.submitted))
+        self.client.submitted.append(i)
+        self.client.pending[i] = value
+        return FakeAsyncResult(i, value, error)
+
+class FakeClient(object):
+    """Stands in for IPython.parallel.Client. Tasks complete two at a time, in
+    reverse order of submission."""
+    def __init__(self, profile='default'):
+        self.submitted = []
+        self.pending = OrderedDict()
+        self.results = {}
+        self.metadata = {}
+        self.spins = 0
+
+    def load_balanced_view(self):
+        return FakeView(self)
+
+    def spin(self):
+        self.spins += 1
+        for i in self.pending.keys()[-2:][::-1]:
+            self.results[i] = self.pending.pop(i)
+            self.metadata[i] = {}
+
+def run_with_shared_layout(p):
+    layout = OrderedDict([('V1', p.V1), ('N', 2)])
+    return OrderedDict([
+        ('parameters', OrderedDict([('t', p.t), ('layout', layout)])),
+        ('results', OrderedDict([('layout', layout), ('E', p.V1*2)]))])
+
+def run_example_simulation_or_fail(p):
+    if p.V1 % 3 == 0:
+        raise ValueError('Failed for V1={}'.format(p.V1))
+    return run_example_simulation(p)
+
 class TestExperiment(object):
     def setUp(self):
         base_dir = os.path.dirname(__file__)
@@ -1538,6 +1622,141 @@ class TestExperiment(object):
             self.assertEqual(p[1], i%100+100)
             i += 1
 
+    def test_existing_parameter_sets_are_retrieved_from_the_catalog(self):
+        e = Experiment(self.d,config=self.c)
+        e.define_parameter_set(('t','parameters/t'),('V1','parameters/layout/V1'))
+        for V1 in range(100,110):
+            e.add_parameter_set(1,V1)
+
+        def run_measurement(p):
+            s = ExampleSimulation()
+            s.t = p.t
+            s.V1 = p.V1
+            return s
+
+        self.assertEqual(e.run(run_measurement), (10,10))
+        self.assertTrue(os.path.exists(os.path.join(self.d, 'measurement.catalog')))
+        vs = e.catalog.values(['parameters/t','parameters/layout/V1'])
+        self.assertEqual(vs, [(i+1,(1,100+i)) for i in range(10)])
+        self.assertEqual(e.catalog.values([]), [(i+1,()) for i in range(10)])
+        self.assertEqual(e.catalog.values(['parameters/muh']), [])
+        vs = e.catalog.values(['parameters/layout/V1','parameters/t','parameters/layout/V1'])
+        self.assertEqual(vs, [(i+1,(100+i,1,100+i)) for i in range(10)])
+
+        # A definition that repeats a path still finds the existing sets
+        e2 = Experiment(self.d,config=self.c)
+        e2.define_parameter_set(('t','parameters/t'),('V1','parameters/layout/V1'),
+                                ('V','parameters/layout/V1'))
+        for V1 in range(100,110):
+            e2.add_parameter_set(1,V1,V1)
+        self.assertEqual(len(e2._get_existing_psets()), 10)
+        self.assertEqual(e2.run(run_measurement), (0,10))
+
+        # Modify a measurement behind coma's back
+        f = self.filename('measurement.000003')
+        a = Archive(f, 'measurement')
+        o = a.load()
+        o['parameters']['layout']['V1'] = 500
+        a.save(o)
+        os.remove(self.filename('measurement.000005'))
+
+        self.assertEqual(e.run(run_measurement), (2,10))
+        self.assertEqual(e.number_of_measurements(), 11)
+        vs = dict(e.catalog.values(['parameters/layout/V1']))
+        self.assertEqual(vs[3], (500,))
+        self.assertFalse(vs.has_key(5))
+        self.assertEqual(sorted(vs.values()), [(V1,) for V1 in range(100,110) + [500]])
+
+        # A new experiment object uses the existing catalog
+        e = Experiment(self.d,config=self.c)
+        e.define_parameter_set(('t','parameters/t'),('V1','parameters/layout/V1'))
+        self.assertEqual(len(e._get_existing_psets()), 11)
+
+        e.reset()
+        self.assertEqual(e.catalog.values(['parameters/t']), [])
+        e.deactivate()
+        self.assertFalse(os.path.exists(os.path.join(self.d, 'measurement.catalog')))
+
+    def test_aborted_run_releases_reserved_measurement_ids(self):
+        e = Experiment(self.d,config=self.c)
+        e.define_parameter_set(('t','parameters/t'),('V1','parameters/layout/V1'))
+        for V1 in range(100,110):
+            e.add_parameter_set(1,V1)
+
+        def run_measurement(p):
+            if p.V1 == 104:
+                raise ValueError()
+            s = ExampleSimulation()
+            s.t = p.t
+            s.V1 = p.V1
+            return s
+
+        with self.assertRaises(ValueError):
+            e.run(run_measurement)
+        self.assertEqual(e.number_of_measurements(), 4)
+        self.assertEqual(e.mindex.get(), 5)
+        self.assertEqual(len(e._reserved_mids), 0)
+
+        self.assertEqual(e.new_measurement().id, 6)
+
+    def test_run_measurements_with_an_ipython_client(self):
+        Client = parallelexperiment.Client
+        parallelexperiment.Client = FakeClient
+        stdout,stderr = sys.stdout,sys.stderr
+        try:
+            e = ParallelExperiment(self.d,config=self.c)
+            e.poll_interval = 0
+            e.define_parameter_set(('t','parameters/t'),('V1','parameters/layout/V1'))
+            for V1 in range(100,110):
+                e.add_parameter_set(1,V1)
+            sys.stdout = sys.stderr = StringIO()
+            self.assertEqual(e.run(run_example_simulation_or_fail), (10,10))
+            out = sys.stdout.getvalue()
+        finally:
+            sys.stdout,sys.stderr = stdout,stderr
+            parallelexperiment.Client = Client
+
+        # Tasks completed out of order, but each result was saved as the
+        # measurement it was submitted for
+        self.assertTrue(e.pclient.spins > 1)
+        vs = [(m.id, m['parameters/layout/V1']) for m in e.measurements()]
+        self.assertEqual(vs, [(V1-99, V1) for V1 in range(100,110) if V1 % 3 != 0])
+        for V1 in [102,105,108]:
+            self.assertTrue('Measurement {} was not successful'.format(V1-99) in out)
+            self.assertTrue('Failed for V1={}'.format(V1) in out)
+        self.assertEqual(e.tasks, {})
+        self.assertEqual(e.pclient.results, {})
+        self.assertEqual(e.pclient.metadata, {})
+
+    def test_run_with_shared_objects(self):
+        c = dict(self.c, serializer_references=True)
+        e = Experiment(self.d,config=c)
+        e.define_parameter_set(('t','parameters/t'),('V1','parameters/layout/V1'))
+        for V1 in range(100,103):
+            e.add_parameter_set(1,V1)
+        self.assertEqual(e.run(run_with_shared_layout), (3,3))
+        self.assertEqual(e.run(run_with_shared_layout), (0,3))
+        self.assertEqual(e.number_of_measurements(), 3)
+        rs = e.retrieve_results((('V1','results/layout/V1'),('E','results/E')),
+                                (('t','parameters/t'),))
+        self.assertEqual(rs[0].table.tolist(), [[100,200],[101,202],[102,204]])
+
+    def test_run_measurements_in_a_process_pool(self):
+        e = ProcessPoolExperiment(self.d,config=self.c,processes=2)
+        e.define_parameter_set(('t','parameters/t'),('V1','parameters/layout/V1'))
+        for V1 in range(100,120):
+            e.add_parameter_set(1,V1)
+
+        self.assertEqual(e.run(run_example_simulation), (20,20))
+        self.assertEqual(e.number_of_measurements(), 20)
+        ps = sorted(m['parameters/layout/V1'] for m in e.measurements())
+        self.assertEqual(ps, range(100,120))
+
+        for V1 in range(120,125):
+            e.add_parameter_set(1,V1)
+        self.assertEqual(e.run(run_example_simulation), (5,25))
+        self.assertEqual(e.number_of_measurements(), 25)
+
     def create_example_result_list(self):
         d1 = OrderedDict([('t','parameters/t'),('V1','parameters/layout/V1')])
         d2 = OrderedDict([('t','parameters/t'),('V1','parameters/layout/V1'),('a','parameters/a')])
@@ -1733,6 +1952,271 @@ class TestExperiment(object):
             self.assertEqual(r.table[i,0], 100+i%10)
             self.assertEqual(r.table[i,1], (100+i%10)*10)
 
+    def test_retrieve_results_from_consolidated_store(self):
+        self.run_example_experiment_2()
+        e = Experiment(self.d, config=self.c)
+        self.assertFalse(e.store.covers([]))
+        self.assertEqual(e.retrieve_results(())[0].table.shape, (180,0))
+        tdef = (('V1','parameters/layout/V1'),('P','results/P'),
+                ('NL','results/NestedList'),('N','results/N'))
+        pdef = (('t','parameters/t'),('N','parameters/layout/N'),
+                ('a','parameters/a'))
+        paths = [p for n,p in tdef + pdef]
+
+        def check(rs1, rs2):
+            self.assertEqual(len(rs1), len(rs2))
+            for r1,r2 in zip(rs1, rs2):
+                self.assertEqual(r1.parameters.ps, r2.parameters.ps)
+                self.assertEqual(r1.table_columns, r2.table_columns)
+                self.assertEqual(r1.measurement_ids, r2.measurement_ids)
+                self.assertEqual(r1.table.dtype, r2.table.dtype)
+                self.assertEqual(r1.table.tolist(), r2.table.tolist())
+
+        rs = e.retrieve_results(tdef, pdef)
+        rs_sub = e.retrieve_results(tdef[:2], pdef[:2])
+        e.consolidate(paths + ['parameters/muh'])
+        self.assertTrue(os.path.exists(os.path.join(self.d, 'measurement.store.npz')))
+        self.assertTrue(e.store.covers(paths))
+        ms = list(e.store.measurements(e._measurement_files(), paths))
+        self.assertEqual([m.id for m in ms], range(1,181))
+        self.assertTrue(all(isinstance(m, StoredMeasurement) for m in ms))
+        check(rs, e.retrieve_results(tdef, pdef))
+        check(rs_sub, e.retrieve_results(tdef[:2], pdef[:2]))
+
+        # Measurements that changed are read from their files
+        f = self.filename('measurement.000013')
+        a = Archive(f, 'measurement')
+        o = a.load()
+        o['parameters']['layout']['V1'] = 500
+        a.save(o)
+        os.remove(self.filename('measurement.000015'))
+        ms = list(e.store.measurements(e._measurement_files(), paths))
+        self.assertEqual(len(ms), 179)
+        self.assertTrue(isinstance(ms[12], FileMeasurement))
+        self.assertEqual(ms[12]['parameters/layout/V1'], 500)
+        rs = e.retrieve_results(tdef, pdef)
+        self.assertEqual(rs[0].measurement_ids[:5], [11,12,13,14,16])
+        self.assertEqual(rs[0].table[2,0], 500)
+
+        # Paths that are not in the store are read from the files
+        rs2 = e.retrieve_results(tdef + (('x','parameters/layout/boa'),), pdef)
+        self.assertEqual(rs2[0].table[2,0], 500)
+        self.assertEqual(rs2[0].table_columns[-1], 'x')
+
+        e.consolidate(paths)
+        self.assertTrue(isinstance(list(e.store.measurements(
+            e._measurement_files(), paths))[12], StoredMeasurement))
+        check(rs, e.retrieve_results(tdef, pdef))
+
+        e.reset()
+        self.assertFalse(e.store.exists())
+        self.assertEqual(len(e.retrieve_results(tdef, pdef)), 0)
+
+    def test_measurements_in_several_formats_are_used_once(self):
+        self.run_example_experiment_2()
+        e = Experiment(self.d, config=self.c)
+        fmt = 'json' if self.format != 'json' else 'xml'
+        convert_archive(self.filename('measurement.000002'), 'measurement', fmt)
+        fs = e._measurement_files()
+        self.assertEqual([mid for mid,f in fs], range(1,181))
+        first = min(Archive.formats.index(self.format), Archive.formats.index(fmt))
+        self.assertTrue(dict(fs)[2].endswith('.' + Archive.formats[first]))
+
+        e.consolidate(['parameters/layout/V1','results/NestedList'])
+        ms = list(e.store.measurements(fs))
+        self.assertEqual([m.id for m in ms], range(1,181))
+        m = FileMeasurement(dict(fs)[2])
+        self.assertEqual(ms[1]['results/NestedList'], m['results/NestedList'])
+
+    def test_retrieve_results_only_reads_new_and_changed_measurements(self):
+        self.run_example_experiment_2()
+        e = Experiment(self.d, config=dict(self.c, experiment_result_cache=True))
+        tdef = (('V1','parameters/layout/V1'),('P','results/P'),
+                ('NL','results/NestedList'))
+        pdef = (('t','parameters/t'),('N','parameters/layout/N'),
+                ('a','parameters/a'))
+
+        loaded = []
+        load = FileMeasurement.load
+        def counting_load(m):
+            loaded.append(m.id)
+            load(m)
+        FileMeasurement.load = counting_load
+        try:
+            rs = e.retrieve_results(tdef, pdef)
+            self.assertEqual(len(loaded), 180)
+            cache = os.path.join(self.d, 'measurement.results')
+            self.assertEqual(len(os.listdir(cache)), 1)
+
+            del loaded[:]
+            rs2 = e.retrieve_results(tdef, pdef)
+            self.assertEqual(loaded, [])
+            self.assertEqual([r.measurement_ids for r in rs2],
+                             [r.measurement_ids for r in rs])
+            self.assertEqual([r.table.tolist() for r in rs2],
+                             [r.table.tolist() for r in rs])
+            self.assertEqual([r.table_columns for r in rs2],
+                             [r.table_columns for r in rs])
+
+            # A different definition has its own cache
+            e.retrieve_results(tdef[:1], pdef[:1])
+            self.assertEqual(len(loaded), 180)
+            self.assertEqual(len(os.listdir(cache)), 2)
+
+            # Modify a measurement, remove one and add new ones
+            f = self.filename('measurement.000013')
+            a = Archive(f, 'measurement')
+            o = a.load()
+            o['parameters']['layout']['V1'] = 500
+            a.save(o)
+            os.remove(self.filename('measurement.000015'))
+            e.define_parameter_set(('t','parameters/t'),('V1','parameters/layout/V1'))
+            e.clear_parameter_sets()
+            e.add_parameter_set(3,100)
+            e.run(run_example_simulation)
+            del loaded[:]
+            rs = e.retrieve_results(tdef, pdef)
+            self.assertEqual(sorted(loaded), [13,181])
+            r = rs['t',1]['N',2]['a',20][0]
+            self.assertEqual(r.measurement_ids[:5], [11,12,13,14,16])
+            self.assertEqual(r.table[2,0], 500)
+        finally:
+            FileMeasurement.load = load
+
+        # The cached results are the same as freshly retrieved ones
+        shutil.rmtree(cache)
+        rs2 = e.retrieve_results(tdef, pdef)
+        self.assertEqual([r.parameters.ps for r in rs2],
+                         [r.parameters.ps for r in rs])
+        self.assertEqual([r.table.tolist() for r in rs2],
+                         [r.table.tolist() for r in rs])
+
+        e.reset()
+        self.assertFalse(os.path.exists(cache))
+
+    def test_result_cache_is_optional_and_may_fail(self):
+        self.run_example_experiment_2()
+        tdef = (('V1','parameters/layout/V1'),('P','results/P'))
+        pdef = (('t','parameters/t'),('N','parameters/layout/N'))
+        cache = os.path.join(self.d, 'measurement.results')
+
+        rs = Experiment(self.d, config=self.c).retrieve_results(tdef, pdef)
+        self.assertFalse(os.path.exists(cache))
+
+        # The cache can't be written, e.g. in a read-only directory
+        open(cache, 'w').close()
+        e = Experiment(self.d, config=dict(self.c, experiment_result_cache=True))
+        rs2 = e.retrieve_results(tdef, pdef)
+        self.assertEqual([r.table.tolist() for r in rs2],
+                         [r.table.tolist() for r in rs])
+        self.assertEqual(os.path.getsize(cache), 0)
+
+        # Cache files that can't be decoded are ignored
+        os.remove(cache)
+        e.retrieve_results(tdef, pdef)
+        f = os.path.join(cache, os.listdir(cache)[0])
+        self.assertTrue(f.endswith('.json'))
+        for content in [open(f).read()[:100], '{"key": 1}', 'cos\nsystem\n']:
+            with open(f, 'w') as fp:
+                fp.write(content)
+            rs2 = e.retrieve_results(tdef, pdef)
+            self.assertEqual([r.table.tolist() for r in rs2],
+                             [r.table.tolist() for r in rs])
+
+    def test_retrieve_results_with_workers(self):
+        self.run_example_experiment_2()
+        tdef = (('V1','parameters/layout/V1'),('P','results/P'),
+                ('NL','results/NestedList'),('N','results/N'))
+        pdef = (('t','parameters/t'),('N','parameters/layout/N'),
+                ('a','parameters/a'))
+        cache = os.path.join(self.d, 'measurement.results')
+
+        def results(e, workers):
+            if os.path.exists(cache):
+                shutil.rmtree(cache)
+            rs = e.retrieve_results(tdef, pdef, workers=workers)
+            return [(r.parameters.ps, r.table_columns, r.measurement_ids,
+                     r.table.dtype, r.table.tolist()) for r in rs]
+
+        e = Experiment(self.d, config=self.c)
+        rs = results(e, None)
+        self.assertEqual(len(rs), 12)
+        self.assertEqual(results(e, 3), rs)
+        c = dict(self.c, experiment_load_workers=2)
+        self.assertEqual(results(Experiment(self.d, config=c), None), rs)
+
+        e.define_parameter_set(('t','parameters/t'),('V1','parameters/layout/V1'))
+        ps = e._get_existing_psets()
+        e.catalog.remove()
+        self.assertEqual(e._get_existing_psets(workers=3), ps)
+        self.assertEqual(len(ps), 180)
+
+        # Workers of a process pool can't start processes of their own
+        pool = multiprocessing.Pool(1)
+        try:
+            t = pool.map(retrieve_results_in_daemon, [(self.d, self.c)])[0]
+        finally:
+            pool.terminate()
+            pool.join()
+        self.assertEqual(t, e.retrieve_results((('V1','parameters/layout/V1'),))[0].table.tolist())
+
+    def test_retrieve_results_as_typed_tables(self):
+        self.run_example_experiment_2()
+        e = Experiment(self.d, config=self.c)
+        tdef = (('V1','parameters/layout/V1'),('P','results/P'),
+                ('N','results/N'))
+        pdef = (('t','parameters/t'),('N','parameters/layout/N'))
+        rs = e.retrieve_results(tdef, pdef)
+        rs1 = e.retrieve_results(tdef, pdef, table_format='records')
+        rs2 = e.retrieve_results(tdef, pdef, table_format='columns')
+        for r,r1,r2 in zip(rs, rs1, rs2):
+            self.assertEqual(r1.table.dtype.names, r.table_columns)
+            self.assertEqual(tuple(r2.table.keys()), r.table_columns)
+            self.assertEqual(r1.table.shape, (30,))
+            for j,c in enumerate(r.table_columns):
+                self.assertEqual(r1.table[c].tolist(), r.table[:,j].tolist())
+                self.assertEqual(r2.table[c].tolist(), r.table[:,j].tolist())
+            self.assertEqual(r1.table['V1'].dtype, numpy.int64)
+            self.assertEqual(r1.table['P_1'].dtype, numpy.int64)
+            self.assertEqual(r1.table['N'].dtype, object)
+            self.assertTrue(isinstance(r1.table.N[0], OrderedDict))
+
+        with self.assertRaises(ExperimentError):
+            e.retrieve_results(tdef, pdef, table_format='muh')
+
+    def test_typed_tables_infer_a_dtype_per_column(self):
+        e = Experiment(self.d, config=self.c)
+        e.define_parameter_set(('i','i'))
+        for i in range(3):
+            e.add_parameter_set(i)
+        def run_measurement(p):
+            return OrderedDict([
+                ('i', p.i),
+                ('x', [0.5, 1][p.i%2]),
+                ('s', 'a'*(p.i+1)),
+                ('l', 2**70 if p.i == 2 else 1),
+                ('m', [1, 'a', None][p.i])])
+        e.run(run_measurement)
+        tdef = [(k,k) for k in ['i','x','s','l','m']]
+        r = e.retrieve_results(tdef, table_format='records')[0]
+        self.assertEqual([r.table.dtype[k] for k in r.table_columns],
+                         [numpy.dtype(numpy.int64), numpy.dtype(float),
+                          numpy.dtype('S3'), numpy.dtype(object),
+                          numpy.dtype(object)])
+        self.assertEqual(r.table.i.tolist(), [0,1,2])
+        self.assertEqual(r.table.x.tolist(), [0.5,1.0,0.5])
+        self.assertEqual(r.table.s.tolist(), ['a','aa','aaa'])
+        self.assertEqual(r.table.l.tolist(), [1,1,2**70])
+        self.assertEqual(r.table.m.tolist(), [1,'a',None])
+
+        t = _typed_table([[u'\xe4',1.5,True], ['bc',2,False]], ('u','x','b'),
+                         'columns')
+        self.assertEqual(t['u'].dtype, numpy.dtype('U2'))
+        self.assertEqual(t['u'].tolist(), [u'\xe4',u'bc'])
+        self.assertEqual(t['x'].tolist(), [1.5,2.0])
+        self.assertEqual(t['b'].dtype, numpy.dtype(bool))
+        self.assertEqual(t['b'].tolist(), [True,False])
+
     def test_retrieve_results_with_tuple_as_parameter(self):
         self.run_example_experiment_2()
         e = Experiment(self.d, config=self.c)
@@ -1980,6 +2464,51 @@ class TestExperiment(object):
         self.assertTrue(i, 10)
         self.assertTrue(filecmp.cmp(fn1,fn2,shallow=False))
 
+    def test_activate_deactivate_and_reset_experiment_with_sidecar_files(self):
+        c = copy.copy(self.c)
+        c['measurement_sidecar_threshold'] = 100
+        e = Experiment(self.d, config=c)
+        e.define_parameter_set(('t','parameters/t'))
+        for t in range(3):
+            e.add_parameter_set(t)
+
+        def run_measurement(p):
+            s = ExampleSimulation()
+            s.t = p.t
+            s.results['wavefunction'] = numpy.ones((20,20)) * p.t
+            s.results['energy'] = numpy.array([p.t])
+            return s
+
+        e.run(run_measurement)
+        sidecars = [os.path.join(self.d, 'measurement.{:06d}.0.npy'.format(i))
+                    for i in range(1,4)]
+        for f in sidecars:
+            self.assertTrue(os.path.exists(f))
+        for m in e.measurements():
+            w = m['results/wavefunction']
+            self.assertTrue(isinstance(w, numpy.memmap))
+            self.assertTrue((w == m['parameters/t']).all())
+
+        e.deactivate()
+        for f in sidecars:
+            self.assertFalse(os.path.exists(f))
+        e = Experiment(self.d, config=c)
+        for m in e.measurements():
+            w = m['results/wavefunction']
+            self.assertFalse(isinstance(w, numpy.memmap))
+            self.assertTrue((w == m['parameters/t']).all())
+
+        e.activate()
+        for f in sidecars:
+            self.assertTrue(os.path.exists(f))
+        for m in e.measurements():
+            self.assertTrue((m['results/wavefunction'] == m['parameters/t']).all())
+
+        e.reset()
+        for f in sidecars:
+            self.assertFalse(os.path.exists(f))
+        self.assertEqual(e.number_of_measurements(), 0)
+
     def test_activate_an_active_experiment_fails(self):
         fn = self.filename('experiment.000030')
         f = open(fn, 'w')
@@ -2199,6 +2728,77 @@ class TestExperimentXMLAndJsonMixed(unittest.TestCase):
         self.assertEquals(e.id, 1)
         self.assertEquals(e.description, 'Blub')
 
+    @unittest.skipIf(h5py is None, 'requires h5py')
+    def test_can_use_h5_format(self):
+        c = {'archive_default_format': 'h5'}
+        i = IndexFile(self.fi, 'experiment', config=c)
+        i.create()
+
+        c = {'experiment_index': self.fi, 'archive_default_format': 'h5'}
+        e = Experiment(self.d, description='Blub', config=c)
+        e.define_parameter_set(('a','parameters/a'))
+        for a in range(5):
+            e.add_parameter_set(a)
+
+        def run_measurement(p):
+            s = ExampleSimulation()
+            s.a = p.a
+            s.results['energies'] = numpy.arange(10.0) * p.a
+            return s
+
+        self.assertEqual(e.run(run_measurement), (5,5))
+        self.assertTrue(os.path.exists(os.path.join(self.d, 'coma.index.h5')))
+        self.assertTrue(os.path.exists(os.path.join(self.d, 'experiment.000001.h5')))
+        self.assertTrue(os.path.exists(os.path.join(self.d, 'measurement.index.h5')))
+        self.assertTrue(os.path.exists(os.path.join(self.d, 'measurement.000005.h5')))
+
+        # reopen the same experiment
+        e = Experiment(self.d, config=c)
+        self.assertEquals(e.id, 1)
+        self.assertEquals(e.description, 'Blub')
+        self.assertEqual(e.number_of_measurements(), 5)
+        rs = e.retrieve_results([('E','results/energies/3')], [('a','parameters/a')])
+        self.assertEqual([r.table.tolist() for r in rs], [[[3.0*a]] for a in range(5)])
+
+    def test_can_use_compressed_and_binary_formats(self):
+        for fmt in ['json.gz','xml.bz2','bin']:
+            c = {'archive_default_format': fmt}
+            i = IndexFile(self.fi, 'experiment', config=c)
+            i.create()
+
+            c = {'experiment_index': self.fi, 'archive_default_format': fmt}
+            e = Experiment(self.d, description='Blub', config=c)
+            e.define_parameter_set(('a','parameters/a'))
+            for a in range(5):
+                e.add_parameter_set(a)
+
+            def run_measurement(p):
+                s = ExampleSimulation()
+                s.a = p.a
+                return s
+
+            self.assertEqual(e.run(run_measurement), (5,5))
+            self.assertTrue(os.path.exists(os.path.join(self.d, 'coma.index.' + fmt)))
+            self.assertTrue(os.path.exists(os.path.join(self.d, 'experiment.000001.' + fmt)))
+            self.assertTrue(os.path.exists(os.path.join(self.d, 'measurement.000005.' + fmt)))
+
+            # reopen the same experiment
+            e = Experiment(self.d, config=c)
+            self.assertEquals(e.description, 'Blub')
+            self.assertEqual(e.number_of_measurements(), 5)
+            rs = e.retrieve_results([('a','parameters/a')])
+            self.assertEqual(rs[0].table.tolist(), [[a] for a in range(5)])
+            # Loads the files in two worker processes
+            rs = e.retrieve_results([('t','parameters/t'),('a','parameters/a')],
+                                    workers=2)
+            self.assertEqual(rs[0].table.tolist(), [[2,a] for a in range(5)])
+
+            e.deactivate()
+            self.assertEqual(sorted(os.listdir(self.d)),
+                             ['coma.index.' + fmt, 'experiment.000001.' + fmt])
+            shutil.rmtree(self.d)
+            os.mkdir(self.d)
+
     def run_example_experiment_xml_and_json(self, e, r=(0,10)):
         e.start()
         s = ExampleSimulation()
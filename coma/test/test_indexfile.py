@@ -0,0 +1,112 @@
+# Copyright (c) 2014, Burkhard Ritter
+# This code is distributed under the two-clause BSD License.
+
+import unittest
+import os
+import shutil
+import socket
+import subprocess
+import threading
+import time
+from coma import IndexFile
+
+class TestIndexFile(unittest.TestCase):
+    def setUp(self):
+        self.d = os.path.join(os.path.dirname(__file__), 'testindexfile')
+        if os.path.exists(self.d):
+            shutil.rmtree(self.d)
+        os.mkdir(self.d)
+        self.f = os.path.join(self.d, 'measurement.index')
+        self.i = IndexFile(self.f, 'measurement', config={'archive_default_format': 'json'})
+        self.i.create()
+
+    def tearDown(self):
+        if os.path.exists(self.d):
+            shutil.rmtree(self.d)
+
+    def test_increment(self):
+        self.assertEqual(self.i.get(), 0)
+        self.assertEqual(self.i.increment(), 1)
+        self.assertEqual(self.i.increment(), 2)
+        self.assertEqual(self.i.get(), 2)
+        self.assertFalse(os.path.exists(self.i.archive.filename + '.lock'))
+
+    def test_reserve_and_release(self):
+        self.i.increment()
+        ids = self.i.reserve(5)
+        self.assertEqual(ids, [2,3,4,5,6])
+        self.assertEqual(self.i.get(), 6)
+        self.assertEqual(self.i.reserve(0), [])
+
+        # Unused ids at the end of the index are given back
+        self.assertTrue(self.i.release(ids[2:]))
+        self.assertEqual(self.i.get(), 3)
+
+        # But not if other ids were handed out in the meantime
+        ids = self.i.reserve(3)
+        self.assertEqual(ids, [4,5,6])
+        self.assertEqual(self.i.increment(), 7)
+        self.assertFalse(self.i.release(ids[1:]))
+        self.assertEqual(self.i.get(), 7)
+        self.assertFalse(os.path.exists(self.i.archive.filename + '.lock'))
+
+    def write_lock(self, host, pid, t):
+        with open(self.i.archive.filename + '.lock', 'w') as f:
+            f.write('{} {} {} token\n'.format(host, pid, t))
+
+    def test_lock_records_owner(self):
+        self.i.lock()
+        host,pid,t,token = self.i._lock_owner(self.i.archive.filename + '.lock')
+        self.assertEqual(host, socket.gethostname())
+        self.assertEqual(pid, os.getpid())
+        self.i.unlock()
+        self.assertEqual(self.i.lock_stats['locks'], 2)
+        self.assertEqual(self.i.lock_stats['contended'], 0)
+
+    def test_lock_waits_for_the_owner(self):
+        self.write_lock(socket.gethostname(), os.getpid(), time.time())
+        t = threading.Timer(0.2, os.remove, [self.i.archive.filename + '.lock'])
+        t.start()
+        self.assertEqual(self.i.increment(), 1)
+        t.join()
+        self.assertEqual(self.i.lock_stats['contended'], 1)
+        self.assertTrue(self.i.lock_stats['wait_time'] > 0.1)
+
+    def test_lock_times_out(self):
+        self.write_lock(socket.gethostname(), os.getpid(), time.time())
+        self.i.lock_timeout = 0.1
+        with self.assertRaises(IOError):
+            self.i.increment()
+        self.assertEqual(self.i.get(), 0)
+
+    def test_stale_locks_are_broken(self):
+        # Owner process does not exist anymore
+        p = subprocess.Popen(['true'])
+        p.wait()
+        self.write_lock(socket.gethostname(), p.pid, time.time())
+        self.i.lock_timeout = 1
+        self.assertEqual(self.i.increment(), 1)
+
+        # Lock is expired
+        self.write_lock('otherhost', 1, 0)
+        self.i.lock_expiry = 0
+        self.assertEqual(self.i.increment(), 2)
+        self.assertEqual(self.i.lock_stats['broken'], 2)
+        self.assertEqual(os.listdir(self.d), [os.path.basename(self.i.archive.filename)])
+
+    def test_locks_of_live_local_processes_are_not_broken(self):
+        self.write_lock(socket.gethostname(), os.getpid(), 0)
+        self.i.lock_expiry = 0
+        self.i.lock_timeout = 0.1
+        with self.assertRaises(IOError):
+            self.i.increment()
+        self.assertEqual(self.i.lock_stats['broken'], 0)
+
+    def test_unlock_leaves_the_lock_of_another_owner(self):
+        lockfile = self.i.archive.filename + '.lock'
+        self.i.lock()
+        # Our lock is broken and someone else takes it
+        os.remove(lockfile)
+        self.write_lock('otherhost', 1, time.time())
+        self.i.unlock()
+        self.assertEqual(self.i._lock_owner(lockfile)[:2], ('otherhost', 1))
@@ -6,7 +6,9 @@ from collections import OrderedDict
 import os
 import shutil
 import copy
-from coma import FileMeasurement, MemoryMeasurement
+import numpy
+from coma import FileMeasurement, MemoryMeasurement, RecursiveSerializer
+from coma.serialization import h5py, lzma
 
 class ExampleSimulation(object):
     def __init__(self):
@@ -32,6 +34,22 @@ class ExampleSimulation(object):
             ])
         return i
 
+class Layout(object):
+    def __init__(self, N):
+        self.N = N
+        self.positions = numpy.arange(N*2.0).reshape(N,2)
+
+    def my_getstate(self):
+        return OrderedDict([('N', self.N), ('positions', self.positions)])
+
+class NestedSimulation(ExampleSimulation):
+    def my_getstate(self):
+        i = ExampleSimulation.my_getstate(self)
+        i['parameters']['layout'] = Layout(3)
+        i['parameters']['tuple'] = ((1,2),3,float('nan'))
+        i['results']['layouts'] = [Layout(1), Layout(2)]
+        return i
+
 class TestFileMeasurement():
     def setUp(self):
         base_dir = os.path.dirname(__file__)
@@ -168,6 +186,133 @@ class TestFileMeasurement():
         m.parameters.layout.boas = 'muh'
         self.assertEqual(m['parameters/layout/boas'], 'muh')
 
+    def test_measurement_is_loaded_lazily(self):
+        m = FileMeasurement(self.f, id=10, config=self.c)
+        m.start()
+        m.end()
+        m.save(ExampleSimulation())
+
+        m = FileMeasurement(self.f, id=10, config=self.c)
+        self.assertFalse(m._loaded)
+        self.assertEqual(m.id, 10)
+        self.assertFalse(m._loaded)
+        i = m.load_info()
+        self.assertFalse(m._loaded)
+        self.assertEqual(i['measurement_id'], 10)
+        self.assertEqual(i['program'], 'ExampleSimulation')
+        self.assertTrue(i['start_date'] is not None)
+        self.assertEqual(m['parameters/a'], 1)
+        self.assertTrue(m._loaded)
+        self.assertEqual(m.load_info(), i)
+
+        m = FileMeasurement(self.f, config=self.c)
+        self.assertTrue(m.start_date is not None)
+        self.assertTrue(m._loaded)
+
+        m = FileMeasurement(self.f, config=self.c)
+        self.assertEqual(m.id, 10)
+        m = FileMeasurement(self.f, config=self.c)
+        self.assertEqual(m.results.energies, [1,2,3,4])
+
+    def test_failed_save_keeps_the_data(self):
+        s = ExampleSimulation()
+        s.energies = [1, object()]
+        m = FileMeasurement(self.f, id=10, config=self.c)
+        m.start()
+        m.end()
+        with self.assertRaises(Exception):
+            m.save(s)
+        self.assertEqual(m['parameters/a'], 1)
+        m['results/energies'][1] = 2
+        m.save()
+        m = FileMeasurement(self.f, config=self.c)
+        self.assertEqual(m['results/energies'], [1,2])
+
+    def test_large_numpy_arrays_are_stored_in_sidecar_files(self):
+        if self.format in ('h5','bin'):
+            self.skipTest('{} archives store arrays natively'.format(self.format))
+        c = dict(self.c)
+        c['measurement_sidecar_threshold'] = 100
+        s = ExampleSimulation()
+        s.energies = numpy.arange(100, dtype=numpy.float64).reshape(10,10)
+        s.a = numpy.arange(3)
+        sidecar = self.f + '.0.npy'
+
+        m = FileMeasurement(self.f, config=c)
+        m.save(s)
+        self.assertTrue(os.path.exists(sidecar))
+        self.assertEqual(m.sidecar.files(), [sidecar])
+
+        m = FileMeasurement(self.f, config=c)
+        e = m['results/energies']
+        self.assertTrue(isinstance(e, numpy.memmap))
+        self.assertEqual(e.shape, (10,10))
+        self.assertTrue((e == s.energies).all())
+        self.assertFalse(isinstance(m['parameters/a'], numpy.memmap))
+        self.assertTrue((m['parameters/a'] == s.a).all())
+
+        # Loading does not depend on the threshold
+        m = FileMeasurement(self.f, config=self.c)
+        self.assertTrue((m['results/energies'] == s.energies).all())
+
+        # Saving again while the array is memory-mapped
+        m = FileMeasurement(self.f, config=c)
+        m.save()
+        m = FileMeasurement(self.f, config=c)
+        self.assertTrue((m['results/energies'] == s.energies).all())
+
+        # Saving again with fewer large arrays removes the old files
+        s.a = numpy.arange(20)
+        FileMeasurement(self.f, config=c).save(s)
+        self.assertEqual(len(m.sidecar.files()), 2)
+        s.energies = numpy.arange(3)
+        FileMeasurement(self.f, config=c).save(s)
+        self.assertEqual(m.sidecar.files(), [sidecar])
+        m = FileMeasurement(self.f, config=c)
+        self.assertTrue((m['results/energies'] == s.energies).all())
+        self.assertTrue((m['parameters/a'] == s.a).all())
+
+        m.remove()
+        self.assertFalse(os.path.exists(self.fn))
+        self.assertFalse(os.path.exists(sidecar))
+
+    def test_saving_an_object_is_the_same_as_saving_its_serialization(self):
+        s = NestedSimulation()
+        m = FileMeasurement(self.f, id=3, config=self.c)
+        m.start()
+        m.end()
+        m.save(s)
+        self.assertFalse(m._loaded)
+        self.assertEqual(m.start_date, m['info/start_date'])
+        f = open(self.fn, 'rb')
+        b1 = f.read()
+        f.close()
+        d1 = m.data
+        os.remove(self.fn)
+
+        # The old way: serialize everything first, then save
+        r = RecursiveSerializer(serialize_ndarrays=False, config=self.c)
+        o = r.serialize(s)
+        o['info'] = OrderedDict([('program', s.program), ('version', s.version)])
+        m2 = FileMeasurement(self.f, id=3, config=self.c)
+        m2.start_date = m.start_date
+        m2.end_date = m.end_date
+        m2.data = OrderedDict([('info', o.pop('info'))] + o.items())
+        m2.save()
+        f = open(self.fn, 'rb')
+        b2 = f.read()
+        f.close()
+
+        if self.format in ('json','xml','bin'):
+            # HDF5 files and gzip headers contain timestamps
+            self.assertEqual(b1, b2)
+        d2 = FileMeasurement(self.f, config=self.c).data
+        self.assertEqual(d1['parameters']['layout']['positions'].tolist(),
+                         d2['parameters']['layout']['positions'].tolist())
+        self.assertEqual(d1['results']['layouts'][1]['N'], 2)
+        self.assertEqual(d1['info'], d2['info'])
+        self.assertEqual(d1.keys(), d2.keys())
+
 class TestMeasurementXML(TestFileMeasurement, unittest.TestCase):
     def __init__(self, method='runTest'):
         super(TestMeasurementXML, self).__init__(method)
@@ -178,6 +323,28 @@ class TestMeasurementJson(TestFileMeasurement, unittest.TestCase):
         super(TestMeasurementJson, self).__init__(method)
         self.format = 'json'
 
+class TestMeasurementBin(TestFileMeasurement, unittest.TestCase):
+    def __init__(self, method='runTest'):
+        super(TestMeasurementBin, self).__init__(method)
+        self.format = 'bin'
+
+class TestMeasurementJsonGz(TestFileMeasurement, unittest.TestCase):
+    def __init__(self, method='runTest'):
+        super(TestMeasurementJsonGz, self).__init__(method)
+        self.format = 'json.gz'
+
+@unittest.skipIf(lzma is None, 'requires lzma')
+class TestMeasurementXMLXz(TestFileMeasurement, unittest.TestCase):
+    def __init__(self, method='runTest'):
+        super(TestMeasurementXMLXz, self).__init__(method)
+        self.format = 'xml.xz'
+
+@unittest.skipIf(h5py is None, 'requires h5py')
+class TestMeasurementH5(TestFileMeasurement, unittest.TestCase):
+    def __init__(self, method='runTest'):
+        super(TestMeasurementH5, self).__init__(method)
+        self.format = 'h5'
+
 class TestMemoryMeasurement(unittest.TestCase):
     def test_create_memory_measurement_without_data(self):
         o = OrderedDict()
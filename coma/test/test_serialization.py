@@ -4,13 +4,22 @@
 import unittest
 from collections import OrderedDict
 from coma import XMLArchive, XMLArchiveError, JsonArchive, JsonArchiveError, \
-                 Archive, ArchiveError, archive_exists, Serializer, RecursiveSerializer
+                 Archive, ArchiveError, archive_exists, Serializer, RecursiveSerializer, \
+                 H5Archive, H5ArchiveError, BinArchive, BinArchiveError, \
+                 convert_archive
+from coma.serialization import h5py, simplejson
+from coma.path import access_data_by_path
 import os
 import math
 import filecmp
 import shutil
 import numpy
 import copy
+import base64
+import datetime
+import xml.etree.ElementTree as ET
+from xml.dom import minidom
+from StringIO import StringIO
 
 _SIMPLE_XML='''\
 <measurement>
@@ -490,6 +499,17 @@ test_json = \
     'numpy': _NUMPY_JSON
 }
 
+test_paths = [
+    ['info/program'],
+    ['parameters/m/N_col', 'results/average'],
+    ['parameters/*', 'parameters/m/N_row'],
+    ['results/XExpectationValues/2', 'results/ListWithDifferentTypes/*'],
+    ['results/numpy_array/1', 'results/numpy_array_simple'],
+    ['parameters/'],
+    ['muh', 'parameters/muh/blah'],
+    []
+]
+
 # TODO: These tests could certainly be simplified. E.g. TestXMLArchive and
 # TestJsonArchive are mostly equivalent and even overlap with TestArchive.
 
@@ -543,6 +563,17 @@ class Class3(object):
         o['parameters']['all'] = [self.a,self.b]
         return o
 
+class Plain(object):
+    def __init__(self, x):
+        self.x = x
+
+class PlainSubclass(Plain):
+    pass
+
+class _UTC(datetime.tzinfo):
+    def utcoffset(self, dt):
+        return datetime.timedelta(0)
+
 class TestXMLArchive(unittest.TestCase):
     def setUp(self):
         base_dir = os.path.dirname(__file__)
@@ -595,6 +626,24 @@ class TestXMLArchive(unittest.TestCase):
         s = a.dumps(test_data['list'])
         self.assertEqual(test_xml['list'], s)
 
+    def test_dump_is_the_same_as_pretty_printing_with_minidom(self):
+        o = OrderedDict([
+            ('special', ['', ' ', 'a&b<c>"d\'', 'x\r\ny\rz', '  lead', 'line\nbreak']),
+            ('numbers', [None, True, 0, -5, 2**80, 1e-20, 0.1+0.2, float('nan'),
+                         float('inf'), -float('inf')]),
+            ('empty', OrderedDict([('list', []), ('dict', OrderedDict())])),
+            ('nested', [[1,[2]], OrderedDict([('a', (1,2))])]),
+            ('array', numpy.arange(3.0))])
+        for indent in [2, 4]:
+            a = XMLArchive('measurement', indent=indent)
+            s = ET.tostring(a._dump_to_element(o))
+            header = minidom.Document().toprettyxml(indent=a.indent)
+            s = minidom.parseString(s).toprettyxml(indent=a.indent)[len(header):]
+            self.assertEqual(a.dumps(o), s)
+            f = StringIO()
+            a.dump(o, f)
+            self.assertEqual(f.getvalue(), s)
+
     def test_dump_numpy(self):
         a = XMLArchive('measurement')
         s = a.dumps(test_data['numpy'])
@@ -653,6 +702,84 @@ class TestXMLArchive(unittest.TestCase):
         s = a.dumps(d)
         self.assertEqual(test_xml['simple'], s)
 
+    def test_load_only_some_paths(self):
+        a = XMLArchive('measurement')
+        for k in ['simple','list','numpy']:
+            s = a.dumps(test_data[k])
+            for ps in test_paths:
+                o = a.loads(s, ps)
+                for p in ps:
+                    try:
+                        v = access_data_by_path(test_data[k], p)
+                    except KeyError:
+                        self.assertRaises(KeyError, access_data_by_path, o, p)
+                        continue
+                    self.assertTrue(numpy.all(access_data_by_path(o, p) == v))
+
+        o = a.loads(test_xml['simple'], ['parameters/m/N_col'])
+        self.assertEqual(o, OrderedDict([('parameters', OrderedDict([('m', OrderedDict([('N_col',5)]))]))]))
+        o = a.loads(test_xml['list'], ['results/XExpectationValues/1'])
+        self.assertEqual(o['results']['XExpectationValues'], [None,2,None,None,None])
+        self.assertRaises(XMLArchiveError, a.loads, test_xml['invalid_list_1'], ['results'])
+
+    def test_load_validates_lists_and_tags(self):
+        a = XMLArchive('test')
+        with self.assertRaises(XMLArchiveError):
+            a.loads('<test><count>2</count><item_version>0</item_version><item>1</item></test>')
+        with self.assertRaises(XMLArchiveError):
+            a.loads('<test><count>1</count><item_version>0</item_version><muh>1</muh></test>')
+        with self.assertRaises(XMLArchiveError):
+            a.loads('<test><a>1</a><b>2</b><a>3</a></test>')
+        o = a.loads('<test><count>2</count><item_version>0</item_version>'
+                    '<item><a>1</a><b/></item><item><count>0</count><item_version>0</item_version></item></test>')
+        self.assertEqual(o, [OrderedDict([('a',1),('b',None)]), []])
+
+    def test_load_numeric_lists(self):
+        o = OrderedDict([
+            ('ints', range(-5,100)),
+            ('mixed', [0.5, 1, 1e10, -2.5e-3, float('inf'), -float('inf'), 2**70]),
+            ('strings', [1, 'a', '1.0', ' 1', 'inf', None]),
+            ('nested', [1, [2.5, 3]]),
+            ('nan', [float('nan'), 1.5])])
+        a = XMLArchive('test')
+        b = XMLArchive('test', config={'archive_xml_numeric_arrays': True})
+        s = a.dumps(o)
+        for p in [None, ['ints','mixed','strings','nested','nan']]:
+            r = a.loads(s, paths=p)
+            self.assertEqual(r['ints'], range(-5,100))
+            self.assertEqual(r['mixed'], o['mixed'])
+            self.assertEqual([type(v) for v in r['mixed']],
+                             [float, int, float, float, float, float, long])
+            self.assertEqual(r['strings'], [1, 'a', 1.0, ' 1', 'inf', None])
+            self.assertEqual(r['nested'], o['nested'])
+            self.assertTrue(math.isnan(r['nan'][0]))
+
+            r = b.loads(s, paths=p)
+            self.assertEqual(type(r['ints']), numpy.ndarray)
+            self.assertEqual(r['ints'].tolist(), range(-5,100))
+            self.assertEqual(r['mixed'].dtype, object)
+            self.assertEqual(r['nan'].dtype, float)
+            self.assertEqual(r['nested'][1].tolist(), [2.5, 3])
+            self.assertEqual(r['strings'], [1, 'a', 1.0, ' 1', 'inf', None])
+
+        with self.assertRaises(XMLArchiveError):
+            a.loads('<test><count>3</count><item_version>0</item_version><item>1</item></test>')
+        with self.assertRaises(XMLArchiveError):
+            a.loads('<test><count>1</count><item_version>0</item_version><item>1</item><x>1</x></test>')
+
+    def test_load_entry(self):
+        name = self.filename('test_serialization.xml')
+        f = open(name, 'w')
+        f.write(test_xml['simple'])
+        f.close()
+        a = XMLArchive('measurement')
+        self.assertEqual(a.loadfile_entry(name, 'info'), test_data['simple']['info'])
+        self.assertEqual(a.loadfile_entry(name, 'results'), test_data['simple']['results'])
+        with self.assertRaises(KeyError):
+            a.loadfile_entry(name, 'muh')
+        with self.assertRaises(XMLArchiveError):
+            XMLArchive('blah').loadfile_entry(name, 'info')
+
     def test_special_numerical_values(self):
         d = [float('nan'), float('inf'), -float('inf')]
         xml = '<test><count>3</count><item_version>0</item_version><item>NaN</item><item>Infinity</item><item>-Infinity</item></test>'
@@ -791,6 +918,55 @@ class TestJsonArchive(unittest.TestCase):
         s = a.dumps(test_data['numpy'])
         self.assertEqual(test_json['numpy'], s)
 
+    def test_json_backend(self):
+        a = JsonArchive('measurement', config={'archive_json_backend': 'json'})
+        self.assertEqual(a.backend, 'json')
+        with self.assertRaises(JsonArchiveError):
+            JsonArchive('measurement', config={'archive_json_backend': 'muh'})
+        a = JsonArchive('measurement')
+        if simplejson is None:
+            self.assertEqual(a.backend, 'json')
+            with self.assertRaises(JsonArchiveError):
+                JsonArchive('measurement', config={'archive_json_backend': 'simplejson'})
+
+    def test_load_plain_dicts(self):
+        for backend in ['json', 'auto']:
+            c = {'archive_json_ordered': False, 'archive_json_backend': backend}
+            a = JsonArchive('measurement', config=c)
+            for k in ['simple','list']:
+                o = a.loads(test_json[k])
+                self.assertEqual(type(o), dict)
+                self.assertEqual(type(o['info']), dict)
+                self.assertEqual(o, test_data[k])
+            o = a.loads(test_json['numpy'])
+            r = test_data['numpy']['results']
+            self.assertTrue((o['results']['numpy_array'] == r['numpy_array']).all())
+            o = a.loads(test_json['numpy'], paths=['results/numpy_array'])
+            self.assertEqual(type(o['results']), dict)
+            self.assertTrue((o['results']['numpy_array'] == r['numpy_array']).all())
+
+    @unittest.skipIf(simplejson is None, 'requires simplejson')
+    def test_json_backends_produce_identical_output(self):
+        d = [float('nan'), float('inf'), -float('inf'), 1e-300, 0.1, 2**70,
+             True, None, u'\xe4\n"', (1,2), [], {}, numpy.arange(3.0)]
+        for pretty_print in [True, False]:
+            c = {'archive_json_backend': 'json'}
+            a = JsonArchive('measurement', pretty_print=pretty_print, config=c)
+            c = {'archive_json_backend': 'simplejson'}
+            b = JsonArchive('measurement', pretty_print=pretty_print, config=c)
+            self.assertEqual(b.backend, 'simplejson')
+            for k in ['simple','list','numpy']:
+                self.assertEqual(a.dumps(test_data[k]), b.dumps(test_data[k]))
+            s = a.dumps(d)
+            self.assertEqual(s, b.dumps(d))
+
+            o = b.loads(s)
+            self.assertEqual(o[1:-1], a.loads(s)[1:-1])
+            self.assertTrue(math.isnan(o[0]))
+            self.assertEqual(o[-1].tolist(), [0.0,1.0,2.0])
+            self.assertEqual(b.loads(a.dumps(test_data['simple'])).keys(),
+                             test_data['simple'].keys())
+
     def test_load_simple(self):
         with self.assertRaises(JsonArchiveError):
             a = JsonArchive('blah')
@@ -852,6 +1028,56 @@ class TestJsonArchive(unittest.TestCase):
         s = a.dumps(d)
         self.assertEqual(test_json['simple'], s)
 
+    def test_load_only_some_paths(self):
+        a = JsonArchive('measurement')
+        for k in ['simple','list','numpy']:
+            s = a.dumps(test_data[k])
+            for ps in test_paths:
+                o = a.loads(s, ps)
+                for p in ps:
+                    try:
+                        v = access_data_by_path(test_data[k], p)
+                    except KeyError:
+                        self.assertRaises(KeyError, access_data_by_path, o, p)
+                        continue
+                    self.assertTrue(numpy.all(access_data_by_path(o, p) == v))
+
+        o = a.loads(test_json['simple'], ['parameters/m/N_col'])
+        self.assertEqual(o, OrderedDict([('parameters', OrderedDict([('m', OrderedDict([('N_col',5)]))]))]))
+        o = a.loads(test_json['list'], ['results/XExpectationValues/1'])
+        self.assertEqual(o['results']['XExpectationValues'], [None,2,None,None,None])
+        self.assertRaises(JsonArchiveError, a.loads, test_json['invalid_1'], ['results'])
+
+        name = self.filename('test_serialization.json')
+        a.dumpfile(test_data['list'], name)
+        self.assertEqual(a.loadfile(name, ['info/version']),
+                         OrderedDict([('info', OrderedDict([('version', 'ef51159-dirty')]))]))
+
+    def test_load_entry(self):
+        name = self.filename('test_serialization.json')
+        for pretty_print in [True, False]:
+            a = JsonArchive('measurement', pretty_print=pretty_print)
+            a.dumpfile(test_data['simple'], name)
+            self.assertEqual(a.loadfile_entry(name, 'info'), test_data['simple']['info'])
+            self.assertEqual(a.loadfile_entry(name, 'results'), test_data['simple']['results'])
+            with self.assertRaises(KeyError):
+                a.loadfile_entry(name, 'muh')
+
+        # The first entry is read without parsing the rest of the file
+        f = open(name, 'w')
+        f.write('{"measurement": {"info": {"a": 1}, "invalid')
+        f.close()
+        self.assertEqual(a.loadfile_entry(name, 'info'), {'a': 1})
+        with self.assertRaises(JsonArchiveError):
+            a.loadfile_entry(name, 'muh')
+
+        # Scalars that are cut off by the end of the first read
+        for i in [4070, 4093, 4095]:
+            f = open(name, 'w')
+            f.write('{"measurement": {"info": ' + ' '*i + '12345678, "b": 1}}')
+            f.close()
+            self.assertEqual(a.loadfile_entry(name, 'info'), 12345678)
+
     def test_special_numerical_values(self):
         d = [float('nan'), float('inf'), -float('inf')]
         json = '{"test":[NaN,Infinity,-Infinity]}'
@@ -933,6 +1159,261 @@ class TestJsonArchive(unittest.TestCase):
         self.assertTrue(os.path.exists(f1))
         self.assertTrue(filecmp.cmp(f1, f1_ref, shallow=False))
 
+@unittest.skipIf(h5py is None, 'requires h5py')
+class TestH5Archive(unittest.TestCase):
+    def setUp(self):
+        base_dir = os.path.dirname(__file__)
+        self.d = os.path.join(base_dir, 'testh5archive')
+        
+        if os.path.exists(self.d):
+            shutil.rmtree(self.d)
+        os.mkdir(self.d)
+
+    def tearDown(self):
+        if os.path.exists(self.d):
+            shutil.rmtree(self.d)
+
+    def filename(self, f):
+        return os.path.join(self.d, f)
+
+    def test_roundtrip(self):
+        f = self.filename('test.h5')
+        a = H5Archive('measurement')
+        for k in ['simple','list']:
+            a.dumpfile(test_data[k], f)
+            o = a.loadfile(f)
+            self.assertEqual(o, test_data[k])
+            self.assertEqual(o.keys(), test_data[k].keys())
+            self.assertEqual(o['info'].keys(), test_data[k]['info'].keys())
+
+        with self.assertRaises(H5ArchiveError):
+            H5Archive('blah').loadfile(f)
+
+    def test_special_values(self):
+        f = self.filename('test.h5')
+        d = [float('nan'), float('inf'), -float('inf'), True, None, 'a', [], {}]
+        a = H5Archive('test')
+        a.dumpfile(d, f)
+        d2 = a.loadfile(f)
+        self.assertEqual(d[1:], d2[1:])
+        self.assertTrue(math.isnan(d2[0]))
+        self.assertTrue(d2[3] is True)
+
+        with self.assertRaises(H5ArchiveError):
+            a.dumpfile({'a/b': 1}, f)
+
+    def test_numpy_arrays_are_stored_as_datasets(self):
+        f = self.filename('test.h5')
+        c = {'archive_h5_compression': 'gzip', 'archive_h5_compression_level': 9}
+        a = H5Archive('measurement', config=c)
+        a.dumpfile(test_data['numpy'], f)
+
+        h = h5py.File(f, 'r')
+        ds = h['measurement/results/numpy_array']
+        self.assertTrue(isinstance(ds, h5py.Dataset))
+        self.assertEqual(ds.compression, 'gzip')
+        self.assertEqual(ds.compression_opts, 9)
+        self.assertTrue(ds.chunks is not None)
+        h.close()
+
+        o = a.loadfile(f)
+        r = test_data['numpy']['results']
+        self.assertEqual(o['results']['numpy_array'].dtype, r['numpy_array'].dtype)
+        self.assertTrue((o['results']['numpy_array'] == r['numpy_array']).all())
+        self.assertTrue((o['results']['numpy_array_simple'] == r['numpy_array_simple']).all())
+
+    def test_0d_numpy_arrays(self):
+        f = self.filename('test.h5')
+        a = H5Archive('test')
+        a.dumpfile(OrderedDict([('x', numpy.array(2.5)), ('i', numpy.array(3))]), f)
+        for o in [a.loadfile(f), a.loadfile(f, paths=['x','i'])]:
+            self.assertTrue(isinstance(o['x'], numpy.ndarray))
+            self.assertEqual(o['x'].shape, ())
+            self.assertEqual(o['x'], 2.5)
+            self.assertEqual(o['i'].dtype, numpy.array(3).dtype)
+        x = a.loadfile_path(f, 'x')
+        self.assertTrue(isinstance(x, numpy.ndarray))
+        self.assertEqual(x.shape, ())
+
+    def test_load_path(self):
+        f = self.filename('test.h5')
+        a = H5Archive('measurement')
+        a.dumpfile(test_data['numpy'], f)
+        self.assertEqual(a.loadfile_path(f, 'parameters/m'), test_data['numpy']['parameters']['m'])
+        self.assertEqual(a.loadfile_path(f, 'parameters/m/N_col'), 5)
+        self.assertEqual(a.loadfile_path(f, 'results/numpy_array/1/2'), 6)
+        self.assertEqual(a.loadfile_path(f, 'results/numpy_array/1').tolist(), [4,5,6])
+        self.assertEqual(a.loadfile_path(f, 'parameters/*'), [2, test_data['numpy']['parameters']['m']])
+        with self.assertRaises(KeyError):
+            a.loadfile_path(f, 'parameters/muh')
+        with self.assertRaises(KeyError):
+            a.loadfile_path(f, 'results/numpy_array/2')
+
+    def test_load_only_some_paths(self):
+        f = self.filename('test.h5')
+        a = H5Archive('measurement')
+        a.dumpfile(test_data['numpy'], f)
+        o = a.loadfile(f, ['parameters/m/N_col', 'results/numpy_array'])
+        self.assertEqual(o.keys(), ['parameters','results'])
+        self.assertEqual(o['parameters'], OrderedDict([('m', OrderedDict([('N_col',5)]))]))
+        self.assertEqual(o['results'].keys(), ['numpy_array'])
+
+    def test_serialize_and_restore_class_hierarchy(self):
+        f = self.filename('test.h5')
+        o = Class2(3,4)
+        o.object1.a = 30
+        o.object1.b = 40
+
+        c = {
+            'serializer_getstate': '__getstate__',
+            'serializer_setstate': '__setstate__'
+        }
+        a = H5Archive('testhierarchy', config=c)
+        a.dumpfile(o, f)
+        a.serializer = Serializer(restore_objects=True, config=c)
+        o = a.loadfile(f)
+        self.assertEquals(o.c, 3)
+        self.assertEquals(o.object1.a, 30)
+
+    def test_archive_uses_h5_format(self):
+        a = Archive(self.filename('testarchive'), 'measurement', default_format='h5')
+        a.save(test_data['simple'])
+        self.assertTrue(os.path.exists(self.filename('testarchive.h5')))
+        self.assertTrue(archive_exists(self.filename('testarchive')))
+        a = Archive(self.filename('testarchive'), 'measurement')
+        self.assertEqual(a.format, 'h5')
+        self.assertEqual(a.load(), test_data['simple'])
+
+class TestBinArchive(unittest.TestCase):
+    def setUp(self):
+        base_dir = os.path.dirname(__file__)
+        self.d = os.path.join(base_dir, 'testbinarchive')
+        
+        if os.path.exists(self.d):
+            shutil.rmtree(self.d)
+        os.mkdir(self.d)
+
+    def tearDown(self):
+        if os.path.exists(self.d):
+            shutil.rmtree(self.d)
+
+    def filename(self, f):
+        return os.path.join(self.d, f)
+
+    def test_roundtrip(self):
+        f = self.filename('test.bin')
+        a = BinArchive('measurement')
+        for k in ['simple','list']:
+            a.dumpfile(test_data[k], f)
+            o = a.loadfile(f)
+            self.assertEqual(o, test_data[k])
+            self.assertEqual(o.keys(), test_data[k].keys())
+            self.assertEqual(o['info'].keys(), test_data[k]['info'].keys())
+            self.assertEqual(a.dumps(o), open(f, 'rb').read())
+
+        with self.assertRaises(BinArchiveError):
+            BinArchive('blah').loadfile(f)
+        with self.assertRaises(BinArchiveError):
+            a.loads(a.dumps(test_data['simple'])[:-3])
+
+    def test_special_values(self):
+        d = [float('nan'), float('inf'), -float('inf'), True, False, None, 'a',
+             u'\xe4', [], {}, 2**70, -2**63, (1,2)]
+        a = BinArchive('test')
+        d2 = a.loads(a.dumps(d))
+        self.assertEqual(d[1:-1], d2[1:-1])
+        self.assertTrue(math.isnan(d2[0]))
+        self.assertTrue(d2[3] is True)
+        self.assertEqual(d2[-1], [1,2])
+
+    def test_numpy_arrays_are_stored_as_raw_buffers(self):
+        a = BinArchive('measurement')
+        s = a.dumps(test_data['numpy'])
+        r = test_data['numpy']['results']
+        self.assertTrue(r['numpy_array'].tobytes() in s)
+
+        o = a.loads(s)
+        for k in ['numpy_array','numpy_array_simple']:
+            self.assertEqual(o['results'][k].dtype, r[k].dtype)
+            self.assertEqual(o['results'][k].shape, r[k].shape)
+            self.assertTrue((o['results'][k] == r[k]).all())
+        o['results']['numpy_array'][0,0] = 10
+
+        e = numpy.zeros((0,3))
+        z = numpy.array(5.0)
+        f = numpy.asfortranarray(numpy.arange(6).reshape(2,3))
+        o = a.loads(a.dumps([e, z, f]))
+        self.assertEqual(o[0].shape, (0,3))
+        self.assertEqual(o[1], 5.0)
+        self.assertEqual(o[2].tolist(), f.tolist())
+
+    def test_load_only_some_paths(self):
+        f = self.filename('test.bin')
+        a = BinArchive('measurement')
+        a.dumpfile(test_data['numpy'], f)
+        o = a.loadfile(f, ['parameters/m/N_col', 'results/numpy_array'])
+        self.assertEqual(o.keys(), ['parameters','results'])
+        self.assertEqual(o['parameters'], OrderedDict([('m', OrderedDict([('N_col',5)]))]))
+        self.assertEqual(o['results'].keys(), ['numpy_array'])
+        self.assertEqual(a.loadfile_entry(f, 'parameters'), test_data['numpy']['parameters'])
+        with self.assertRaises(KeyError):
+            a.loadfile_entry(f, 'muh')
+
+    def test_files_are_memory_mapped(self):
+        class UnreadableFile(file):
+            def read(self, *args):
+                raise AssertionError('The file was read')
+        f = self.filename('test.bin')
+        a = BinArchive('measurement')
+        a.dumpfile(test_data['numpy'], f)
+        r = test_data['numpy']['results']
+        with UnreadableFile(f, 'rb') as fp:
+            o = a.load(fp)
+        self.assertTrue((o['results']['numpy_array'] == r['numpy_array']).all())
+        o['results']['numpy_array'][0,0] = 10
+        with UnreadableFile(f, 'rb') as fp:
+            o = a.load(fp, ['results/numpy_array_simple'])
+            self.assertEqual(a.load_entry(fp, 'parameters'),
+                             test_data['numpy']['parameters'])
+        self.assertEqual(o['results']['numpy_array_simple'].tolist(),
+                         r['numpy_array_simple'].tolist())
+
+        open(f, 'wb').close()
+        with self.assertRaises(BinArchiveError):
+            a.loadfile(f)
+
+    def test_serialize_and_restore_class_hierarchy(self):
+        o = Class2(3,4)
+        o.object1.a = 30
+        o.object1.b = 40
+
+        c = {
+            'serializer_getstate': '__getstate__',
+            'serializer_setstate': '__setstate__'
+        }
+        a = BinArchive('testhierarchy', config=c)
+        s = a.dumps(o)
+        a.serializer = Serializer(restore_objects=True, config=c)
+        o = a.loads(s)
+        self.assertEquals(o.c, 3)
+        self.assertEquals(o.object1.a, 30)
+
+    def test_convert_archive(self):
+        n = self.filename('testarchive')
+        a = Archive(n, 'measurement', default_format='json')
+        a.save(test_data['numpy'])
+        f = convert_archive(n, 'measurement', 'bin')
+        self.assertEqual(f, n + '.bin')
+        self.assertTrue(os.path.exists(n + '.json'))
+        f = convert_archive(n + '.bin', 'measurement', 'xml', remove=True)
+        self.assertEqual(sorted(os.listdir(self.d)), ['testarchive.json', 'testarchive.xml'])
+        os.remove(n + '.json')
+
+        o = Archive(n, 'measurement').load()
+        r = test_data['numpy']
+        self.assertEqual(o['parameters'], r['parameters'])
+        self.assertTrue((o['results']['numpy_array'] == r['results']['numpy_array']).all())
+
 class TestArchive(unittest.TestCase):
     def setUp(self):
         base_dir = os.path.dirname(__file__)
@@ -962,6 +1443,117 @@ class TestArchive(unittest.TestCase):
         with self.assertRaises(ArchiveError):
             Archive(self.filename('testarchive'), 'measurement')
 
+    def test_compressed_archives(self):
+        o = OrderedDict([('a', 1), ('b', [1.5, float('inf'), 'muh'])])
+        for fmt in ['json.gz', 'json.bz2', 'xml.gz', 'xml.bz2']:
+            a = Archive(self.filename('testarchive'), 'test', default_format=fmt)
+            self.assertEqual(a.filename, self.filename('testarchive.' + fmt))
+            a.save(o)
+            self.assertTrue(archive_exists(self.filename('testarchive')))
+
+            a = Archive(self.filename('testarchive'), 'test')
+            self.assertEqual(a.format, fmt)
+            self.assertEqual(a.load(), o)
+            self.assertEqual(a.load(paths=['b/2']), {'b': [None, None, 'muh']})
+            self.assertEqual(a.load_entry('b'), o['b'])
+            os.remove(a.filename)
+
+    def test_save_homogeneous_lists_column_wise(self):
+        o = OrderedDict([
+            ('objects', [Class3(i,0.5*i) for i in range(50)]),
+            ('dicts', [OrderedDict([('x',i),('y',[i]),('z',None)]) for i in range(50)]),
+            ('arrays', [OrderedDict([('a',numpy.arange(i+1))]) for i in range(3)])])
+        for fmt in ['json', 'xml', 'bin', 'json.gz']:
+            a = Archive(self.filename('rows.'+fmt), 'test')
+            a.save(o)
+            b = Archive(self.filename('columns.'+fmt), 'test',
+                        config={'serializer_columns': True})
+            b.save(o)
+            self.assertTrue(os.path.getsize(b.filename) < os.path.getsize(a.filename))
+            r1 = a.load()
+            r2 = b.load()
+            self.assertEqual(r2['objects'], r1['objects'])
+            self.assertEqual(r2['dicts'], r1['dicts'])
+            for x,y in zip(r1['arrays'], r2['arrays']):
+                self.assertTrue((x['a'] == y['a']).all())
+
+    def test_save_shared_objects_once(self):
+        a = numpy.arange(1000.0)
+        p = OrderedDict([('t',1.0), ('u',[1,2,3])])
+        o = OrderedDict([('a',a), ('p',p), ('items',[
+            OrderedDict([('i',i), ('a',a), ('p',p)]) for i in range(20)])])
+        fmts = ['json', 'xml', 'bin']
+        if h5py is not None:
+            fmts.append('h5')
+        for fmt in fmts:
+            x = Archive(self.filename('copies.'+fmt), 'test')
+            x.save(o)
+            y = Archive(self.filename('shared.'+fmt), 'test',
+                        config={'serializer_references': True})
+            y.save(o)
+            self.assertTrue(os.path.getsize(y.filename) < os.path.getsize(x.filename))
+            r = y.load()
+            self.assertTrue((r['a'] == a).all())
+            self.assertEqual(r['p'], p)
+            for i,d in enumerate(r['items']):
+                self.assertEqual(d['i'], i)
+                self.assertTrue(d['a'] is r['a'])
+                self.assertTrue(d['p'] is r['p'])
+
+    def test_partially_load_shared_objects(self):
+        y = [0,0]
+        o = OrderedDict([('info', OrderedDict([('y',y)])),
+                         ('results', OrderedDict([('x',1), ('y',y)]))])
+        fmts = ['json', 'xml', 'bin']
+        if h5py is not None:
+            fmts.append('h5')
+        c = {'serializer_references': True}
+        for fmt in fmts:
+            Archive(self.filename('shared.'+fmt), 'test', config=c).save(o)
+            # The shared list is stored in "info", outside of the loaded path
+            a = Archive(self.filename('shared.'+fmt), 'test', config=c)
+            r = a.load(['results/y'])
+            self.assertEqual(r['results']['y'], [0,0])
+            self.assertEqual(a.load_entry('results')['y'], [0,0])
+            self.assertEqual(a.load(['info/y'])['info']['y'], [0,0])
+
+        # Paths that go through a shared object
+        layout = OrderedDict([('V1',1), ('N',2)])
+        o = OrderedDict([('info', OrderedDict([('a',1)])),
+                         ('parameters', OrderedDict([('layout',layout), ('t',3)])),
+                         ('results', OrderedDict([('layout',layout)]))])
+        for fmt in fmts:
+            Archive(self.filename('shared2.'+fmt), 'test', config=c).save(o)
+            a = Archive(self.filename('shared2.'+fmt), 'test', config=c)
+            for ps in [['results/layout/V1'], ['parameters/layout/N','results/layout/V1'],
+                       ['parameters/layout/V1','results/layout']]:
+                r = a.load(ps)
+                for p in ps:
+                    self.assertEqual(access_data_by_path(r, p), access_data_by_path(o, p))
+
+    def test_references_are_only_restored_with_the_option(self):
+        s = '{"test": {"a": {"__id__": 0, "__value__": [1]}, "b": {"__ref__": 0}}}'
+        a = JsonArchive('test', config={'serializer_references': True})
+        self.assertEqual(a.loads(s), {'a': [1], 'b': [1]})
+        # Ids of an earlier load are forgotten
+        o = a.loads('{"test": {"b": {"__ref__": 0}}}')
+        self.assertEqual(o['b'], {'__ref__': 0})
+        a = JsonArchive('test')
+        o = a.loads(s)
+        self.assertEqual(o['a'], {'__id__': 0, '__value__': [1]})
+        self.assertEqual(o['b'], {'__ref__': 0})
+
+    def test_compressed_archives_are_detected_unambiguously(self):
+        o = {'a': 1}
+        Archive(self.filename('testarchive'), 'test', default_format='json').save(o)
+        Archive(self.filename('testarchive.json.gz'), 'test').save(o)
+        with self.assertRaises(ArchiveError):
+            Archive(self.filename('testarchive'), 'test')
+        a = Archive(self.filename('testarchive.json.gz'), 'test')
+        self.assertEqual((a.basename, a.format), (self.filename('testarchive'), 'json.gz'))
+        with self.assertRaises(ArchiveError):
+            Archive(self.filename('testarchive'), 'test', default_format='h5.gz')
+
     def test_archive_cannot_be_constructed_with_invalid_format(self):
         with self.assertRaises(ArchiveError):
             Archive(self.filename('testarchive'), 'test', default_format='txt')
@@ -1321,6 +1913,126 @@ class TestSerializer(unittest.TestCase):
             s = Serializer()
             o = s.restore(d)
 
+    def test_serialize_numpy_arrays_with_base64_encoding(self):
+        a = numpy.array([[1,2,3],[4,5,6]], dtype='<i4')
+        s = Serializer(ndarray_encoding='base64')
+        d = s.serialize(a)
+
+        self.assertEquals(d['__type__'], 'numpy.ndarray')
+        self.assertEquals(d['shape'], (2,3))
+        self.assertEquals(d['dtype'], '<i4')
+        self.assertEquals(d['encoding'], 'base64')
+        self.assertFalse(d.has_key('list'))
+        self.assertEquals(d['data'], 'AQAAAAIAAAADAAAABAAAAAUAAAAGAAAA')
+
+        with self.assertRaises(ValueError):
+            Serializer(ndarray_encoding='muh')
+
+    def test_serialize_and_restore_numpy_arrays_with_base64_encoding(self):
+        s = Serializer(ndarray_encoding='base64')
+        arrays = [
+            numpy.array([[1.5,2,3],[4,5,float('nan')]]),
+            numpy.array([1,2,3], dtype='>i8'),
+            numpy.array([1+2j,3-4j], dtype=numpy.complex64),
+            numpy.array([True,False]),
+            numpy.arange(12, dtype=numpy.int16).reshape(3,4).T,
+            numpy.array([], dtype=numpy.float32),
+            numpy.array(3.0)
+        ]
+        for a in arrays:
+            o = s.restore(s.serialize(a))
+            self.assertTrue(isinstance(o, numpy.ndarray))
+            self.assertEqual(o.dtype, a.dtype)
+            self.assertEqual(o.shape, a.shape)
+            self.assertTrue(numpy.array_equal(o[o==o], a[a==a]))
+            o[...] = 0
+
+        # Arrays of objects fall back to the list encoding
+        a = numpy.array([1,'a'], dtype=object)
+        d = s.serialize(a)
+        self.assertTrue(d.has_key('list'))
+
+    def test_restore_numpy_arrays_with_base64_encoding_through_archives(self):
+        c = {'serializer_ndarray_encoding': 'base64'}
+        a = numpy.array([[1,2,3],[4,5,6]], dtype=numpy.uint8)
+        for A in [XMLArchive, JsonArchive]:
+            ar = A('test', config=c)
+            o = ar.loads(ar.dumps(OrderedDict([('a',a),('e',a[:0])])))
+            self.assertEqual(o['a'].dtype, numpy.uint8)
+            self.assertTrue((o['a'] == a).all())
+            self.assertEqual(o['e'].shape, (0,3))
+
+            # Archives without the option still read base64 encoded arrays
+            ar2 = A('test')
+            o = ar2.loads(ar.dumps(a))
+            self.assertTrue((o == a).all())
+
+    def test_restore_base64_data_that_looks_like_a_number(self):
+        c = {'serializer_ndarray_encoding': 'base64'}
+        for data in ['1e99', 'Infinity', 'NaN0', '00001234', '1'*40]:
+            a = numpy.frombuffer(base64.b64decode(data), dtype=numpy.uint8)
+            o = OrderedDict([('x', OrderedDict([('a',a)]))])
+            for pretty_print in [True, False]:
+                ar = XMLArchive('test', pretty_print=pretty_print, config=c)
+                s = ar.dumps(o)
+                self.assertTrue('<data>{}</data>'.format(data) in s)
+                self.assertTrue((ar.loads(s)['x']['a'] == a).all())
+                self.assertTrue((ar.loads(s, paths=['x/a'])['x']['a'] == a).all())
+                self.assertTrue((ar.load_entry(StringIO(s), 'x')['a'] == a).all())
+
+    def test_serialize_and_restore_registered_types(self):
+        o = OrderedDict([
+            ('complex', 1.5-2j),
+            ('int32', numpy.int32(7)),
+            ('float32', numpy.float32(0.25)),
+            ('bool', numpy.bool_(True)),
+            ('date', datetime.date(2014,3,1)),
+            ('datetime', datetime.datetime(2014,3,1,12,30,5)),
+            ('datetime_us', datetime.datetime(2014,3,1,12,30,5,123))])
+        for A in [XMLArchive, JsonArchive, BinArchive]:
+            a = A('test')
+            r = a.loads(a.dumps(o))
+            self.assertEqual(r, o)
+            for k in o.keys():
+                self.assertEqual(type(r[k]), type(o[k]))
+
+        s = Serializer()
+        with self.assertRaises(ValueError):
+            s.serialize(datetime.datetime(2014,3,1,tzinfo=_UTC()))
+
+    def test_register_type(self):
+        s = Serializer()
+        with self.assertRaises(AttributeError):
+            s.serialize(Plain(1))
+        Serializer.register_type(Plain, 'test.plain',
+                                 lambda s,o: {'x': o.x},
+                                 lambda s,d: Plain(d['x']))
+        try:
+            # Subclasses use the encoder of their closest registered base
+            for o in [Plain(3), PlainSubclass(4)]:
+                d = s.serialize(o)
+                self.assertEqual(d.keys(), ['__type__', 'x'])
+                self.assertEqual(d['__type__'], 'test.plain')
+                r = s.restore(d)
+                self.assertEqual(type(r), Plain)
+                self.assertEqual(r.x, o.x)
+            a = JsonArchive('test')
+            self.assertEqual(a.loads(a.dumps([Plain(5)]))[0].x, 5)
+        finally:
+            Serializer.unregister_type(Plain)
+        with self.assertRaises(AttributeError):
+            s.serialize(PlainSubclass(1))
+        # Unknown types are passed through
+        d = OrderedDict([('__type__', 'test.plain'), ('x', 1)])
+        self.assertTrue(s.restore(d) is d)
+
+    def test_restored_classes_are_cached(self):
+        s = Serializer(restore_objects=True, getstate='__getstate__', setstate='__setstate__')
+        d = s.serialize(Class1(1,2))
+        Serializer._classes.pop(d['__class__'], None)
+        s.restore(copy.copy(d))
+        self.assertTrue(Serializer._classes[d['__class__']] is Class1)
+
 class TestRecursiveSerializer(unittest.TestCase):
     def setUp(self):
         self.hierarchy = OrderedDict([
@@ -1395,6 +2107,102 @@ class TestRecursiveSerializer(unittest.TestCase):
         self.assertEquals(p['all'][0], p['a'])
         self.assertEqual(p['a'], self.d_numpy_array)
 
+    def test_serialize_homogeneous_lists_column_wise(self):
+        c = {
+            'serializer_getstate': '__getstate__',
+            'serializer_setstate': '__setstate__',
+            'serializer_columns': True
+        }
+        l = [Class1(i,2*i) for i in range(3)]
+        s = RecursiveSerializer(config=c)
+        d = s.serialize(l)
+        self.assertEqual(d['__type__'], 'columns')
+        self.assertEqual(d['count'], 3)
+        self.assertEqual(d['class'], 'coma.test.test_serialization.Class1')
+        p = d['columns']['parameters']
+        self.assertEqual(p['__type__'], 'columns')
+        self.assertFalse(p.has_key('class'))
+        self.assertEqual(p['columns']['a'], [0,1,2])
+        self.assertEqual(p['columns']['b'], [0,2,4])
+        self.assertEqual(p['columns']['all'], [[0,0],[1,2],[2,4]])
+
+        # Without restoring objects, the result is the same as for a list
+        # that was serialized item by item
+        c2 = dict(c, serializer_columns=False)
+        self.assertEqual(RecursiveSerializer().restore(d),
+                         RecursiveSerializer(config=c2).serialize(l))
+        rs = RecursiveSerializer(restore_objects=True, config=c).restore(d)
+        self.assertEqual([type(r) for r in rs], [Class1]*3)
+        self.assertEqual([(r.a,r.b) for r in rs], [(0,0),(1,2),(2,4)])
+
+        # Lists that are not homogeneous are serialized item by item
+        for l in [[Class1()], [Class1(), Class2()], [Class1(), {'a': 1}],
+                  [{'a': 1}, {'b': 1}], [{'a': 1}, {'a': 1, 'b': 2}],
+                  [{}, {}], [{1: 'a'}, {1: 'b'}], [1, 2], [[1], [2]],
+                  [numpy.zeros(2), numpy.ones(2)]]:
+            self.assertEqual(type(s.serialize(l)), list)
+
+        with self.assertRaises(ValueError):
+            d['columns']['parameters']['columns']['a'].pop()
+            s.restore(d)
+
+    def test_serialize_shared_objects_once(self):
+        c = {
+            'serializer_getstate': '__getstate__',
+            'serializer_setstate': '__setstate__',
+            'serializer_references': True
+        }
+        lattice = Class1(1,2)
+        a = numpy.arange(3)
+        p = OrderedDict([('t',1.0)])
+        l = [1,2]
+        t = (p,)
+        o = OrderedDict([
+            ('x', lattice),
+            ('y', [lattice, a, p]),
+            ('z', OrderedDict([('a',a), ('p',p), ('t',t)])),
+            ('l', l),
+            ('l2', l),
+            ('t', t)])
+        s = RecursiveSerializer(config=c)
+        d = s.serialize(o)
+        self.assertEqual(d['x']['__class__'], 'coma.test.test_serialization.Class1')
+        self.assertEqual(d['x']['__id__'], 0)
+        self.assertEqual(d['y'][0], {'__ref__': 0})
+        self.assertEqual(d['y'][1]['__type__'], 'numpy.ndarray')
+        self.assertEqual(d['y'][1].keys()[-1], '__id__')
+        self.assertEqual(d['z']['a'], {'__ref__': d['y'][1]['__id__']})
+        self.assertEqual(d['z']['t'], [{'__ref__': d['y'][2]['__id__']}])
+        self.assertEqual(d['l'], OrderedDict([('__value__',[1,2]), ('__id__',3)]))
+        self.assertEqual(d['l2'], {'__ref__': 3})
+        self.assertEqual(len(d['t']), 1)
+
+        r = RecursiveSerializer(restore_objects=True, config=c).restore(d)
+        self.assertTrue(isinstance(r['x'], Class1))
+        self.assertTrue(r['x'] is r['y'][0])
+        self.assertTrue(r['y'][1] is r['z']['a'])
+        self.assertTrue((r['y'][1] == a).all())
+        self.assertTrue(r['y'][2] is r['z']['p'])
+        self.assertTrue(r['y'][2] is r['t'][0])
+        self.assertEqual(r['l'], [1,2])
+        self.assertTrue(r['l'] is r['l2'])
+
+        # Without the option, shared objects are copied
+        d = RecursiveSerializer(config=dict(c, serializer_references=False)).serialize(o)
+        self.assertEqual(d['y'][0], d['x'])
+        self.assertFalse(d['x'].has_key('__id__'))
+
+    def test_serialize_circular_references_fails(self):
+        c = {'serializer_references': True}
+        s = RecursiveSerializer(config=c)
+        d = OrderedDict()
+        d['a'] = [1, d]
+        l = []
+        l.append(OrderedDict([('l', l)]))
+        for o in [d, l]:
+            with self.assertRaises(ValueError):
+                s.serialize(o)
+
     def test_restore_numpy_arrays(self):
         d = OrderedDict([('parameters',OrderedDict([
             ('a',self.d_numpy_array),
@@ -2,6 +2,31 @@
 # This code is distributed under the two-clause BSD License.
 
 import datetime
+import multiprocessing
+import multiprocessing.pool
 
 def current_date_as_string():
     return datetime.datetime.utcnow().replace(microsecond=0).isoformat() + 'Z'
+
+def map_in_pool(function, args, workers=None):
+    """Return [function(a) for a in args], computed by `workers` workers.
+
+    The workers are processes, so `function` and `args` must be picklable.
+    Daemonic processes (e.g. the workers of a ProcessPoolExperiment) can't have
+    children, so they use threads instead.
+    The results are in the same order as `args`. If `workers` is None or 1,
+    everything runs in the current process.
+    """
+    if workers is None or workers <= 1 or len(args) <= 1:
+        return [function(a) for a in args]
+    if multiprocessing.current_process().daemon:
+        pool = multiprocessing.pool.ThreadPool(workers)
+    else:
+        pool = multiprocessing.Pool(workers)
+    try:
+        rs = pool.map(function, args, max(1, len(args) // (4*workers)))
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return rs